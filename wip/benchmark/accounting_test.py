@@ -0,0 +1,37 @@
+import io
+
+from wip import common, receiver
+from wip.benchmark.protocol_test import echo, scgi_request, BODY
+
+
+REQUEST = scgi_request() + BODY
+
+
+def test_resource_usage(benchmark):
+    # what each request pays to be accounted: two samples and a delta
+    def sample():
+        common.usage_fields(common.resource_usage(),
+                            common.resource_usage())
+    benchmark('resource_usage', sample)
+
+
+def test_thread_cpu_time(benchmark):
+    benchmark('thread_cpu_time', common.thread_cpu_time)
+
+
+def test_counting_input(benchmark):
+    def read(wrap):
+        wsgi_input = io.BytesIO(BODY)
+        if wrap:
+            wsgi_input = receiver.CountingInput(wsgi_input)
+        wsgi_input.read(len(BODY))
+    benchmark('raw', lambda: read(False))
+    benchmark('counted', lambda: read(True))
+
+
+def test_accounted_request(benchmark):
+    # compare with protocol_test's test_run_app
+    def run():
+        receiver.SCGIRequestProcessor(
+            io.BytesIO(REQUEST), io.BytesIO()).run_app(echo)
+    benchmark('scgi-echo', run)
@@ -0,0 +1,76 @@
+import threading
+import time
+
+import pytest
+
+from wip.common import allowed_cpus
+from wip.functional_test.conftest import serving
+
+
+REQUESTS = 2000
+CLIENTS = 16
+
+
+def placements(pinned):
+    # one shard per receiver either way, so only pinning differs
+    cpus = allowed_cpus() or [0]
+
+    def placement(index):
+        options = ['--shard', str(index)]
+        if pinned:
+            options.extend(['--cpu', str(cpus[index % len(cpus)])])
+        return options
+    return len(cpus), placement
+
+
+@pytest.fixture(scope='module', params=['unpinned', 'pinned'])
+def server(request, tmpdir_factory):
+    receivers, placement = placements(request.param == 'pinned')
+    directory = tmpdir_factory.mktemp('affinity_' + request.param)
+    with serving(directory, receivers=receivers, shards=receivers,
+                 receiver_options=['--production', '--no-log'],
+                 placement=placement) as client:
+        yield request.param, receivers, client
+
+
+def run_clients(client, uri):
+    # (requests per second, each request's latency)
+    per_client = REQUESTS // CLIENTS
+    latencies = [[] for _ in range(CLIENTS)]
+
+    def run(latencies):
+        for _ in range(per_client):
+            started = time.time()
+            client.get(uri)
+            latencies.append(time.time() - started)
+
+    threads = [threading.Thread(target=run, args=(latencies[i],))
+               for i in range(CLIENTS)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    return (per_client * CLIENTS / elapsed,
+            sorted(sum(latencies, [])))
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+@pytest.mark.parametrize('label,uri', [
+    ('hello', '/'),
+    ('large 64KiB', '/large?size=%d' % (64 * 1024,)),
+])
+def test_pinned_against_unpinned(capsys, server, label, uri):
+    placement, receivers, client = server
+    runs = [run_clients(client, uri) for _ in range(3)]
+    rate, latencies = max(runs, key=lambda run: run[0])
+    with capsys.disabled():
+        print('\n%s, %s, %d receivers on %d shards, %d clients: '
+              '%.0f requests/s, p50 %.2f ms, p99 %.2f ms' % (
+                  label, placement, receivers, receivers, CLIENTS, rate,
+                  percentile(latencies, 0.5) * 1e3,
+                  percentile(latencies, 0.99) * 1e3))
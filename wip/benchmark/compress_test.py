@@ -0,0 +1,43 @@
+import io
+import json
+
+import pytest
+
+from wip import receiver
+from wip.benchmark.protocol_test import scgi_request
+from wip.compress import Compress
+
+
+BODY = json.dumps([{'id': i, 'name': 'item %d' % (i,), 'tags': ['a', 'b']}
+                   for i in range(200)]).encode('ascii')
+REQUEST = scgi_request([(b'CONTENT_LENGTH', b'0'),
+                        (b'REQUEST_URI', b'/items'),
+                        (b'HTTP_ACCEPT_ENCODING', b'gzip, deflate')])
+
+
+def json_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'application/json'),
+                              ('Content-Length', str(len(BODY))),
+                              ('ETag', '"items-1"')])
+    return [BODY]
+
+
+APPS = {
+    'identity': json_app,
+    'gzip': Compress(json_app, cache_bytes=0),
+    'gzip-cached': Compress(json_app),
+}
+
+
+@pytest.mark.parametrize('name', sorted(APPS))
+def test_compress(benchmark, name):
+    app = APPS[name]
+
+    def run():
+        outstream = io.BytesIO()
+        receiver.SCGIRequestProcessor(
+            io.BytesIO(REQUEST), outstream).run_app(app)
+        return len(outstream.getvalue())
+
+    benchmark('%s, %d bytes sent for a %d byte body'
+              % (name, run(), len(BODY)), run, number=1000)
@@ -0,0 +1,21 @@
+import timeit
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def runbenchmarks(request):
+    if not request.config.getoption('--runbenchmarks'):
+        pytest.skip('skipping benchmarks')
+
+
+@pytest.fixture
+def benchmark(request, capsys):
+    def run(label, func, number=10000, repeat=5):
+        best = min(timeit.repeat(func, number=number, repeat=repeat))
+        per_call = best / number
+        with capsys.disabled():
+            print('\n%s[%s]: %.2f us/call' % (
+                request.node.name, label, per_call * 1e6))
+        return per_call
+    return run
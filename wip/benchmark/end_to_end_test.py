@@ -0,0 +1,106 @@
+import errno
+import socket
+import threading
+import time
+
+import pytest
+
+from wip.functional_test.conftest import serving
+
+
+REQUESTS = 400
+
+
+@pytest.fixture(scope='module', params=[1, 4])
+def server(request, tmpdir_factory):
+    directory = tmpdir_factory.mktemp('end_to_end')
+    with serving(directory, receivers=request.param,
+                 receiver_options=['--production', '--no-log']) as client:
+        yield request.param, client
+
+
+def run_clients(client, clients, uri, body=None):
+    # requests per second with clients sending REQUESTS between them
+    per_client = REQUESTS // clients
+
+    def run():
+        for _ in range(per_client):
+            if body is None:
+                client.get(uri)
+            else:
+                client.post(uri, body)
+
+    threads = [threading.Thread(target=run) for _ in range(clients)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return per_client * clients / (time.time() - started)
+
+
+@pytest.mark.parametrize('clients', [1, 16])
+@pytest.mark.parametrize('label,uri,body', [
+    ('hello', '/', None),
+    ('echo 64KiB', '/echo', b'x' * 64 * 1024),
+    ('large 1MiB', '/large?size=%d' % (1024 * 1024,), None),
+])
+def test_requests_per_second(capsys, server, clients, label, uri, body):
+    receivers, client = server
+    best = max(run_clients(client, clients, uri, body) for _ in range(3))
+    with capsys.disabled():
+        print('\n%s with %d receivers, %d clients: %.0f requests/s' % (
+            label, receivers, clients, best))
+
+
+@pytest.fixture(scope='module')
+def twisted_server(tmpdir_factory):
+    directory = tmpdir_factory.mktemp('end_to_end_twisted')
+    with serving(directory, receiver_options=[
+            '--twisted', '--production', '--no-log']) as client:
+        yield client
+
+
+@pytest.mark.parametrize('idle', [0, 500])
+def test_twisted_with_idle_connections(capsys, twisted_server, idle):
+    # connections that have sent half a request would each hold a
+    # blocking receiver forever; a single twisted receiver serves on
+    idlers = []
+    try:
+        while len(idlers) < idle:
+            try:
+                sock = twisted_server.connect()
+            except socket.error as e:
+                # the listen queue's full until the receiver catches up
+                if e.args[0] != errno.EAGAIN:
+                    raise
+                time.sleep(0.001)
+                continue
+            sock.sendall(b'70:CONTENT_LENGTH')
+            idlers.append(sock)
+        best = max(run_clients(twisted_server, 16, '/') for _ in range(3))
+    finally:
+        for sock in idlers:
+            sock.close()
+    with capsys.disabled():
+        print('\nhello with 1 twisted receiver, %d idle connections, '
+              '16 clients: %.0f requests/s' % (idle, best))
+
+
+@pytest.fixture(scope='module')
+def dispatch_server(tmpdir_factory):
+    directory = tmpdir_factory.mktemp('end_to_end_dispatch')
+    with serving(directory, receivers=4, handoff_options=['--dispatch'],
+                 receiver_options=['--dispatched', '--production',
+                                   '--no-log']) as client:
+        yield client
+
+
+@pytest.mark.parametrize('clients', [1, 16])
+def test_dispatched_requests_per_second(capsys, dispatch_server, clients):
+    # compare with test_requests_per_second's hello with 4 receivers;
+    # each connection costs a trip through the handoff daemon
+    best = max(run_clients(dispatch_server, clients, '/') for _ in range(3))
+    with capsys.disabled():
+        print('\nhello with 4 dispatched receivers, %d clients: '
+              '%.0f requests/s' % (clients, best))
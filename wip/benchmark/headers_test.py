@@ -0,0 +1,60 @@
+import io
+
+import pytest
+
+from wip import receiver
+from wip.benchmark.protocol_test import NGINX_VARS, scgi_request
+from wip.common import headers_to_native_strings
+
+
+MANY_VARS = NGINX_VARS + [
+    (b'HTTP_X_HEADER_%d' % (i,), b'some value or other %d' % (i,))
+    for i in range(100)]
+
+REQUESTS = {
+    'nginx': scgi_request(),
+    'many': scgi_request(MANY_VARS),
+}
+
+
+def per_field(block):
+    # how headers were parsed before: split, then decode each field
+    headers = block.split(b'\0')
+    if headers[-1] != b'':
+        raise RuntimeError()
+    headers = headers_to_native_strings(headers)
+    return dict(zip(*[iter(headers)] * 2))
+
+
+def rewound(f, read):
+    def run():
+        f.seek(0)
+        return read(f)
+    return run
+
+
+@pytest.mark.parametrize('size', sorted(REQUESTS))
+def test_read_netstring(benchmark, size):
+    # a buffered file, like a socket's, is read without a call per
+    # digit of the length
+    request = REQUESTS[size]
+    benchmark('%s-bytesio' % (size,),
+              rewound(io.BytesIO(request), receiver.read_netstring))
+    benchmark('%s-buffered' % (size,),
+              rewound(io.BufferedReader(io.BytesIO(request)),
+                      receiver.read_netstring))
+
+
+@pytest.mark.parametrize('size', sorted(REQUESTS))
+def test_parse_headers(benchmark, size):
+    block = receiver.read_netstring(io.BytesIO(REQUESTS[size]))
+    assert receiver.parse_headers(block) == per_field(block)
+    benchmark('%s-per-field-unchecked' % (size,), lambda: per_field(block))
+    benchmark('%s-whole-block-checked' % (size,),
+              lambda: receiver.parse_headers(block))
+
+
+@pytest.mark.parametrize('size', sorted(REQUESTS))
+def test_read_headers(benchmark, size):
+    benchmark(size, rewound(io.BufferedReader(io.BytesIO(REQUESTS[size])),
+                            receiver.read_headers))
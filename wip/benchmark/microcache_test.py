@@ -0,0 +1,48 @@
+import io
+import json
+
+import pytest
+
+from wip import receiver
+from wip.benchmark.protocol_test import scgi_request
+from wip.microcache import MemoryStore, MicroCache
+from wip.sharedcache import SharedStore
+
+
+ITEMS = [{'id': i, 'name': 'item %d' % (i,), 'tags': ['a', 'b']}
+         for i in range(200)]
+REQUEST = scgi_request([(b'CONTENT_LENGTH', b'0'),
+                        (b'REQUEST_METHOD', b'GET'),
+                        (b'REQUEST_URI', b'/hot')])
+
+
+def app(environ, start_response):
+    # stands in for an endpoint that does some work
+    body = json.dumps(ITEMS).encode('ascii')
+    start_response('200 OK', [('Content-Type', 'application/json'),
+                              ('Cache-Control', 'max-age=60')])
+    return [body]
+
+
+@pytest.fixture(params=['uncached', 'memory', 'shared', 'shared-zero-copy'])
+def cached_app(request, tmpdir):
+    if request.param == 'uncached':
+        yield request.param, app
+        return
+    if request.param == 'memory':
+        store = MemoryStore()
+    else:
+        store = SharedStore(str(tmpdir.join('cache')))
+    yield request.param, MicroCache(
+        app, store=store, zero_copy=request.param.endswith('zero-copy'))
+
+
+def test_hit(benchmark, cached_app):
+    name, wrapped = cached_app
+
+    def run():
+        receiver.SCGIRequestProcessor(
+            io.BytesIO(REQUEST), io.BytesIO()).run_app(wrapped)
+
+    run()
+    benchmark(name, run)
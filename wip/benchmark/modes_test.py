@@ -0,0 +1,21 @@
+import io
+
+import pytest
+
+from wip import receiver
+from wip.benchmark.protocol_test import BODY, echo, hello, scgi_request
+
+
+REQUEST = scgi_request() + BODY
+
+
+@pytest.mark.parametrize('app', [hello, echo])
+@pytest.mark.parametrize('mode', ['debug', 'production'])
+def test_mode_overhead(benchmark, mode, app):
+    wrapped = receiver.wrap_app(app, mode)
+
+    def run():
+        receiver.SCGIRequestProcessor(
+            io.BytesIO(REQUEST), io.BytesIO()).run_app(wrapped)
+
+    benchmark('%s-%s' % (mode, app.__name__), run)
@@ -0,0 +1,69 @@
+import io
+
+import pytest
+
+from wip import receiver, uwsgi
+
+
+# roughly what nginx's stock scgi_params and uwsgi_params send
+NGINX_VARS = [
+    (b'CONTENT_LENGTH', b'5'),
+    (b'REQUEST_METHOD', b'POST'),
+    (b'REQUEST_URI', b'/some/resource?with=query&string=1'),
+    (b'QUERY_STRING', b'with=query&string=1'),
+    (b'CONTENT_TYPE', b'application/x-www-form-urlencoded'),
+    (b'DOCUMENT_URI', b'/some/resource'),
+    (b'DOCUMENT_ROOT', b'/usr/share/nginx/html'),
+    (b'SCGI', b'1'),
+    (b'SERVER_PROTOCOL', b'HTTP/1.1'),
+    (b'REMOTE_ADDR', b'192.0.2.10'),
+    (b'REMOTE_PORT', b'53124'),
+    (b'SERVER_PORT', b'80'),
+    (b'SERVER_NAME', b'example.com'),
+    (b'HTTP_HOST', b'example.com'),
+    (b'HTTP_USER_AGENT', b'Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101'),
+    (b'HTTP_ACCEPT', b'text/html,application/xhtml+xml,*/*;q=0.8'),
+    (b'HTTP_ACCEPT_ENCODING', b'gzip, deflate'),
+    (b'HTTP_COOKIE', b'session=0123456789abcdef0123456789abcdef'),
+]
+BODY = b'hello'
+
+
+def scgi_request(variables=NGINX_VARS):
+    block = b''.join(key + b'\0' + value + b'\0' for key, value in variables)
+    return str(len(block)).encode('ascii') + b':' + block + b','
+
+
+def hello(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'Hello, world!']
+
+
+def echo(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))]
+
+
+PROTOCOLS = {
+    'scgi': (receiver.read_headers, receiver.SCGIRequestProcessor,
+             scgi_request() + BODY),
+    'uwsgi': (uwsgi.read_vars, uwsgi.UWSGIRequestProcessor,
+              uwsgi.encode_vars(NGINX_VARS) + BODY),
+}
+
+
+@pytest.mark.parametrize('protocol', sorted(PROTOCOLS))
+def test_parse(benchmark, protocol):
+    parse, _, request = PROTOCOLS[protocol]
+    benchmark(protocol, lambda: parse(io.BytesIO(request)))
+
+
+@pytest.mark.parametrize('app', [hello, echo])
+@pytest.mark.parametrize('protocol', sorted(PROTOCOLS))
+def test_run_app(benchmark, protocol, app):
+    _, processor, request = PROTOCOLS[protocol]
+
+    def run():
+        processor(io.BytesIO(request), io.BytesIO()).run_app(app)
+
+    benchmark('%s-%s' % (protocol, app.__name__), run)
@@ -0,0 +1,68 @@
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+
+def import_time(module, preload=()):
+    # microseconds spent importing module, as reported by -X importtime
+    # (cumulative, including its dependencies).  preload is imported
+    # first, to charge what the old receiver imported eagerly.
+    statements = ['import %s' % (name,) for name in preload]
+    statements.append('import %s' % (module,))
+    stderr = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', '; '.join(statements)],
+        stderr=subprocess.STDOUT).decode('ascii')
+    total = 0
+    for line in stderr.splitlines():
+        _, self_us, cumulative_us, name = (
+            field.strip() for field in line.replace('|', ':').split(':'))
+        if name in preload or name == module:
+            total += int(cumulative_us)
+    return total
+
+
+@pytest.mark.parametrize('preload', [
+    (),
+    ('twisted.python.sendmsg', 'eliot', 'six'),
+])
+def test_receiver_import_time(capsys, preload):
+    best = min(import_time('wip.receiver', preload) for _ in range(5))
+    with capsys.disabled():
+        print('\nimport wip.receiver%s: %d us' % (
+            ' with ' + ', '.join(preload) if preload else '', best))
+
+
+@pytest.fixture
+def listener():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    yield sock
+    sock.close()
+
+
+@pytest.mark.parametrize('argv', [[], ['--no-log', '--production']])
+def test_receiver_spawn(benchmark, listener, argv):
+    # from exec to the first response served on an inherited socket
+    args = [sys.executable, '-m', 'wip.receiver', '--protocol', 'http',
+            '--fd', str(listener.fileno())] + argv
+
+    def spawn():
+        with open(os.devnull, 'w') as devnull:
+            proc = subprocess.Popen(args, stdout=devnull,
+                                    pass_fds=[listener.fileno()])
+        try:
+            client = socket.create_connection(listener.getsockname())
+            try:
+                client.sendall(b'GET / HTTP/1.0\r\n\r\n')
+                assert client.recv(4096).startswith(b'HTTP/1.1 200')
+            finally:
+                client.close()
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    benchmark(' '.join(argv) or 'defaults', spawn, number=5, repeat=3)
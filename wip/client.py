@@ -0,0 +1,130 @@
+import socket
+
+from wip.common import headers_to_bytes, headers_to_native_strings
+
+
+def encode_netstring(data):
+    return b''.join([str(len(data)).encode('ascii'), b':', data, b','])
+
+
+def encode_scgi_headers(environ):
+    # environ is a list of (name, value) native strings.  the spec
+    # wants CONTENT_LENGTH first and SCGI present.
+    names = set(name for name, _ in environ)
+    if 'CONTENT_LENGTH' not in names:
+        raise ValueError('SCGI requests need a CONTENT_LENGTH')
+    environ = sorted(environ, key=lambda pair: pair[0] != 'CONTENT_LENGTH')
+    if 'SCGI' not in names:
+        environ.append(('SCGI', '1'))
+    block = headers_to_bytes(''.join(
+        '%s\0%s\0' % (name, value) for name, value in environ))
+    return encode_netstring(block)
+
+
+def request_environ(method, uri, headers=(), body=b''):
+    # roughly what nginx's stock scgi_params send
+    path, _, query = uri.partition('?')
+    environ = [
+        ('CONTENT_LENGTH', str(len(body))),
+        ('REQUEST_METHOD', method),
+        ('REQUEST_URI', uri),
+        ('QUERY_STRING', query),
+        ('DOCUMENT_URI', path),
+        ('SERVER_PROTOCOL', 'HTTP/1.1'),
+        ('SERVER_NAME', 'localhost'),
+        ('SERVER_PORT', '80'),
+        ('REMOTE_ADDR', '127.0.0.1'),
+        ('REMOTE_PORT', '0'),
+    ]
+    for name, value in headers:
+        name = name.upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ.append((name, value))
+    return environ
+
+
+class SCGIResponse(object):
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @property
+    def status_code(self):
+        return int(self.status.split(None, 1)[0])
+
+    def header(self, name):
+        name = name.lower()
+        for header, value in self.headers:
+            if header.lower() == name:
+                return value
+        return None
+
+
+def read_response_head(f):
+    # (status, headers) from a CGI style response
+    status = None
+    headers = []
+    while True:
+        line = f.readline(65536)
+        if not line.endswith(b'\n'):
+            raise RuntimeError()
+        [line] = headers_to_native_strings([line.rstrip(b'\r\n')])
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        if name.lower() == 'status':
+            status = value.strip()
+        else:
+            headers.append((name, value.strip()))
+    if status is None:
+        raise RuntimeError()
+    return status, headers
+
+
+class SCGIClient(object):
+    # speaks SCGI to whatever address a web server would, for tests and
+    # benchmarks that have no web server
+
+    def __init__(self, address, family=socket.AF_UNIX, timeout=10.0):
+        self.address = address
+        self.family = family
+        self.timeout = timeout
+
+    def connect(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def send_request(self, sock, method, uri, headers=(), body=b''):
+        sock.sendall(encode_scgi_headers(
+            request_environ(method, uri, headers, body)))
+        if body:
+            sock.sendall(body)
+
+    def request(self, method, uri, headers=(), body=b''):
+        sock = self.connect()
+        try:
+            self.send_request(sock, method, uri, headers, body)
+            f = sock.makefile('rb')
+            try:
+                status, response_headers = read_response_head(f)
+                # the server closes the connection after the body
+                return SCGIResponse(status, response_headers, f.read())
+            finally:
+                f.close()
+        finally:
+            sock.close()
+
+    def get(self, uri, headers=()):
+        return self.request('GET', uri, headers)
+
+    def post(self, uri, body, headers=()):
+        return self.request('POST', uri, headers, body)
@@ -0,0 +1,42 @@
+import io
+
+import pytest
+
+from wip import client, receiver
+
+
+def test_scgi_headers_round_trip(capture_logging):
+    environ = client.request_environ(
+        'POST', '/echo?a=b', [('Content-Type', 'text/plain'),
+                              ('X-Thing', 'yes')], b'body')
+    encoded = client.encode_scgi_headers(environ)
+    assert encoded.index(b'CONTENT_LENGTH\x004\x00') == encoded.index(b':') + 1
+    with capture_logging():
+        parsed = receiver.read_headers(io.BytesIO(encoded))
+    assert parsed['SCGI'] == '1'
+    assert parsed['REQUEST_URI'] == '/echo?a=b'
+    assert parsed['QUERY_STRING'] == 'a=b'
+    assert parsed['CONTENT_TYPE'] == 'text/plain'
+    assert parsed['HTTP_X_THING'] == 'yes'
+
+
+def test_scgi_headers_need_content_length():
+    with pytest.raises(ValueError):
+        client.encode_scgi_headers([('REQUEST_METHOD', 'GET')])
+
+
+def test_read_response_head():
+    f = io.BytesIO(b'Status: 404 Not Found\r\n'
+                   b'Content-Type: text/plain\r\n\r\nbody')
+    assert client.read_response_head(f) == (
+        '404 Not Found', [('Content-Type', 'text/plain')])
+    assert f.read() == b'body'
+
+
+@pytest.mark.parametrize('head', [
+    b'Content-Type: text/plain\r\n\r\n',
+    b'Status: 200 OK\r\n',
+])
+def test_read_response_head_fails(head):
+    with pytest.raises(RuntimeError):
+        client.read_response_head(io.BytesIO(head))
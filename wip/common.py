@@ -1,6 +1,11 @@
+import fcntl
+import os
+import resource
 import struct
 import socket
-import six
+import sys
+import termios
+import time
 
 
 _SOCK_DESCRIPTION = struct.Struct('iii')
@@ -9,13 +14,298 @@ DESCRIPTION_LENGTH = _SOCK_DESCRIPTION.size
 
 READY_BYTE = b'!'
 
+# in dispatch mode a receiver sends DISPATCH_REQUEST once, then a
+# READY_BYTE each time it wants one of the connections the handoff
+# daemon accepted, which arrives like a listener would
+DISPATCH_REQUEST = b'>'
+# a dispatched receiver that's stopping takes back its READY_BYTE with
+# UNREADY_BYTE.  the daemon lets it go, hanging up once a connection
+# already on its way has been sent.
+UNREADY_BYTE = b'<'
 
-def describe_socket(skt):
-    return _SOCK_DESCRIPTION.pack(skt.family, skt.type, skt.proto)
+# a version 2 handoff is requested by VERSION_REQUEST followed by a
+# single byte naming the highest version the receiver speaks.  the
+# reply carries every named listening socket in one message.
+VERSION_REQUEST = b'?'
+HANDOFF_VERSION = 2
+MAX_HANDOFF_SOCKETS = 64
+# a listener's name is sent with a one byte length
+MAX_LISTENER_NAME_LENGTH = 255
+DEFAULT_LISTENER = 'default'
+
+# version, socket count, length of the entries that follow
+_HANDOFF_HEADER = struct.Struct('!BBH')
+# name length, description length
+_HANDOFF_ENTRY = struct.Struct('!BB')
+
+HANDOFF_HEADER_LENGTH = _HANDOFF_HEADER.size
+
+
+# backlog, listener option count, connection option count
+_SOCK_TUNING = struct.Struct('iHH')
+# level, option name, value
+_SOCK_OPTION = struct.Struct('iii')
+
+_OPTION_LEVELS = (('TCP_', socket.IPPROTO_TCP),
+                  ('SO_', socket.SOL_SOCKET))
+
+
+def parse_socket_option(option):
+    # NAME=VALUE, where NAME is a TCP_ or SO_ constant from the socket
+    # module, e.g. TCP_DEFER_ACCEPT=5
+    name, sep, value = option.partition('=')
+    name = name.upper()
+    for prefix, level in _OPTION_LEVELS:
+        if name.startswith(prefix):
+            break
+    else:
+        raise ValueError('unsupported socket option %r' % (name,))
+    optname = getattr(socket, name, None)
+    if optname is None:
+        raise ValueError('unknown socket option %r' % (name,))
+    try:
+        value = int(value) if sep else 1
+    except ValueError:
+        raise ValueError('socket option values must be integers: %r'
+                         % (option,))
+    return level, optname, value
+
+
+def _option_applies(skt, level):
+    if level == socket.IPPROTO_TCP:
+        return (skt.family in (socket.AF_INET, socket.AF_INET6) and
+                skt.type == socket.SOCK_STREAM)
+    return True
+
+
+class SocketTuning(object):
+
+    def __init__(self, backlog=0, listener_options=(),
+                 connection_options=()):
+        self.backlog = backlog
+        self.listener_options = list(listener_options)
+        self.connection_options = list(connection_options)
+
+    def __eq__(self, other):
+        if not isinstance(other, SocketTuning):
+            return NotImplemented
+        return ((self.backlog, self.listener_options,
+                 self.connection_options) ==
+                (other.backlog, other.listener_options,
+                 other.connection_options))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def encode(self):
+        options = self.listener_options + self.connection_options
+        return b''.join(
+            [_SOCK_TUNING.pack(self.backlog,
+                               len(self.listener_options),
+                               len(self.connection_options))] +
+            [_SOCK_OPTION.pack(*option) for option in options])
+
+    @classmethod
+    def decode(cls, data):
+        if len(data) < _SOCK_TUNING.size:
+            raise RuntimeError()
+        backlog, listener_count, connection_count = (
+            _SOCK_TUNING.unpack_from(data))
+        if len(data) != (_SOCK_TUNING.size +
+                         _SOCK_OPTION.size *
+                         (listener_count + connection_count)):
+            raise RuntimeError()
+        options = [_SOCK_OPTION.unpack_from(data, offset)
+                   for offset in range(_SOCK_TUNING.size, len(data),
+                                       _SOCK_OPTION.size)]
+        return cls(backlog,
+                   options[:listener_count],
+                   options[listener_count:])
+
+    def apply_to_listener(self, skt):
+        for level, optname, value in self.listener_options:
+            if _option_applies(skt, level):
+                skt.setsockopt(level, optname, value)
+        if self.backlog:
+            # listen() on a listening socket only resizes its backlog
+            skt.listen(self.backlog)
+
+    def apply_to_connection(self, skt):
+        for level, optname, value in self.connection_options:
+            if _option_applies(skt, level):
+                skt.setsockopt(level, optname, value)
+
+
+# the head of Linux's struct tcp_info: tcpi_state, then, skipping
+# tcpi_rto, tcpi_ato, tcpi_snd_mss and tcpi_rcv_mss, tcpi_unacked and
+# tcpi_sacked.  for a listening socket those last two are the current
+# accept queue length and its maximum.
+_TCP_INFO = struct.Struct('=B7x16xII')
+_TCP_LISTEN = 10
+
+
+def accept_queue(skt):
+    # (depth, backlog) for a listening TCP socket, or None where the
+    # kernel doesn't say
+    tcp_info = getattr(socket, 'TCP_INFO', None)
+    if (tcp_info is None or
+            not _option_applies(skt, socket.IPPROTO_TCP) or
+            not skt.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN)):
+        return None
+    info = skt.getsockopt(socket.IPPROTO_TCP, tcp_info, _TCP_INFO.size)
+    if len(info) < _TCP_INFO.size:
+        return None
+    state, depth, backlog = _TCP_INFO.unpack_from(info)
+    if state != _TCP_LISTEN:
+        return None
+    return depth, backlog
+
+
+_QUEUED = struct.Struct('i')
+
+
+def send_queue(skt):
+    # (queued, capacity) for a connected socket: bytes written but not
+    # yet taken by the peer, and the send buffer size.  None where the
+    # kernel doesn't say.
+    outq = getattr(termios, 'TIOCOUTQ', None)
+    if outq is None:
+        return None
+    try:
+        queued = fcntl.ioctl(skt.fileno(), outq, b'\0' * _QUEUED.size)
+    except (IOError, OSError):
+        return None
+    [queued] = _QUEUED.unpack(queued)
+    return queued, skt.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+
+
+# the kernel's own value where Python doesn't name it
+SO_INCOMING_CPU = getattr(socket, 'SO_INCOMING_CPU',
+                          49 if sys.platform.startswith('linux') else None)
+_NODE_CPULIST = '/sys/devices/system/node/node%d/cpulist'
+
+
+def parse_cpus(text, node_cpulist=_NODE_CPULIST):
+    # a sorted list of the CPUs in a list like 0-3,8, where nodeN
+    # stands for NUMA node N's CPUs
+    cpus = set()
+    for part in text.split(','):
+        part = part.strip()
+        if part.startswith('node'):
+            try:
+                with open(node_cpulist % (int(part[4:]),)) as f:
+                    node = f.read().strip()
+            except (ValueError, IOError, OSError):
+                raise ValueError('unknown NUMA node %r' % (part,))
+            if node:
+                cpus.update(parse_cpus(node, node_cpulist))
+            continue
+        first, sep, last = part.partition('-')
+        try:
+            first = int(first)
+            last = int(last) if sep else first
+        except ValueError:
+            raise ValueError('expected CPUs like 0-3,8 or node0, got %r'
+                             % (text,))
+        if first < 0 or last < first:
+            raise ValueError('bad CPU range %r' % (part,))
+        cpus.update(range(first, last + 1))
+    if not cpus:
+        raise ValueError('no CPUs in %r' % (text,))
+    return sorted(cpus)
+
+
+def allowed_cpus():
+    # the CPUs this process may run on, or None where that's unknown
+    getaffinity = getattr(os, 'sched_getaffinity', None)
+    if getaffinity is None:
+        return None
+    return sorted(getaffinity(0))
+
+
+def pin_to_cpus(cpus):
+    # keep the calling thread, and the threads it starts from now on,
+    # on cpus.  False where the platform can't.
+    setaffinity = getattr(os, 'sched_setaffinity', None)
+    if setaffinity is None:
+        return False
+    setaffinity(0, cpus)
+    return True
+
+
+def steer_to_cpu(skt, cpu):
+    # of the SO_REUSEPORT sockets sharing skt's port, have the kernel
+    # prefer skt for connections whose packets cpu handles.  False where
+    # it can't.
+    if (SO_INCOMING_CPU is None or
+            not _option_applies(skt, socket.IPPROTO_TCP)):
+        return False
+    skt.setsockopt(socket.SOL_SOCKET, SO_INCOMING_CPU, cpu)
+    return True
+
+
+def shard_name(name, shard):
+    # listener names can't contain ':'.  the first shard keeps the
+    # listener's own name, so receivers that know nothing of shards
+    # still find it.
+    return name if not shard else '%s:%d' % (name, shard)
+
+
+def describe_socket(skt, tuning=None):
+    description = _SOCK_DESCRIPTION.pack(skt.family, skt.type, skt.proto)
+    if tuning is not None:
+        description += tuning.encode()
+    return description
+
+
+def socket_tuning(description):
+    if len(description) == DESCRIPTION_LENGTH:
+        return None
+    return SocketTuning.decode(description[DESCRIPTION_LENGTH:])
+
+
+def describe_fd(fileno):
+    # ask the kernel what an inherited descriptor is, rather than
+    # trusting whoever passed it
+    probe = socket.fromfd(fileno, socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        return _SOCK_DESCRIPTION.pack(
+            probe.getsockopt(socket.SOL_SOCKET, socket.SO_DOMAIN),
+            probe.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE),
+            probe.getsockopt(socket.SOL_SOCKET, socket.SO_PROTOCOL))
+    finally:
+        probe.close()
+
+
+# sd_listen_fds(3)
+SD_LISTEN_FDS_START = 3
+
+
+def listen_fds(environ=None, unset_environment=True):
+    # (name, fd) for each socket passed by systemd-style activation,
+    # or an empty list when there are none for this process
+    environ = os.environ if environ is None else environ
+    try:
+        pid = int(environ.get('LISTEN_PID', ''))
+        count = int(environ.get('LISTEN_FDS', ''))
+    except ValueError:
+        return []
+    names = environ.get('LISTEN_FDNAMES')
+    # ''.split(':') would name a lone socket ''
+    names = [] if names is None else names.split(':')
+    if unset_environment:
+        for key in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+            environ.pop(key, None)
+    if pid != os.getpid():
+        return []
+    if len(names) != count:
+        names = ['unknown'] * count
+    return list(zip(names, range(SD_LISTEN_FDS_START,
+                                 SD_LISTEN_FDS_START + count)))
 
 
 def reconstitute_socket(fileno, description, eliot_action=None):
-    args = _SOCK_DESCRIPTION.unpack(description)
+    args = _SOCK_DESCRIPTION.unpack_from(description)
     skt = socket.fromfd(fileno, *args)
     if eliot_action is not None:
         eliot_action.add_success_fields(
@@ -23,7 +313,60 @@ def reconstitute_socket(fileno, description, eliot_action=None):
     return skt
 
 
-if six.PY3:
+def version_request(version=HANDOFF_VERSION):
+    return VERSION_REQUEST + struct.pack('!B', version)
+
+
+def encode_handoff(listeners):
+    if len(listeners) > MAX_HANDOFF_SOCKETS:
+        raise RuntimeError()
+    if any(len(name) > MAX_LISTENER_NAME_LENGTH for name, _ in listeners):
+        raise RuntimeError()
+    entries = b''.join(
+        _HANDOFF_ENTRY.pack(len(name), len(description)) +
+        name + description
+        for name, description in listeners)
+    return _HANDOFF_HEADER.pack(
+        HANDOFF_VERSION, len(listeners), len(entries)) + entries
+
+
+def handoff_length(header):
+    _, _, length = _HANDOFF_HEADER.unpack_from(header)
+    return _HANDOFF_HEADER.size + length
+
+
+def decode_handoff(data):
+    if len(data) < _HANDOFF_HEADER.size:
+        raise RuntimeError()
+    version, count, length = _HANDOFF_HEADER.unpack_from(data)
+    if (version != HANDOFF_VERSION or
+            len(data) != _HANDOFF_HEADER.size + length):
+        raise RuntimeError()
+    listeners = []
+    offset = _HANDOFF_HEADER.size
+    for _ in range(count):
+        if offset + _HANDOFF_ENTRY.size > len(data):
+            raise RuntimeError()
+        name_length, description_length = _HANDOFF_ENTRY.unpack_from(
+            data, offset)
+        offset += _HANDOFF_ENTRY.size
+        name_end = offset + name_length
+        description_end = name_end + description_length
+        if description_end > len(data):
+            raise RuntimeError()
+        listeners.append((data[offset:name_end],
+                          data[name_end:description_end]))
+        offset = description_end
+    if offset != len(data):
+        raise RuntimeError()
+    return listeners
+
+
+# six is left out on purpose; this module is on every receiver's
+# startup path
+if sys.version_info[0] > 2:
+    from urllib.parse import unquote_to_bytes
+
     # per pep 3333 :(
     # https://www.python.org/dev/peps/pep-3333/#unicode-issues
     _ENCODING = 'ISO-8859-1'
@@ -33,9 +376,57 @@ if six.PY3:
 
     def headers_to_bytes(header_string):
         return header_string.encode(_ENCODING)
+
+    def url_unquote(path):
+        return unquote_to_bytes(path).decode(_ENCODING)
 else:
+    from urllib import unquote
+
     def headers_to_native_strings(headers):
         return headers
 
     def headers_to_bytes(header_string):
         return header_string
+
+    url_unquote = unquote
+
+
+def adopt_fd(fileno, eliot_action=None):
+    skt = reconstitute_socket(fileno, describe_fd(fileno), eliot_action)
+    # reconstitute_socket duplicated it
+    os.close(fileno)
+    return skt
+
+
+# only Linux counts per thread; elsewhere threads muddle the figures
+_RUSAGE_WHO = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+_thread_time = getattr(time, 'thread_time', None)
+
+
+def thread_cpu_time():
+    # CPU seconds the calling thread has used so far
+    if _thread_time is not None:
+        return _thread_time()
+    usage = resource.getrusage(_RUSAGE_WHO)
+    return usage.ru_utime + usage.ru_stime
+
+
+def resource_usage():
+    # (CPU seconds, rusage) for the calling thread, so far
+    usage = resource.getrusage(_RUSAGE_WHO)
+    cpu = (_thread_time() if _thread_time is not None
+           else usage.ru_utime + usage.ru_stime)
+    return cpu, usage
+
+
+def usage_fields(before, after):
+    # what was used between two resource_usage calls.  voluntary
+    # context switches are waits, mostly on I/O; involuntary ones are
+    # the thread being preempted.
+    (cpu_before, before), (cpu_after, after) = before, after
+    return {'cpu_seconds': cpu_after - cpu_before,
+            'user_seconds': after.ru_utime - before.ru_utime,
+            'system_seconds': after.ru_stime - before.ru_stime,
+            'voluntary_switches': after.ru_nvcsw - before.ru_nvcsw,
+            'involuntary_switches': after.ru_nivcsw - before.ru_nivcsw,
+            'major_faults': after.ru_majflt - before.ru_majflt}
@@ -0,0 +1,326 @@
+import collections
+import threading
+import zlib
+
+
+DEFAULT_CONTENT_TYPES = frozenset([
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+    'text/css',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+    'text/xml',
+])
+DEFAULT_LEVEL = 6
+DEFAULT_MIN_SIZE = 512
+DEFAULT_CACHE_BYTES = 8 * 1024 * 1024
+
+# in order of preference
+_WBITS = collections.OrderedDict([
+    ('gzip', 16 + zlib.MAX_WBITS),
+    ('deflate', zlib.MAX_WBITS),
+])
+_UNCOMPRESSIBLE_STATUSES = frozenset([204, 206, 304])
+
+
+def choose_encoding(accept_encoding):
+    # the most preferred of gzip and deflate the client accepts, or None
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = quality
+    best, best_quality = None, 0.0
+    for encoding in _WBITS:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def _is_strong(etag):
+    return etag.startswith('"')
+
+
+def _encoded_etag(etag, encoding):
+    # the compressed body is a different representation, so it needs
+    # its own entity tag
+    if etag.endswith('"'):
+        return '%s-%s"' % (etag[:-1], encoding)
+    return etag
+
+
+class CompressedBodies(object):
+    # a thread safe LRU of compressed bodies, bounded by their total size
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._bodies = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._bodies)
+
+    def get(self, key):
+        with self._lock:
+            body = self._bodies.pop(key, None)
+            if body is not None:
+                self._bodies[key] = body
+            return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._bodies.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._bodies[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._bodies.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class _Response(object):
+    # decides, as late as it has to, whether a single response gets
+    # compressed
+
+    def __init__(self, compress, environ, start_response):
+        self._compress = compress
+        self._environ = environ
+        self._start_response = start_response
+        self._encoding = choose_encoding(
+            environ.get('HTTP_ACCEPT_ENCODING', ''))
+        self._write = None
+        self._status = None
+        self._headers = None
+        self._exc_info = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._reset()
+
+    def _reset(self):
+        # None until decided, then 'identity', 'compress' or 'cached'
+        self._mode = None
+        self._buffered = []
+        self._buffered_size = 0
+        self._compressor = None
+        self._compressed = None
+        self.cache_key = None
+        self.cached = None
+
+    def start_response(self, status, response_headers, exc_info=None):
+        if exc_info is not None and self._write is not None:
+            # too late; let the server raise it
+            self._start_response(status, response_headers, exc_info)
+        self._status = status
+        self._headers = list(response_headers)
+        self._exc_info = exc_info
+        self._reset()
+        self._decide_from_headers()
+        return self.write
+
+    def _header(self, name):
+        for header, value in self._headers:
+            if header.lower() == name:
+                return value
+        return None
+
+    def _without(self, name):
+        return [(header, value) for header, value in self._headers
+                if header.lower() != name]
+
+    def _eligible(self):
+        code = int(self._status.split(None, 1)[0])
+        if code < 200 or code in _UNCOMPRESSIBLE_STATUSES:
+            return False
+        if self._header('content-encoding') is not None:
+            return False
+        if 'no-transform' in (self._header('cache-control') or '').lower():
+            return False
+        content_type = (self._header('content-type') or '').split(';')[0]
+        return (content_type.strip().lower() in
+                self._compress.content_types)
+
+    def _decide_from_headers(self):
+        if not self._eligible():
+            self._mode = 'identity'
+            return
+        vary = self._header('vary')
+        if vary is None:
+            self._headers.append(('Vary', 'Accept-Encoding'))
+        elif 'accept-encoding' not in vary.lower():
+            self._headers = self._without('vary')
+            self._headers.append(('Vary', vary + ', Accept-Encoding'))
+        if self._encoding is None:
+            self._mode = 'identity'
+            return
+        content_length = self._header('content-length')
+        if content_length is not None:
+            if int(content_length) < self._compress.min_size:
+                self._mode = 'identity'
+            else:
+                self._start_compressing()
+        # otherwise buffer until there's enough to be worth it
+
+    def _start_compressing(self):
+        etag = self._header('etag')
+        if self._compress.cache is not None and etag and _is_strong(etag):
+            self.cache_key = (
+                self._environ.get('SCRIPT_NAME', ''),
+                self._environ.get('PATH_INFO', ''),
+                self._environ.get('QUERY_STRING', ''),
+                etag, self._encoding)
+        headers = self._without('content-length')
+        if etag:
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != 'etag']
+            headers.append(('ETag', _encoded_etag(etag, self._encoding)))
+        headers.append(('Content-Encoding', self._encoding))
+        self._headers = headers
+
+        if self.cache_key is not None:
+            self.cached = self._compress.cache.get(self.cache_key)
+        if self.cached is not None:
+            self._mode = 'cached'
+            self._headers.append(('Content-Length', str(len(self.cached))))
+            return
+        self._mode = 'compress'
+        self._compressor = zlib.compressobj(
+            self._compress.level, zlib.DEFLATED, _WBITS[self._encoding])
+        if self.cache_key is not None:
+            self._compressed = []
+
+    def _send_headers(self):
+        if self._write is None:
+            self._write = self._start_response(
+                self._status, self._headers, self._exc_info)
+            self._exc_info = None
+
+    def feed(self, data, flush=False):
+        # what to send for data from the application.  with flush, all
+        # of it that's been compressed is sent now, for streams.
+        self.bytes_in += len(data)
+        if self._mode is None:
+            self._buffered.append(data)
+            self._buffered_size += len(data)
+            if self._buffered_size < self._compress.min_size:
+                return b''
+            self._start_compressing()
+            data = b''.join(self._buffered)
+            self._buffered = None
+        self._send_headers()
+        if self._mode == 'identity':
+            out = data
+        elif self._mode == 'compress':
+            out = self._compressor.compress(data)
+            if flush and data:
+                out += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            if self._compressed is not None:
+                self._compressed.append(out)
+        else:
+            out = b''
+        self.bytes_out += len(out)
+        return out
+
+    def finish(self):
+        # what's left to send once the application is done
+        if self._mode is None:
+            # never reached the minimum size
+            self._mode = 'identity'
+            body = b''.join(self._buffered)
+            self._headers.append(('Content-Length', str(len(body))))
+            self._send_headers()
+            self.bytes_out += len(body)
+            return body
+        self._send_headers()
+        if self._mode == 'cached':
+            self.bytes_out += len(self.cached)
+            return self.cached
+        if self._mode != 'compress':
+            return b''
+        out = self._compressor.flush()
+        self.bytes_out += len(out)
+        if self._compressed is not None:
+            self._compressed.append(out)
+            self._compress.cache.put(
+                self.cache_key, b''.join(self._compressed))
+        return out
+
+    def write(self, data):
+        # pep 3333: what's written must be sent before write returns
+        out = self.feed(data, flush=True)
+        if out:
+            self._write(out)
+
+    @property
+    def compressed(self):
+        return self._mode in ('compress', 'cached')
+
+
+class Compress(object):
+    # WSGI middleware that gzips or deflates responses whose content
+    # type is in content_types, once they're at least min_size bytes.
+    # responses with strong ETags are compressed once and then served
+    # from a cache of at most cache_bytes.
+
+    def __init__(self, app, level=DEFAULT_LEVEL, min_size=DEFAULT_MIN_SIZE,
+                 content_types=DEFAULT_CONTENT_TYPES,
+                 cache_bytes=DEFAULT_CACHE_BYTES):
+        self.app = app
+        self.level = level
+        self.min_size = min_size
+        self.content_types = frozenset(content_types)
+        self.cache = CompressedBodies(cache_bytes) if cache_bytes else None
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.app(environ, start_response)
+        response = _Response(self, environ, start_response)
+        return self._respond(response, self.app(
+            environ, response.start_response))
+
+    def _respond(self, response, result):
+        # like the servers, anything but a list is taken for a stream,
+        # whose chunks have to reach the client as they're produced
+        streaming = not isinstance(result, (list, tuple))
+        try:
+            # on a cache hit the application's body isn't needed
+            if response.cached is None:
+                for chunk in result:
+                    # pep 3333: middleware that's accumulating must
+                    # still yield something for every chunk
+                    yield response.feed(chunk, flush=streaming)
+            yield response.finish()
+        finally:
+            close = getattr(result, 'close', None)
+            if close is not None:
+                close()
+            self._count(response)
+
+    def _count(self, response):
+        with self._stats_lock:
+            self.stats['compressed' if response.compressed
+                       else 'identity'] += 1
+            if response.cache_key is not None:
+                self.stats['cache_hits' if response.cached is not None
+                           else 'cache_misses'] += 1
+            self.stats['bytes_in'] += response.bytes_in
+            self.stats['bytes_out'] += response.bytes_out
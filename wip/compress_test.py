@@ -0,0 +1,234 @@
+import gzip
+import io
+import sys
+import zlib
+
+import pytest
+
+from wip import compress
+
+
+BODY = b'{"key": "value"}' * 100
+
+
+def run(app, accept_encoding='gzip', method='GET', **kwargs):
+    started = []
+
+    def start_response(status, response_headers, exc_info=None):
+        started.append((status, response_headers))
+        return written.append
+
+    written = []
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': '/thing',
+               'HTTP_ACCEPT_ENCODING': accept_encoding}
+    middleware = kwargs.pop('middleware', None) or compress.Compress(
+        app, **kwargs)
+    response = middleware(environ, start_response)
+    try:
+        for chunk in response:
+            if chunk:
+                assert started, 'body before start_response'
+            written.append(chunk)
+    finally:
+        close = getattr(response, 'close', None)
+        if close is not None:
+            close()
+    [(status, headers)] = started
+    return status, dict(headers), b''.join(written)
+
+
+def json_app(body=BODY, headers=(), chunks=1, content_length=True):
+    calls = []
+
+    def app(environ, start_response):
+        calls.append(environ)
+        response_headers = [('Content-Type', 'application/json')]
+        if content_length:
+            response_headers.append(('Content-Length', str(len(body))))
+        start_response('200 OK', response_headers + list(headers))
+        size = -(-len(body) // chunks)
+        return [body[i:i + size] for i in range(0, len(body), size)]
+    app.calls = calls
+    return app
+
+
+@pytest.mark.parametrize('accept_encoding,chosen', [
+    ('gzip, deflate', 'gzip'),
+    ('deflate', 'deflate'),
+    ('gzip;q=0.5, deflate', 'deflate'),
+    ('GZIP', 'gzip'),
+    ('*', 'gzip'),
+    ('*;q=0, deflate;q=0.1', 'deflate'),
+    ('gzip;q=0, *', 'deflate'),
+    ('br', None),
+    ('gzip;q=0', None),
+    ('gzip;q=nonsense', None),
+    ('', None),
+])
+def test_choose_encoding(accept_encoding, chosen):
+    assert compress.choose_encoding(accept_encoding) == chosen
+
+
+@pytest.mark.parametrize('chunks', [1, 7])
+@pytest.mark.parametrize('content_length', [True, False])
+def test_gzip(chunks, content_length):
+    status, headers, body = run(
+        json_app(chunks=chunks, content_length=content_length))
+    assert status == '200 OK'
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert 'Content-Length' not in headers
+    assert gzip.GzipFile(fileobj=io.BytesIO(body)).read() == BODY
+
+
+def test_deflate():
+    _, headers, body = run(json_app(), accept_encoding='deflate')
+    assert headers['Content-Encoding'] == 'deflate'
+    assert zlib.decompress(body) == BODY
+
+
+@pytest.mark.parametrize('content_length', [True, False])
+def test_small_responses_are_left_alone(content_length):
+    _, headers, body = run(json_app(b'{}', content_length=content_length))
+    assert 'Content-Encoding' not in headers
+    assert headers['Content-Length'] == '2'
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert body == b'{}'
+
+
+@pytest.mark.parametrize('headers,accept_encoding', [
+    ([('Content-Type', 'image/png')], 'gzip'),
+    ([('Content-Encoding', 'br')], 'gzip'),
+    ([('Cache-Control', 'public, no-transform')], 'gzip'),
+    ([], 'identity'),
+])
+def test_not_compressed(headers, accept_encoding):
+    def app(environ, start_response):
+        response_headers = [('Content-Type', 'application/json')]
+        names = set(name for name, _ in headers)
+        start_response('200 OK', [header for header in response_headers
+                                  if header[0] not in names] + headers)
+        return [BODY]
+
+    _, response_headers, body = run(app, accept_encoding=accept_encoding)
+    assert 'gzip' not in response_headers.get('Content-Encoding', '')
+    assert body == BODY
+
+
+def test_head_is_untouched():
+    app = json_app()
+    _, headers, body = run(app, method='HEAD')
+    assert 'Content-Encoding' not in headers
+    assert 'Vary' not in headers
+
+
+def test_existing_vary_is_extended():
+    _, headers, _ = run(json_app(headers=[('Vary', 'Cookie')]))
+    assert headers['Vary'] == 'Cookie, Accept-Encoding'
+
+
+def test_allowlist_and_level():
+    app = json_app()
+    _, headers, body = run(app, content_types=['text/csv'])
+    assert 'Content-Encoding' not in headers
+
+    _, headers, fast = run(app, level=1)
+    _, headers, small = run(app, level=9)
+    assert len(small) <= len(fast)
+
+
+def test_write_callable():
+    def app(environ, start_response):
+        write = start_response('200 OK', [('Content-Type', 'text/plain')])
+        write(BODY[:1000])
+        write(BODY[1000:])
+        return []
+
+    _, headers, body = run(app)
+    # a chunk can only be written once the headers are out
+    assert headers['Content-Encoding'] == 'gzip'
+    assert gzip.GzipFile(fileobj=io.BytesIO(body)).read() == BODY
+
+
+def test_streams_arrive_as_they_are_produced():
+    events = [b'{"event": %d, "padding": "%s"}' % (i, b'x' * 570)
+              for i in range(5)]
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        for event in events:
+            yield event
+
+    middleware = compress.Compress(app)
+    response = middleware({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/',
+                           'HTTP_ACCEPT_ENCODING': 'gzip'},
+                          lambda status, headers, exc_info=None: None)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    # each event can be decompressed as soon as it's yielded
+    for i, chunk in enumerate(response):
+        if i == len(events):
+            break
+        assert decompressor.decompress(chunk) == events[i]
+    response.close()
+
+
+def test_etag_cache():
+    app = json_app(headers=[('ETag', '"v1"')])
+    middleware = compress.Compress(app)
+
+    _, headers, first = run(app, middleware=middleware)
+    assert headers['ETag'] == '"v1-gzip"'
+    _, headers, second = run(app, middleware=middleware)
+    assert headers['Content-Length'] == str(len(first))
+    assert second == first
+    assert len(app.calls) == 2
+    assert middleware.stats['cache_misses'] == 1
+    assert middleware.stats['cache_hits'] == 1
+    assert middleware.stats['compressed'] == 2
+    assert middleware.stats['bytes_in'] == len(BODY)
+    assert middleware.stats['bytes_out'] == len(first) * 2
+
+    # the cache is per encoding
+    _, headers, deflated = run(app, accept_encoding='deflate',
+                               middleware=middleware)
+    assert zlib.decompress(deflated) == BODY
+    assert middleware.stats['cache_misses'] == 2
+
+
+def test_weak_etags_are_not_cached():
+    app = json_app(headers=[('ETag', 'W/"v1"')])
+    middleware = compress.Compress(app)
+    run(app, middleware=middleware)
+    _, headers, _ = run(app, middleware=middleware)
+    assert headers['ETag'] == 'W/"v1-gzip"'
+    assert len(middleware.cache) == 0
+    assert middleware.stats['cache_hits'] == 0
+
+
+def test_compressed_bodies_evicts_least_recently_used():
+    bodies = compress.CompressedBodies(10)
+    bodies.put('a', b'aaaa')
+    bodies.put('b', b'bbbb')
+    assert bodies.get('a') == b'aaaa'
+    bodies.put('c', b'cccc')
+    assert bodies.get('b') is None
+    assert bodies.get('a') == b'aaaa'
+    assert bodies.size == 8
+    bodies.put('huge', b'x' * 11)
+    assert bodies.get('huge') is None
+    assert len(bodies) == 2
+
+
+def test_late_error_replaces_buffered_response():
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        try:
+            raise ValueError()
+        except ValueError:
+            start_response('500 Internal Server Error',
+                           [('Content-Type', 'text/plain')], sys.exc_info())
+        return [b'oops']
+
+    status, headers, body = run(app)
+    assert status == '500 Internal Server Error'
+    assert body == b'oops'
@@ -8,7 +8,10 @@ from eliot.testing import UnflushedTracebacks
 def pytest_addoption(parser):
     parser.addoption(
         '--runfunctional', action='store_true',
-        help='run functional tests')
+        help='run the functional tests that need nginx')
+    parser.addoption(
+        '--runbenchmarks', action='store_true',
+        help='run benchmarks')
 
 
 @pytest.fixture
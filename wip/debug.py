@@ -0,0 +1,95 @@
+class InvariantError(AssertionError):
+    # like paste.lint's failures, these are bugs rather than bad requests
+    pass
+
+
+class CheckedInput(object):
+    # a wsgi.input that insists the body is no more than CONTENT_LENGTH
+    # bytes.  one that ends early is the client's doing, for the server
+    # and middleware to answer, not a bug.
+
+    def __init__(self, wsgi_input, content_length):
+        self._input = wsgi_input
+        self._remaining = content_length
+
+    def _check(self, data, size):
+        self._remaining -= len(data)
+        if self._remaining < 0:
+            raise InvariantError(
+                'wsgi.input returned %d bytes past CONTENT_LENGTH' % (
+                    -self._remaining,))
+        return data
+
+    def read(self, size=-1):
+        return self._check(self._input.read(size), size)
+
+    def readline(self, size=-1):
+        return self._check(self._input.readline(size), size)
+
+    def readlines(self, hint=-1):
+        # pep 3333 lets the hint be ignored
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+
+# statuses whose responses never carry a body, whatever Content-Length says
+_BODYLESS_STATUSES = (204, 304)
+
+
+def _has_body(method, status):
+    code = int(status.split(None, 1)[0])
+    return (method != 'HEAD' and code >= 200 and
+            code not in _BODYLESS_STATUSES)
+
+
+class _CheckedResponse(object):
+
+    def __init__(self, response, state):
+        self._response = response
+        self._state = state
+
+    def __iter__(self):
+        for chunk in self._response:
+            self._state['written'] += len(chunk)
+            yield chunk
+        expected = self._state['content_length']
+        if expected is not None and self._state['written'] != expected:
+            raise InvariantError(
+                'Content-Length was %d but %d bytes were written' % (
+                    expected, self._state['written']))
+
+    def close(self):
+        close = getattr(self._response, 'close', None)
+        if close is not None:
+            close()
+
+
+def check_invariants(app):
+    # what paste.lint doesn't check: that the body the server hands over
+    # agrees with CONTENT_LENGTH, and that a response's Content-Length
+    # agrees with what the application wrote.  a HEAD response and a
+    # 1xx, 204 or 304 response declare a length they don't send.
+    def checked(environ, start_response):
+        if environ.get('CONTENT_LENGTH'):
+            environ['wsgi.input'] = CheckedInput(
+                environ['wsgi.input'], int(environ['CONTENT_LENGTH']))
+        state = {'content_length': None, 'written': 0}
+
+        def checked_start_response(status, response_headers, exc_info=None):
+            state['content_length'] = None
+            if _has_body(environ.get('REQUEST_METHOD'), status):
+                for name, value in response_headers:
+                    if name.lower() == 'content-length':
+                        state['content_length'] = int(value)
+            write = start_response(status, response_headers, exc_info)
+
+            def checked_write(data):
+                state['written'] += len(data)
+                write(data)
+            return checked_write
+
+        return _CheckedResponse(app(environ, checked_start_response), state)
+
+    return checked
@@ -0,0 +1,139 @@
+import io
+
+import pytest
+
+from wip import debug, receiver, spool
+
+
+def run(app, environ, wrap=debug.check_invariants):
+    started = []
+
+    def start_response(status, response_headers, exc_info=None):
+        started.append((status, response_headers))
+        return written.append
+
+    written = []
+    response = wrap(app)(environ, start_response)
+    try:
+        written.extend(response)
+    finally:
+        response.close()
+    return started, b''.join(written)
+
+
+def reader(size):
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        return [environ['wsgi.input'].read(size)]
+    return app
+
+
+@pytest.mark.parametrize('body,size', [(b'abc', 3), (b'abc', 1)])
+def test_body_agrees_with_content_length(body, size):
+    environ = {'CONTENT_LENGTH': '3', 'wsgi.input': io.BytesIO(body)}
+    assert run(reader(size), environ)[1] == body[:size]
+
+
+def test_body_short_of_content_length_is_the_clients_doing():
+    environ = {'CONTENT_LENGTH': '5', 'wsgi.input': io.BytesIO(b'abc')}
+
+    def lines(environ, start_response):
+        start_response('200 OK', [])
+        return environ['wsgi.input'].readlines()
+    assert run(lines, environ)[1] == b'abc'
+
+
+def test_short_body_reaches_the_spool():
+    environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/',
+               'CONTENT_LENGTH': '100', 'wsgi.input': io.BytesIO(b'abc')}
+    started, _ = run(spool.SpoolBody(reader(-1)), environ)
+    assert started[0][0] == '400 Bad Request'
+
+
+def test_body_past_content_length():
+    environ = {'CONTENT_LENGTH': '2', 'wsgi.input': io.BytesIO(b'abc')}
+    with pytest.raises(debug.InvariantError):
+        run(reader(3), environ)
+
+
+def test_no_content_length_is_unchecked():
+    environ = {'CONTENT_LENGTH': '', 'wsgi.input': io.BytesIO(b'abc')}
+    assert run(reader(-1), environ)[1] == b'abc'
+
+
+@pytest.mark.parametrize('chunks,ok', [
+    ([b'ab', b'c'], True),
+    ([b'ab'], False),
+    ([b'abcd'], False),
+])
+def test_response_agrees_with_content_length(chunks, ok):
+    closed = []
+
+    class Response(object):
+        def __iter__(self):
+            return iter(chunks)
+
+        def close(self):
+            closed.append(True)
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-length', '3')])
+        return Response()
+
+    if ok:
+        assert run(app, {})[1] == b'abc'
+    else:
+        with pytest.raises(debug.InvariantError):
+            run(app, {})
+    assert closed
+
+
+def test_write_counts_toward_content_length():
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Length', '3')])(b'a')
+        return [b'bc']
+
+    assert run(app, {})[1] == b'abc'
+
+
+@pytest.mark.parametrize('method,status', [
+    ('HEAD', '200 OK'),
+    ('GET', '100 Continue'),
+    ('GET', '204 No Content'),
+    ('GET', '304 Not Modified'),
+])
+def test_bodyless_response_content_length_is_unchecked(method, status):
+    def app(environ, start_response):
+        start_response(status, [('Content-Length', '3')])
+        return []
+
+    assert run(app, {'REQUEST_METHOD': method}) == (
+        [(status, [('Content-Length', '3')])], b'')
+
+
+def test_empty_get_response_is_checked():
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Length', '3')])
+        return []
+
+    with pytest.raises(debug.InvariantError):
+        run(app, {'REQUEST_METHOD': 'GET'})
+
+
+def test_production_app_is_unwrapped():
+    assert receiver.wrap_app(receiver.test_app, 'production') is (
+        receiver.test_app)
+
+
+def test_debug_app_is_checked():
+    app = receiver.wrap_app(receiver.test_app, 'debug')
+    started, body = run(app, {
+        'REQUEST_METHOD': 'GET', 'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.0',
+        'SCRIPT_NAME': '', 'PATH_INFO': '/', 'QUERY_STRING': '',
+        'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(), 'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': False, 'wsgi.multiprocess': True,
+        'wsgi.run_once': False}, wrap=lambda app: app)
+    assert started[0][0] == '200 OK'
+    assert body == b''
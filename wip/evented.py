@@ -0,0 +1,328 @@
+import io
+import socket
+import tempfile
+import threading
+
+from twisted.internet import protocol, task, tcp, unix
+from twisted.internet.interfaces import IPushProducer
+from twisted.python.threadpool import ThreadPool
+from zope.interface import implementer
+
+from wip.lazy import types as t
+from wip.receiver import (WSGIRequestProcessor,
+                          cgi_headers,
+                          read_headers,
+                          MAX_HEADER_LENGTH,
+                          MAX_LENGTH_DIGITS)
+
+
+DEFAULT_SPOOL_MEMORY = 1024 * 1024
+DEFAULT_STATS_INTERVAL = 60
+# how often shutting down looks to see if the last response is out
+DRAIN_INTERVAL = 0.05
+
+
+class ReceiverStats(object):
+    # what an evented receiver is up to.  connections are counted from
+    # the reactor; requests move from queued to active to done on the
+    # pool's threads.
+
+    def __init__(self):
+        self.connections = 0
+        self.queued = 0
+        self.active = 0
+        self.requests = 0
+        # dispatched but not yet disconnected, so its response may
+        # still be on the way; only touched on the reactor
+        self.responding = 0
+        self._lock = threading.Lock()
+
+    def connected(self):
+        self.connections += 1
+
+    def disconnected(self):
+        self.connections -= 1
+
+    def dispatched(self):
+        with self._lock:
+            self.queued += 1
+
+    def started(self):
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+
+    def finished(self):
+        with self._lock:
+            self.active -= 1
+            self.requests += 1
+
+    def report(self):
+        with self._lock:
+            return {'connections': self.connections,
+                    'queued': self.queued,
+                    'active': self.active,
+                    'requests': self.requests}
+
+
+@implementer(IPushProducer)
+class _TransportWriter(object):
+    # a file-like outstream for a pool thread, which writes through the
+    # reactor.  only one write is ever on its way to the reactor, and the
+    # next waits until the transport's taken it and hasn't asked for a
+    # pause, so a fast application can't queue up more than the
+    # transport's buffer.
+
+    def __init__(self, reactor, transport):
+        self._reactor = reactor
+        self._transport = transport
+        self._ready = threading.Event()
+        self._ready.set()
+        # only touched on the reactor
+        self._paused = False
+        self.lost = False
+
+    def write(self, data):
+        self._ready.wait()
+        if self.lost:
+            return
+        if not isinstance(data, bytes):
+            # the write happens later, on the reactor, so a view into
+            # memory that may change by then has to be copied now
+            data = bytes(data)
+        self._ready.clear()
+        self._reactor.callFromThread(self._write, data)
+
+    def _write(self, data):
+        # on the reactor; the transport may pause us from in here
+        if not self.lost:
+            self._transport.write(data)
+        if not self._paused:
+            self._ready.set()
+
+    def flush(self):
+        pass
+
+    def pauseProducing(self):
+        self._paused = True
+        self._ready.clear()
+
+    def resumeProducing(self):
+        self._paused = False
+        self._ready.set()
+
+    def stopProducing(self):
+        self.lost = True
+        self._ready.set()
+
+
+class EventedSCGIRequest(WSGIRequestProcessor):
+    # a request whose headers and body the reactor has already read,
+    # run on a pool thread
+    multithread = True
+
+    def __init__(self, environ, wsgi_input, outstream):
+        super(EventedSCGIRequest, self).__init__(None, outstream)
+        self._environ = environ
+        self._input = wsgi_input
+
+    def _determine_environment(self):
+        return self._populate_environment(self._environ, self._input)
+
+    def _format_headers(self, status, response_headers):
+        return cgi_headers(status, response_headers)
+
+    def _client_gone(self):
+        return self._outstream.lost
+
+
+class SCGIProtocol(protocol.Protocol):
+    # reads one SCGI request without blocking, spooling its body, then
+    # hands it to the pool.  idle and slow clients only cost a
+    # connection.
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._buffer = b''
+        self._body = None
+        self._remaining = None
+        self._environ = None
+        self._writer = None
+
+    def connectionMade(self):
+        self.factory.stats.connected()
+        t.SCGI_ACCEPTED().write()
+        if self.factory.tuning is not None:
+            self.factory.tuning.apply_to_connection(
+                self.transport.getHandle())
+
+    def connectionLost(self, reason):
+        self.factory.stats.disconnected()
+        if self._writer is not None:
+            self.factory.stats.responding -= 1
+            self._writer.stopProducing()
+        elif self._body is not None:
+            self._body.close()
+
+    def dataReceived(self, data):
+        if self._writer is not None:
+            # SCGI has one request per connection
+            return
+        if self._environ is None:
+            self._buffer += data
+            try:
+                self._environ = self._parse_headers()
+            except RuntimeError:
+                self.transport.abortConnection()
+                return
+            if self._environ is None:
+                return
+            data, self._buffer = self._buffer, None
+            self._remaining = int(self._environ['CONTENT_LENGTH'])
+            self._body = tempfile.SpooledTemporaryFile(
+                max_size=self.factory.spool_memory)
+        data = data[:self._remaining]
+        self._body.write(data)
+        self._remaining -= len(data)
+        if not self._remaining:
+            self._dispatch()
+
+    def _parse_headers(self):
+        # the environ once the whole netstring's arrived, else None.
+        # whatever follows it is left in the buffer.
+        colon = self._buffer.find(b':', 0, MAX_LENGTH_DIGITS + 1)
+        if colon < 0:
+            if len(self._buffer) > MAX_LENGTH_DIGITS:
+                raise RuntimeError()
+            return None
+        if not self._buffer[:colon].isdigit():
+            raise RuntimeError()
+        length = int(self._buffer[:colon])
+        if length > MAX_HEADER_LENGTH:
+            # don't buffer what read_headers would refuse anyway
+            raise RuntimeError()
+        end = colon + 1 + length + 1
+        if len(self._buffer) < end:
+            return None
+        environ = read_headers(io.BytesIO(self._buffer[:end]))
+        if not environ.get('CONTENT_LENGTH', '').isdigit():
+            raise RuntimeError()
+        self._buffer = self._buffer[end:]
+        return environ
+
+    def _dispatch(self):
+        self._body.seek(0)
+        self._writer = _TransportWriter(self.factory.reactor, self.transport)
+        # keep reading, and throwing away, whatever else arrives, so a
+        # hangup's noticed
+        self.transport.registerProducer(self._writer, True)
+        request = EventedSCGIRequest(self._environ, self._body, self._writer)
+        self.factory.stats.responding += 1
+        self.factory.stats.dispatched()
+        self.factory.pool.callInThread(self._run, request)
+
+    def _run(self, request):
+        # on a pool thread
+        self.factory.stats.started()
+        try:
+            with t.SCGI_REQUEST():
+                request.run_app(self.factory.app)
+        except Exception:
+            # already logged by the failed action
+            self.factory.reactor.callFromThread(self._abort)
+        else:
+            self.factory.reactor.callFromThread(self._finish)
+        finally:
+            self._body.close()
+            self.factory.stats.finished()
+
+    def _finish(self):
+        self.transport.unregisterProducer()
+        self.transport.loseConnection()
+
+    def _abort(self):
+        self.transport.unregisterProducer()
+        self.transport.abortConnection()
+
+
+class SCGIFactory(protocol.Factory):
+
+    def __init__(self, reactor, app, pool, stats, tuning=None,
+                 spool_memory=DEFAULT_SPOOL_MEMORY):
+        self.reactor = reactor
+        self.app = app
+        self.pool = pool
+        self.stats = stats
+        self.tuning = tuning
+        self.spool_memory = spool_memory
+
+    def buildProtocol(self, addr):
+        return SCGIProtocol(self)
+
+
+class _BorrowedUNIXPort(unix.Port):
+    # the socket's file belongs to whoever bound it, so unlike
+    # twisted's own UNIX ports this leaves it be on the way out
+
+    def connectionLost(self, reason):
+        tcp.Port.connectionLost(self, reason)
+
+
+def adopt_port(reactor, fd, family, factory):
+    if family == socket.AF_UNIX:
+        port = _BorrowedUNIXPort._fromListeningDescriptor(
+            reactor, fd, factory)
+        port.startListening()
+        return port
+    return reactor.adoptStreamPort(fd, family, factory)
+
+
+def drain(reactor, ports, stats, interval=DRAIN_INTERVAL):
+    # stops accepting, then waits until every request that's been read
+    # is answered and its connection closed, so the pool isn't stopped
+    # with requests still running
+    for port in ports:
+        port.stopListening()
+
+    def check():
+        if not stats.responding:
+            poll.stop()
+    poll = task.LoopingCall(check)
+    poll.clock = reactor
+    return poll.start(interval)
+
+
+def log_stats(stats):
+    t.RECEIVER_STATS(**stats.report()).write()
+
+
+def serve(processors, app, threads, spool_memory=DEFAULT_SPOOL_MEMORY,
+          stats_interval=DEFAULT_STATS_INTERVAL, reactor=None):
+    # serve processors' listening sockets from a reactor, calling app on
+    # a pool of threads
+    if reactor is None:
+        from twisted.internet import reactor
+    pool = ThreadPool(minthreads=1, maxthreads=threads,
+                      name='wip.evented')
+    stats = ReceiverStats()
+    ports = []
+    for processor in processors:
+        factory = SCGIFactory(reactor, app, pool, stats,
+                              tuning=processor.tuning,
+                              spool_memory=spool_memory)
+        # the reactor gets its own copy of the socket, which shares
+        # this one's blocking mode
+        processor.setblocking(False)
+        ports.append(adopt_port(reactor, processor.fileno(),
+                                processor.family, factory))
+        processor.close()
+    reactor.callWhenRunning(pool.start)
+    # SIGTERM, like SIGINT, lets the requests in hand finish
+    reactor.addSystemEventTrigger('before', 'shutdown',
+                                  drain, reactor, ports, stats)
+    reactor.addSystemEventTrigger('during', 'shutdown', pool.stop)
+    if stats_interval:
+        reporter = task.LoopingCall(log_stats, stats)
+        reporter.clock = reactor
+        reactor.callWhenRunning(reporter.start, stats_interval, now=False)
+    reactor.run()
@@ -0,0 +1,245 @@
+import os
+import socket
+import threading
+
+from eliot.testing import LoggedAction
+from twisted.internet.selectreactor import SelectReactor
+from twisted.internet.task import Clock
+from twisted.internet.testing import StringTransport
+import pytest
+
+from wip import evented, types
+from wip.client import encode_scgi_headers, request_environ
+
+
+class ImmediateReactor(object):
+    # runs whatever a pool thread asks of the reactor straight away
+
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+class ImmediatePool(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def callInThread(self, f, *args, **kwargs):
+        self.calls.append((f, args, kwargs))
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        for f, args, kwargs in calls:
+            f(*args, **kwargs)
+
+
+def request(method, uri, body=b''):
+    return encode_scgi_headers(
+        request_environ(method, uri, body=body)) + body
+
+
+@pytest.fixture
+def connection():
+    seen = []
+
+    def app(environ, start_response):
+        seen.append((environ, environ['wsgi.input'].read()))
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'hello']
+
+    pool = ImmediatePool()
+    factory = evented.SCGIFactory(ImmediateReactor(), app, pool,
+                                  evented.ReceiverStats(), spool_memory=4)
+    proto = factory.buildProtocol(None)
+    transport = StringTransport()
+    proto.makeConnection(transport)
+    return proto, transport, pool, factory.stats, seen
+
+
+def test_request_arriving_piecemeal(capture_logging, connection):
+    proto, transport, pool, stats, seen = connection
+    data = request('POST', '/thing?x=1', b'the body')
+    with capture_logging() as logger:
+        for i in range(len(data)):
+            proto.dataReceived(data[i:i + 1])
+        # the app only runs once the whole body's arrived
+        assert not seen
+        assert stats.report()['queued'] == 1
+        pool.run()
+    [(environ, body)] = seen
+    assert body == b'the body'
+    assert environ['PATH_INFO'] == '/thing'
+    assert environ['wsgi.multithread']
+    assert transport.value() == (b'Status: 200 OK\r\n'
+                                 b'Content-Type: text/plain\r\n\r\nhello')
+    assert transport.disconnecting
+    assert transport.producer is None
+    assert stats.report() == {'connections': 1, 'queued': 0, 'active': 0,
+                              'requests': 1}
+    [action] = LoggedAction.ofType(logger.messages, types.SCGI_REQUEST)
+    assert action.succeeded
+
+
+def test_anything_after_the_body_is_ignored(capture_logging, connection):
+    proto, transport, pool, stats, seen = connection
+    with capture_logging():
+        proto.dataReceived(request('POST', '/', b'body') + b'extra')
+        proto.dataReceived(b'more')
+        pool.run()
+    assert seen[0][1] == b'body'
+
+
+@pytest.mark.parametrize('data', [b'12345678', b'x:', b'3:abc,',
+                                  b'9999999:CONTENT_LENGTH'])
+def test_bad_requests_are_aborted(capture_logging, connection, data):
+    proto, transport, pool, stats, seen = connection
+    with capture_logging() as logger:
+        proto.dataReceived(data)
+        if data == b'3:abc,':
+            logger.flushTracebacks(RuntimeError)
+    assert transport.disconnecting
+    assert not pool.calls
+
+
+def test_hangup_stops_a_streaming_response(capture_logging):
+    closed = []
+
+    class Endless(object):
+        def __iter__(self):
+            while True:
+                yield b'x'
+
+        def close(self):
+            closed.append(True)
+
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        return Endless()
+
+    pool = ImmediatePool()
+    factory = evented.SCGIFactory(ImmediateReactor(), app, pool,
+                                  evented.ReceiverStats())
+    proto = factory.buildProtocol(None)
+    transport = StringTransport()
+    proto.makeConnection(transport)
+    with capture_logging() as logger:
+        proto.dataReceived(request('GET', '/'))
+        # the transport's full; then the client goes
+        transport.producer.pauseProducing()
+        proto.connectionLost(None)
+        pool.run()
+    assert closed == [True]
+    assert factory.stats.report()['connections'] == 0
+    assert [message for message in logger.messages
+            if message.get('message_type') == 'wip:client_gone']
+
+
+class QueuedReactor(object):
+    # runs what a pool thread asks of it only when told to
+
+    def __init__(self):
+        self.calls = []
+
+    def callFromThread(self, f, *args, **kwargs):
+        self.calls.append((f, args, kwargs))
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        for f, args, kwargs in calls:
+            f(*args, **kwargs)
+
+
+def test_writes_wait_for_the_transport():
+    reactor = QueuedReactor()
+    transport = StringTransport()
+    writer = evented._TransportWriter(reactor, transport)
+    transport.registerProducer(writer, True)
+    writer.write(b'one')
+    second = threading.Thread(target=writer.write, args=(memoryview(b'two'),))
+    second.daemon = True
+    second.start()
+    # one write at a time is on its way to the reactor
+    second.join(0.1)
+    assert second.is_alive()
+    assert len(reactor.calls) == 1
+    # and the transport fills up taking it
+    writer.pauseProducing()
+    reactor.run()
+    second.join(0.1)
+    assert second.is_alive()
+    writer.resumeProducing()
+    second.join(5)
+    assert not second.is_alive()
+    reactor.run()
+    assert transport.value() == b'onetwo'
+
+
+def test_writes_after_a_hangup_are_dropped():
+    reactor = QueuedReactor()
+    transport = StringTransport()
+    writer = evented._TransportWriter(reactor, transport)
+    writer.write(b'one')
+    writer.stopProducing()
+    writer.write(b'two')
+    reactor.run()
+    assert transport.value() == b''
+    assert writer.lost
+
+
+def test_stats_are_logged(capture_logging):
+    stats = evented.ReceiverStats()
+    stats.connected()
+    stats.dispatched()
+    with capture_logging() as logger:
+        evented.log_stats(stats)
+    [message] = logger.messages
+    assert message['message_type'] == 'wip:receiver_stats'
+    assert (message['connections'], message['queued']) == (1, 1)
+
+
+class FakePort(object):
+
+    def __init__(self):
+        self.listening = True
+
+    def stopListening(self):
+        self.listening = False
+
+
+def test_drain_waits_for_responses(capture_logging, connection):
+    proto, transport, pool, stats, seen = connection
+    proto.dataReceived(request('GET', '/'))
+    assert stats.responding == 1
+    clock = Clock()
+    port = FakePort()
+    drained = evented.drain(clock, [port], stats, interval=1)
+    assert not port.listening
+    clock.advance(1)
+    assert not drained.called
+    pool.run()
+    # the response is written, but the connection's still open
+    clock.advance(1)
+    assert not drained.called
+    proto.connectionLost(None)
+    assert stats.responding == 0
+    clock.advance(1)
+    assert drained.called
+
+
+def test_adopted_unix_socket_file_is_left_alone(tmpdir):
+    path = str(tmpdir.join('server.sock'))
+    sock = socket.socket(socket.AF_UNIX)
+    sock.bind(path)
+    sock.listen(5)
+    sock.setblocking(False)
+    reactor = SelectReactor()
+    try:
+        port = evented.adopt_port(reactor, sock.fileno(), socket.AF_UNIX,
+                                  evented.SCGIFactory(None, None, None,
+                                                      None))
+        stopped = port.stopListening()
+        while not stopped.called:
+            reactor.iterate(0)
+    finally:
+        sock.close()
+    assert os.path.exists(path)
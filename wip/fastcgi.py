@@ -0,0 +1,341 @@
+import io
+import select
+import struct
+import threading
+
+from wip.lazy import types as t
+from wip.common import headers_to_native_strings
+from wip.receiver import MalformedHeaders, WSGIRequestProcessor, cgi_headers
+
+
+FCGI_VERSION_1 = 1
+
+FCGI_BEGIN_REQUEST = 1
+FCGI_ABORT_REQUEST = 2
+FCGI_END_REQUEST = 3
+FCGI_PARAMS = 4
+FCGI_STDIN = 5
+FCGI_STDOUT = 6
+FCGI_STDERR = 7
+FCGI_DATA = 8
+FCGI_GET_VALUES = 9
+FCGI_GET_VALUES_RESULT = 10
+FCGI_UNKNOWN_TYPE = 11
+
+FCGI_RESPONDER = 1
+FCGI_KEEP_CONN = 1
+
+FCGI_REQUEST_COMPLETE = 0
+FCGI_UNKNOWN_ROLE = 3
+
+MAX_CONTENT_LENGTH = 0xffff
+
+# how long a kept connection may sit with no request on it before it's
+# closed, so the receiver can accept the web server's other connections
+IDLE_TIMEOUT = 1.0
+
+_HEADER = struct.Struct('!BBHHBx')
+_BEGIN_REQUEST_BODY = struct.Struct('!HB5x')
+_END_REQUEST_BODY = struct.Struct('!IB3x')
+_UNKNOWN_TYPE_BODY = struct.Struct('!B7x')
+_LONG_LENGTH = struct.Struct('!I')
+
+
+def read_record(f):
+    header = f.read(_HEADER.size)
+    if not header:
+        return None
+    if len(header) != _HEADER.size:
+        raise MalformedHeaders('the connection ended in a record header')
+    version, record_type, request_id, content_length, padding_length = (
+        _HEADER.unpack(header))
+    if version != FCGI_VERSION_1:
+        raise MalformedHeaders('version must be %d, not %d'
+                               % (FCGI_VERSION_1, version))
+    content = f.read(content_length + padding_length)
+    if len(content) != content_length + padding_length:
+        raise MalformedHeaders('a record ended %d bytes short' % (
+            content_length + padding_length - len(content),))
+    return record_type, request_id, content[:content_length]
+
+
+def encode_record(record_type, request_id, content=b''):
+    # pad to a multiple of 8, as the specification recommends
+    padding = -len(content) % 8
+    return b''.join([
+        _HEADER.pack(FCGI_VERSION_1, record_type, request_id,
+                     len(content), padding),
+        content,
+        b'\0' * padding])
+
+
+def _read_length(data, offset):
+    length = bytearray(data[offset:offset + 1])
+    if not length:
+        raise MalformedHeaders('a name-value pair is missing a length')
+    if length[0] < 0x80:
+        return length[0], offset + 1
+    if offset + _LONG_LENGTH.size > len(data):
+        raise MalformedHeaders('a four byte length runs past the record')
+    length, = _LONG_LENGTH.unpack_from(data, offset)
+    return length & 0x7fffffff, offset + _LONG_LENGTH.size
+
+
+def decode_pairs(data):
+    pairs = []
+    offset = 0
+    while offset < len(data):
+        name_length, offset = _read_length(data, offset)
+        value_length, offset = _read_length(data, offset)
+        end = offset + name_length + value_length
+        if end > len(data):
+            raise MalformedHeaders('a name-value pair runs past the record')
+        pairs.append(data[offset:offset + name_length])
+        pairs.append(data[offset + name_length:end])
+        offset = end
+    return pairs
+
+
+def _encode_length(length):
+    if length < 0x80:
+        return struct.pack('!B', length)
+    return _LONG_LENGTH.pack(length | 0x80000000)
+
+
+def encode_pairs(pairs):
+    return b''.join(_encode_length(len(name)) + _encode_length(len(value)) +
+                    name + value
+                    for name, value in pairs)
+
+
+class _SocketReader(object):
+    # a buffered reader over a socket that, unlike a makefile, can be
+    # asked whether anything arrives within a timeout
+
+    def __init__(self, sock, size=65536):
+        self._sock = sock
+        self._size = size
+        self._buffer = bytearray()
+
+    def read(self, size):
+        while len(self._buffer) < size:
+            data = self._sock.recv(max(size - len(self._buffer), self._size))
+            if not data:
+                break
+            self._buffer += data
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def wait(self, timeout):
+        if self._buffer:
+            return True
+        readable, _, _ = select.select([self._sock], [], [], timeout)
+        return bool(readable)
+
+
+class _RecordWriter(object):
+
+    def __init__(self, connection, request_id, record_type=FCGI_STDOUT):
+        self._connection = connection
+        self._request_id = request_id
+        self._record_type = record_type
+
+    def write(self, data):
+        data = memoryview(data)
+        for start in range(0, len(data), MAX_CONTENT_LENGTH):
+            self._connection.write_record(
+                self._record_type, self._request_id,
+                data[start:start + MAX_CONTENT_LENGTH].tobytes())
+
+    def flush(self):
+        pass
+
+
+class FastCGIRequest(WSGIRequestProcessor):
+    multithread = True
+
+    def __init__(self, connection, request_id, keep_conn):
+        super(FastCGIRequest, self).__init__(
+            io.BytesIO(), _RecordWriter(connection, request_id))
+        self.request_id = request_id
+        self.keep_conn = keep_conn
+        self.dispatched = False
+        self.aborted = False
+        self._params = []
+
+    def add_params(self, data):
+        self._params.append(data)
+
+    def add_stdin(self, data):
+        self._instream.write(data)
+
+    def _determine_environment(self):
+        headers = headers_to_native_strings(
+            decode_pairs(b''.join(self._params)))
+        self._params = None
+        environ = dict(zip(*[iter(headers)] * 2))
+        self._instream.seek(0)
+        return self._populate_environment(environ, self._instream)
+
+    def _format_headers(self, status, response_headers):
+        return cgi_headers(status, response_headers)
+
+    def _write(self, data):
+        if not self.aborted:
+            super(FastCGIRequest, self)._write(data)
+
+    def _client_gone(self):
+        # the web server sends FCGI_ABORT_REQUEST when its client goes
+        return self.aborted
+
+
+class FastCGIRequestProcessor(object):
+    # a record layer over one persistent, possibly multiplexed,
+    # connection.  requests are read here and run on the pool.
+
+    @classmethod
+    def from_sock(cls, sock, pool, max_requests=None,
+                  idle_timeout=IDLE_TIMEOUT):
+        return cls(_SocketReader(sock), sock.makefile('wb'), pool,
+                   max_requests, idle_timeout)
+
+    def __init__(self, instream, outstream, pool, max_requests=None,
+                 idle_timeout=None):
+        self._instream = instream
+        self._outstream = outstream
+        self._pool = pool
+        self._max_requests = max_requests
+        # needs an instream with wait()
+        self._idle_timeout = idle_timeout
+        self._write_lock = threading.Lock()
+        self._pending = threading.Condition()
+        self._requests = {}
+        self._running = 0
+
+    def write_record(self, record_type, request_id, content=b''):
+        record = encode_record(record_type, request_id, content)
+        with self._write_lock:
+            self._outstream.write(record)
+            self._outstream.flush()
+
+    def _end_request(self, request_id, app_status,
+                     protocol_status=FCGI_REQUEST_COMPLETE):
+        body = _END_REQUEST_BODY.pack(app_status, protocol_status)
+        record = b''.join([
+            encode_record(FCGI_STDOUT, request_id),
+            encode_record(FCGI_END_REQUEST, request_id, body)])
+        with self._write_lock:
+            self._outstream.write(record)
+            self._outstream.flush()
+
+    def _get_values(self, content):
+        values = {b'FCGI_MPXS_CONNS': b'1'}
+        if self._max_requests is not None:
+            values[b'FCGI_MAX_REQS'] = str(self._max_requests).encode()
+            values[b'FCGI_MAX_CONNS'] = values[b'FCGI_MAX_REQS']
+        names = decode_pairs(content)[::2]
+        self.write_record(
+            FCGI_GET_VALUES_RESULT, 0,
+            encode_pairs((name, values[name])
+                         for name in names if name in values))
+
+    def _run(self, app, request):
+        app_status = 0
+        try:
+            with t.FASTCGI_REQUEST(request_id=request.request_id):
+                request.run_app(app)
+        except Exception:
+            # already logged by the failed action
+            app_status = 1
+        finally:
+            try:
+                self._end_request(request.request_id, app_status)
+            finally:
+                with self._pending:
+                    del self._requests[request.request_id]
+                    self._running -= 1
+                    self._pending.notify_all()
+
+    def _dispatch(self, app, request):
+        with self._pending:
+            request.dispatched = True
+            self._running += 1
+        self._pool.apply_async(self._run, (app, request))
+
+    def _wait(self):
+        with self._pending:
+            while self._running:
+                self._pending.wait()
+
+    def _handle_record(self, app, record_type, request_id, content):
+        if record_type == FCGI_GET_VALUES:
+            self._get_values(content)
+            return True
+        if not request_id:
+            self.write_record(FCGI_UNKNOWN_TYPE, 0,
+                              _UNKNOWN_TYPE_BODY.pack(record_type))
+            return True
+
+        if record_type == FCGI_BEGIN_REQUEST:
+            if len(content) != _BEGIN_REQUEST_BODY.size:
+                raise MalformedHeaders('FCGI_BEGIN_REQUEST bodies are %d '
+                                       'bytes, not %d'
+                                       % (_BEGIN_REQUEST_BODY.size,
+                                          len(content)))
+            role, flags = _BEGIN_REQUEST_BODY.unpack(content)
+            if role != FCGI_RESPONDER:
+                self._end_request(request_id, 0, FCGI_UNKNOWN_ROLE)
+                return True
+            with self._pending:
+                self._requests[request_id] = FastCGIRequest(
+                    self, request_id, bool(flags & FCGI_KEEP_CONN))
+            return True
+
+        with self._pending:
+            request = self._requests.get(request_id)
+        if request is None or request.dispatched:
+            if request is not None and record_type == FCGI_ABORT_REQUEST:
+                # the response is discarded; _run still ends it
+                request.aborted = True
+            return True
+
+        if record_type == FCGI_ABORT_REQUEST:
+            with self._pending:
+                del self._requests[request_id]
+            self._end_request(request_id, 0)
+            return request.keep_conn
+        if record_type == FCGI_PARAMS:
+            request.add_params(content)
+        elif record_type == FCGI_STDIN:
+            if content:
+                request.add_stdin(content)
+            else:
+                self._dispatch(app, request)
+                # without FCGI_KEEP_CONN the connection closes once
+                # this request is answered
+                return request.keep_conn
+        return True
+
+    def _went_idle(self):
+        # whether the connection has had no requests in flight and
+        # nothing to read for the idle timeout
+        while not self._instream.wait(self._idle_timeout):
+            with self._pending:
+                if not self._requests:
+                    return True
+        return False
+
+    def run_app(self, app):
+        try:
+            while True:
+                if self._idle_timeout is not None and self._went_idle():
+                    t.FASTCGI_IDLE().write()
+                    break
+                record = read_record(self._instream)
+                if record is None:
+                    break
+                if not self._handle_record(app, *record):
+                    break
+        finally:
+            self._wait()
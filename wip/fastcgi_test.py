@@ -0,0 +1,300 @@
+import functools
+import io
+import socket
+import struct
+import threading
+from multiprocessing.pool import ThreadPool
+
+from eliot.testing import LoggedAction, LoggedMessage
+import pytest
+
+from wip import fastcgi, receiver, types
+
+
+@pytest.mark.parametrize('pairs', [
+    [],
+    [(b'SCGI', b'1')],
+    [(b'X' * 200, b''), (b'REQUEST_URI', b'/' * 70000)],
+])
+def test_pairs_round_trip(pairs):
+    flat = [item for pair in pairs for item in pair]
+    assert fastcgi.decode_pairs(fastcgi.encode_pairs(pairs)) == flat
+
+
+@pytest.mark.parametrize('bad_pairs', [
+    b'\x05',
+    b'\x05\x01abc',
+    b'\x80\x00',
+])
+def test_decode_pairs_fails(bad_pairs):
+    with pytest.raises(receiver.MalformedHeaders):
+        fastcgi.decode_pairs(bad_pairs)
+
+
+def test_record_round_trip():
+    record = fastcgi.encode_record(fastcgi.FCGI_STDIN, 3, b'hello')
+    assert len(record) % 8 == 0
+    assert fastcgi.read_record(io.BytesIO(record)) == (
+        fastcgi.FCGI_STDIN, 3, b'hello')
+
+
+@pytest.mark.parametrize('bad_record', [
+    b'\x01\x05',
+    b'\x02\x05\x00\x01\x00\x00\x00\x00',
+    b'\x01\x05\x00\x01\x00\x05\x00\x00abc',
+])
+def test_read_record_fails(bad_record):
+    with pytest.raises(receiver.MalformedHeaders):
+        fastcgi.read_record(io.BytesIO(bad_record))
+
+
+def begin(request_id, keep_conn=True, role=fastcgi.FCGI_RESPONDER):
+    flags = fastcgi.FCGI_KEEP_CONN if keep_conn else 0
+    return fastcgi.encode_record(
+        fastcgi.FCGI_BEGIN_REQUEST, request_id,
+        struct.pack('!HB5x', role, flags))
+
+
+def params(request_id, path):
+    return b''.join([
+        fastcgi.encode_record(
+            fastcgi.FCGI_PARAMS, request_id,
+            fastcgi.encode_pairs([(b'REQUEST_URI', path),
+                                  (b'CONTENT_LENGTH', b'5')])),
+        fastcgi.encode_record(fastcgi.FCGI_PARAMS, request_id)])
+
+
+def stdin(request_id, body):
+    return b''.join([
+        fastcgi.encode_record(fastcgi.FCGI_STDIN, request_id, body),
+        fastcgi.encode_record(fastcgi.FCGI_STDIN, request_id)])
+
+
+def responses(outstream):
+    outstream.seek(0)
+    stdout, ended = {}, {}
+    while True:
+        record = fastcgi.read_record(outstream)
+        if record is None:
+            return stdout, ended
+        record_type, request_id, content = record
+        if record_type == fastcgi.FCGI_STDOUT:
+            stdout[request_id] = stdout.get(request_id, b'') + content
+        elif record_type == fastcgi.FCGI_END_REQUEST:
+            ended[request_id] = struct.unpack('!IB3x', content)
+
+
+@pytest.fixture
+def pool():
+    pool = ThreadPool(2)
+    yield pool
+    pool.terminate()
+
+
+def test_multiplexed_requests(capture_logging, pool):
+    both_running = threading.Barrier(2, timeout=5)
+
+    def echo(environ, start_response):
+        assert environ['wsgi.multithread']
+        both_running.wait()
+        start_response('200 OK', [('X-Path', environ['PATH_INFO'])])
+        return [environ['wsgi.input'].read()]
+
+    # the two requests' records are interleaved on one connection
+    instream = io.BytesIO(b''.join([
+        begin(1), begin(2),
+        params(1, b'/one'), params(2, b'/two'),
+        stdin(2, b'world'), stdin(1, b'hello')]))
+    outstream = io.BytesIO()
+    processor = fastcgi.FastCGIRequestProcessor(instream, outstream, pool)
+
+    with capture_logging() as logger:
+        processor.run_app(echo)
+
+    stdout, ended = responses(outstream)
+    assert stdout == {
+        1: b'Status: 200 OK\r\nX-Path: /one\r\n\r\nhello',
+        2: b'Status: 200 OK\r\nX-Path: /two\r\n\r\nworld'}
+    assert ended == {1: (0, fastcgi.FCGI_REQUEST_COMPLETE),
+                     2: (0, fastcgi.FCGI_REQUEST_COMPLETE)}
+
+    actions = LoggedAction.ofType(logger.messages, types.FASTCGI_REQUEST)
+    assert len(actions) == 2 and all(a.succeeded for a in actions)
+
+
+def test_closes_without_keep_conn(capture_logging, pool):
+    def hello(environ, start_response):
+        start_response('200 OK', [])
+        return [b'hi']
+
+    instream = io.BytesIO(b''.join([
+        begin(1, keep_conn=False), params(1, b'/'), stdin(1, b'hello'),
+        b'never read']))
+    outstream = io.BytesIO()
+    processor = fastcgi.FastCGIRequestProcessor(instream, outstream, pool)
+
+    with capture_logging():
+        processor.run_app(hello)
+
+    assert instream.read() == b'never read'
+    assert responses(outstream)[1] == {1: (0, 0)}
+
+
+def test_failing_app_and_unknown_role(capture_logging, pool):
+    def fails(environ, start_response):
+        raise ValueError()
+
+    instream = io.BytesIO(b''.join([
+        begin(1), params(1, b'/'), stdin(1, b'hello'),
+        begin(2, role=2)]))
+    outstream = io.BytesIO()
+    processor = fastcgi.FastCGIRequestProcessor(instream, outstream, pool)
+
+    with capture_logging() as logger:
+        processor.run_app(fails)
+        logger.flush_tracebacks(ValueError)
+
+    assert responses(outstream)[1] == {
+        1: (1, fastcgi.FCGI_REQUEST_COMPLETE),
+        2: (0, fastcgi.FCGI_UNKNOWN_ROLE)}
+
+
+def test_abort_before_dispatch(pool):
+    instream = io.BytesIO(b''.join([
+        begin(1), params(1, b'/'),
+        fastcgi.encode_record(fastcgi.FCGI_ABORT_REQUEST, 1)]))
+    outstream = io.BytesIO()
+    processor = fastcgi.FastCGIRequestProcessor(instream, outstream, pool)
+
+    processor.run_app(None)
+
+    assert responses(outstream) == ({1: b''}, {1: (0, 0)})
+
+
+def test_get_values(pool):
+    query = fastcgi.encode_pairs([(b'FCGI_MPXS_CONNS', b''),
+                                  (b'FCGI_MAX_REQS', b''),
+                                  (b'UNKNOWN', b'')])
+    instream = io.BytesIO(
+        fastcgi.encode_record(fastcgi.FCGI_GET_VALUES, 0, query))
+    outstream = io.BytesIO()
+    processor = fastcgi.FastCGIRequestProcessor(instream, outstream, pool,
+                                                max_requests=2)
+
+    processor.run_app(None)
+
+    outstream.seek(0)
+    record_type, _, content = fastcgi.read_record(outstream)
+    assert record_type == fastcgi.FCGI_GET_VALUES_RESULT
+    assert fastcgi.decode_pairs(content) == [b'FCGI_MPXS_CONNS', b'1',
+                                             b'FCGI_MAX_REQS', b'2']
+
+
+@pytest.mark.parametrize('body', [b'', b'\x00\x01', b'\x00' * 9])
+def test_short_begin_request_fails(pool, body):
+    instream = io.BytesIO(
+        fastcgi.encode_record(fastcgi.FCGI_BEGIN_REQUEST, 1, body))
+    processor = fastcgi.FastCGIRequestProcessor(instream, io.BytesIO(), pool)
+    with pytest.raises(receiver.MalformedHeaders):
+        processor.run_app(None)
+
+
+def test_socket_reader():
+    server, client = socket.socketpair()
+    try:
+        reader = fastcgi._SocketReader(server, size=4)
+        assert not reader.wait(0)
+        client.sendall(b'abcdefgh')
+        assert reader.wait(1)
+        assert reader.read(3) == b'abc'
+        # the rest is already buffered
+        assert reader.wait(0)
+        client.close()
+        assert reader.read(10) == b'defgh'
+        assert reader.read(1) == b''
+    finally:
+        server.close()
+        client.close()
+
+
+def test_idle_kept_connection_makes_way(capture_logging, pool):
+    def hello(environ, start_response):
+        start_response('200 OK', [])
+        return [environ['wsgi.input'].read()]
+
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(2)
+    processor = receiver.SocketPassProcessor(
+        listener,
+        request_processor=functools.partial(
+            fastcgi.FastCGIRequestProcessor.from_sock,
+            pool=pool, idle_timeout=0.1))
+    # two connections kept open, as a web server's pool of them is; the
+    # first can't hold on to the receiver once it has nothing to do
+    clients = [socket.create_connection(listener.getsockname())
+               for _ in range(2)]
+    with capture_logging() as logger:
+        serving = threading.Thread(
+            target=lambda: [processor.handle_request(hello) for _ in clients])
+        serving.daemon = True
+        serving.start()
+        try:
+            for client, body in zip(clients, [b'first', b'other']):
+                client.settimeout(5)
+                client.sendall(begin(1) + params(1, b'/') + stdin(1, body))
+                answer = client.makefile('rb')
+                stdout = b''
+                while True:
+                    record_type, _, content = fastcgi.read_record(answer)
+                    if record_type == fastcgi.FCGI_END_REQUEST:
+                        break
+                    stdout += content
+                assert stdout.endswith(body)
+            serving.join(5)
+            assert not serving.is_alive()
+        finally:
+            for client in clients:
+                client.close()
+            listener.close()
+    assert len(LoggedMessage.ofType(logger.messages, types.FASTCGI_IDLE)) == 2
+
+
+def test_truncated_record_drops_only_its_connection(capture_logging, pool):
+    def hello(environ, start_response):
+        start_response('200 OK', [])
+        return [environ['wsgi.input'].read()]
+
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(2)
+    processor = receiver.SocketPassProcessor(
+        listener,
+        request_processor=functools.partial(
+            fastcgi.FastCGIRequestProcessor.from_sock, pool=pool))
+    clients = [socket.create_connection(listener.getsockname())
+               for _ in range(2)]
+    try:
+        # a request, then the web server goes away part way through the
+        # next record
+        truncated = fastcgi.encode_record(fastcgi.FCGI_STDIN, 2, b'x' * 16)
+        clients[0].sendall(begin(1) + params(1, b'/') + stdin(1, b'first') +
+                           truncated[:12])
+        clients[0].shutdown(socket.SHUT_WR)
+        clients[1].sendall(begin(1) + params(1, b'/') + stdin(1, b'other'))
+        clients[1].shutdown(socket.SHUT_WR)
+        with capture_logging() as logger:
+            processor.handle_request(hello)
+            processor.handle_request(hello)
+        for client, body in zip(clients, [b'first', b'other']):
+            client.settimeout(5)
+            stdout, ended = responses(io.BytesIO(client.makefile('rb').read()))
+            assert stdout[1].endswith(body)
+            assert ended == {1: (0, fastcgi.FCGI_REQUEST_COMPLETE)}
+    finally:
+        for client in clients:
+            client.close()
+        listener.close()
+    [message] = [message for message in logger.messages
+                 if message.get('message_type') == 'wip:malformed_headers']
+    assert 'short' in message['reason']
@@ -0,0 +1,87 @@
+import os
+import socket
+import sys
+
+import pytest
+
+from wip.functional_test.conftest import (subprocess_context,
+                                          wait_until_accessible_or_death)
+
+
+# set the variables in the shell so LISTEN_PID is the pid that execs
+# the real program, the way systemd does it
+ACTIVATE = ['/bin/sh', '-c',
+            'LISTEN_PID=$$ LISTEN_FDS=1 LISTEN_FDNAMES=web exec "$@"',
+            'activate']
+
+
+def http_get(address):
+    sock = socket.create_connection(address, timeout=10)
+    try:
+        sock.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        chunks = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    return b''.join(chunks)
+
+
+@pytest.fixture
+def activation_dir(request, workdir):
+    return workdir.mkdir(request.node.name)
+
+
+@pytest.fixture
+def activated_socket():
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(50)
+    yield sock
+    sock.close()
+
+
+def activated(args, sock, log_file, cwd):
+    # what systemd does: the socket arrives as descriptor 3
+    def move_to_3():
+        os.dup2(sock.fileno(), 3)
+    return subprocess_context(ACTIVATE + args, log_file, cwd=cwd,
+                              preexec_fn=move_to_3, pass_fds=(3,))
+
+
+def test_receiver_adopts_activated_socket(activation_dir, activated_socket):
+    receiver_args = [sys.executable, '-m', 'wip.receiver',
+                     '--protocol', 'http', '--listener', 'web']
+    cwd = str(activation_dir)
+    address = activated_socket.getsockname()
+    with activation_dir.join('receiver.log').open('w') as receiver_log:
+        # the socket outlives each receiver, so nothing is refused
+        # across a restart
+        for _ in range(2):
+            with activated(receiver_args, activated_socket,
+                           receiver_log, cwd):
+                assert http_get(address).startswith(b'HTTP/1.1 200 OK\r\n')
+
+
+def test_handoff_adopts_activated_socket(activation_dir, activated_socket):
+    handoff_path = activation_dir.join('handoff.sock')
+    handoff_args = [sys.executable, '-m', 'wip.handoff',
+                    'systemd:web', 'unix:{}'.format(handoff_path.basename)]
+    receiver_args = [sys.executable, '-m', 'wip.receiver',
+                     '--protocol', 'http', handoff_path.basename]
+    cwd = str(activation_dir)
+    address = activated_socket.getsockname()
+    with activation_dir.join('handoff.log').open('w') as handoff_log, \
+            activation_dir.join('receiver.log').open('w') as receiver_log:
+        for _ in range(2):
+            with activated(handoff_args, activated_socket,
+                           handoff_log, cwd) as proc:
+                wait_until_accessible_or_death(proc, handoff_path)
+                with subprocess_context(receiver_args, receiver_log,
+                                        cwd=cwd):
+                    assert http_get(address).startswith(
+                        b'HTTP/1.1 200 OK\r\n')
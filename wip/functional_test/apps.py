@@ -0,0 +1,108 @@
+import os
+import threading
+import time
+
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+
+
+# how many /stream responses have been closed, so tests can tell the
+# receiver cleaned up after a client that went away
+CLOSED = []
+_closed_lock = threading.Lock()
+
+CHUNK = 64 * 1024
+
+
+def _query(environ, name, default):
+    values = parse_qs(environ.get('QUERY_STRING', '')).get(name)
+    return int(values[0]) if values else default
+
+
+def echo(environ, start_response):
+    body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+    start_response('200 OK', [('Content-Type', 'application/octet-stream'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def large(environ, start_response):
+    size = _query(environ, 'size', 1024 * 1024)
+    start_response('200 OK', [('Content-Type', 'application/octet-stream'),
+                              ('Content-Length', str(size))])
+    pattern = bytearray(range(256)) * (CHUNK // 256)
+
+    def chunks():
+        remaining = size
+        while remaining:
+            chunk = bytes(pattern[:min(remaining, CHUNK)])
+            remaining -= len(chunk)
+            yield chunk
+    return chunks()
+
+
+class _Endless(object):
+
+    def __iter__(self):
+        while True:
+            yield b'x' * 4096
+
+    def close(self):
+        with _closed_lock:
+            CLOSED.append(True)
+
+
+def stream(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'application/octet-stream')])
+    return _Endless()
+
+
+def closed(environ, start_response):
+    body = str(len(CLOSED)).encode('ascii')
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def pid(environ, start_response):
+    # which receiver answered
+    body = str(os.getpid()).encode('ascii')
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def slow(environ, start_response):
+    # half now and half after a pause, so a test can act mid-response
+    pause = _query(environ, 'ms', 500) / 1000.0
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', '22')])
+
+    def halves():
+        yield b'the first half, '
+        time.sleep(pause)
+        yield b'then..'
+    return halves()
+
+
+def hello(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', '5')])
+    return [b'hello']
+
+
+ROUTES = {
+    '/echo': echo,
+    '/large': large,
+    '/stream': stream,
+    '/closed': closed,
+    '/pid': pid,
+    '/slow': slow,
+}
+
+
+def app(environ, start_response):
+    route = ROUTES.get(environ.get('PATH_INFO'), hello)
+    return route(environ, start_response)
@@ -1,15 +1,16 @@
 import errno
 import os
+import socket
 import stat
 import subprocess
 import sys
 import time
 import urllib
-from contextlib import contextmanager
+from contextlib import ExitStack, contextmanager
 
 import pytest
-import pkg_resources
-import requests_unixsocket
+
+from wip.client import SCGIClient
 
 
 @contextmanager
@@ -46,12 +47,90 @@ def wait_until_accessible_or_death(proc, path, retries=25, delay=0.125):
 
 
 @pytest.fixture(scope='session')
-def workdir(request, tmpdir_factory):
-    if not request.config.getoption('--runfunctional'):
-        pytest.skip('skipping functional tests')
+def workdir(tmpdir_factory):
     return tmpdir_factory.mktemp('workdir')
 
 
+@pytest.fixture(scope='session')
+def needs_nginx(request):
+    # everything else here stands in for the web server itself, but
+    # these need nginx and requests_unixsocket
+    if not request.config.getoption('--runfunctional'):
+        pytest.skip('skipping functional tests that need nginx')
+
+
+def wait_until_serving(proc, client, retries=40, delay=0.125):
+    # connections wait in the daemon's listen backlog until a receiver
+    # takes one, so this returns once the first receiver's up; a timeout
+    # or a receiver dying before it answers means trying again
+    for ign in range(retries):
+        try:
+            if client.get('/').status_code == 200:
+                return
+        except (socket.error, RuntimeError):
+            pass
+        if proc.poll() is not None:
+            raise RuntimeError('process died waiting for a receiver')
+        time.sleep(delay)
+    raise RuntimeError('no receiver ever answered')
+
+
+def free_port():
+    skt = socket.socket()
+    try:
+        skt.bind(('127.0.0.1', 0))
+        return skt.getsockname()[1]
+    finally:
+        skt.close()
+
+
+@contextmanager
+def serving(directory, receivers=1, app='wip.functional_test.apps:app',
+            receiver_options=(), shards=None, placement=None,
+            handoff_options=()):
+    # a handoff daemon and receivers serving app, with an SCGI client
+    # standing in for the web server.  with shards, the server listens
+    # on a TCP port split into that many shards.  placement gives each
+    # receiver, by number, options of its own.
+    server_path = directory.join('server.sock')
+    handoff_path = directory.join('handoff.sock')
+    if shards is None:
+        server = 'unix:{}'.format(server_path.basename)
+    else:
+        port = free_port()
+        server = 'tcp:{}:interface=127.0.0.1:shards={}'.format(port, shards)
+    handoff_args = [
+        sys.executable, '-m', 'wip.handoff',
+    ] + list(handoff_options) + [
+        server,
+        'unix:{}'.format(handoff_path.basename),
+    ]
+    cwd = str(directory)
+    with directory.join('handoff.log').open('w') as handoff_log, \
+            directory.join('receiver.log').open('w') as receiver_log, \
+            subprocess_context(handoff_args, handoff_log, cwd=cwd) as proc:
+        if shards is None:
+            wait_until_accessible_or_death(proc, server_path)
+        wait_until_accessible_or_death(proc, handoff_path)
+        with ExitStack() as stack:
+            for index in range(receivers):
+                receiver_args = [
+                    sys.executable, '-m', 'wip.receiver', '--app', app,
+                ] + list(receiver_options)
+                if placement is not None:
+                    receiver_args.extend(placement(index))
+                receiver_args.append(handoff_path.basename)
+                stack.enter_context(
+                    subprocess_context(receiver_args, receiver_log, cwd=cwd))
+            if shards is None:
+                client = SCGIClient(str(server_path))
+            else:
+                client = SCGIClient(('127.0.0.1', port),
+                                    family=socket.AF_INET)
+            wait_until_serving(proc, client)
+            yield client
+
+
 # macOS is fussy about UNIX socket path lengths, so there's a bunch of relative
 # paths and symlinks used here because there's no other way to coax it into
 # listening/connecting.
@@ -68,7 +147,8 @@ def receiver_socket_path(workdir):
 
 
 @pytest.fixture(scope='session')
-def running_handoff(receiver_socket_path, handoff_socket_path, workdir):
+def running_handoff(needs_nginx, receiver_socket_path, handoff_socket_path,
+                    workdir):
     with workdir.join('handoff.log').open('w') as handoff_log:
         args = [
             sys.executable, '-m', 'wip.handoff',
@@ -106,6 +186,7 @@ def nginx_binary():
 def running_nginx(running_receiver, receiver_socket_path,
                   nginx_socket_path, nginx_binary,
                   workdir):
+    import pkg_resources
     nginx_conf = pkg_resources.resource_string(__name__, 'nginx.conf')
     workdir.join('nginx.conf').write(nginx_conf)
     with workdir.join('nginx.log').open('w') as nginx_log:
@@ -120,7 +201,8 @@ def running_nginx(running_receiver, receiver_socket_path,
 
 
 @pytest.fixture
-def session():
+def session(needs_nginx):
+    import requests_unixsocket
     return requests_unixsocket.Session()
 
 
@@ -0,0 +1,71 @@
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from wip.client import SCGIClient, encode_scgi_headers, request_environ
+from wip.functional_test.conftest import (serving, subprocess_context,
+                                          wait_until_accessible_or_death)
+
+
+def test_dispatched_receivers_share_connections(workdir):
+    with serving(workdir.mkdir('dispatch'), receivers=2,
+                 handoff_options=['--dispatch'],
+                 receiver_options=['--dispatched']) as client:
+        pids = set()
+        for _ in range(50):
+            response = client.get('/pid')
+            assert response.status_code == 200
+            pids.add(response.body)
+        response = client.post('/echo', b'x' * 100000)
+        assert response.body == b'x' * 100000
+    # whichever receiver's been ready longest gets the next connection
+    assert len(pids) == 2
+
+
+@contextmanager
+def dispatching_handoff(directory, *options):
+    args = [sys.executable, '-m', 'wip.handoff', '--dispatch'] + list(
+        options) + ['unix:server.sock', 'unix:handoff.sock']
+    with directory.join('handoff.log').open('w') as handoff_log, \
+            subprocess_context(args, handoff_log, cwd=str(directory)) as proc:
+        wait_until_accessible_or_death(proc, directory.join('server.sock'))
+        wait_until_accessible_or_death(proc, directory.join('handoff.sock'))
+        yield proc
+
+
+def test_connections_wait_for_a_receiver(workdir):
+    directory = workdir.mkdir('dispatch-waiting')
+    with dispatching_handoff(directory), \
+            directory.join('receiver.log').open('w') as receiver_log:
+        client = SCGIClient(str(directory.join('server.sock')))
+        responses = []
+        waiting = threading.Thread(
+            target=lambda: responses.append(client.get('/')))
+        waiting.start()
+        time.sleep(0.5)
+        assert not responses
+        receiver_args = [sys.executable, '-m', 'wip.receiver',
+                         '--dispatched', 'handoff.sock']
+        with subprocess_context(receiver_args, receiver_log,
+                                cwd=str(directory)):
+            waiting.join(10)
+            [response] = responses
+            assert response.status_code == 200
+
+
+def test_connections_wait_no_longer_than_max_wait(workdir):
+    directory = workdir.mkdir('dispatch-expiry')
+    with dispatching_handoff(directory, '--max-wait', '0.5'):
+        sock = SCGIClient(str(directory.join('server.sock'))).connect()
+        try:
+            sock.sendall(encode_scgi_headers(request_environ('GET', '/')))
+            started = time.time()
+            try:
+                assert sock.recv(1) == b''
+            except socket.error:
+                pass
+            assert 0.4 < time.time() - started < 5
+        finally:
+            sock.close()
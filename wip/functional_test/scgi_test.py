@@ -0,0 +1,177 @@
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+from wip.client import (encode_scgi_headers, read_response_head,
+                        request_environ)
+from wip.functional_test.conftest import serving
+
+
+LOOPS = {
+    'blocking': [],
+    'twisted': ['--twisted', '--threads', '4'],
+}
+
+
+@pytest.fixture(scope='module', params=sorted(LOOPS))
+def loop(request):
+    return request.param
+
+
+@pytest.fixture(scope='module')
+def client(loop, workdir):
+    with serving(workdir.mkdir('scgi-' + loop), receivers=2,
+                 receiver_options=LOOPS[loop]) as client:
+        yield client
+
+
+@pytest.fixture
+def lone_client(request, loop, workdir):
+    # one receiver, so every request sees the same application state
+    with serving(workdir.mkdir(request.node.name),
+                 receiver_options=LOOPS[loop]) as client:
+        yield client
+
+
+def expected_large(size):
+    pattern = bytes(bytearray(range(256)))
+    return (pattern * (size // 256 + 1))[:size]
+
+
+def test_basic_request(client):
+    response = client.get('/')
+    assert response.status_code == 200
+    assert response.header('Content-Type') == 'text/plain'
+    assert response.body == b'hello'
+
+
+def test_concurrent_clients(client):
+    bodies = []
+    errors = []
+
+    def post(i):
+        try:
+            for j in range(10):
+                body = ('%d-%d' % (i, j)).encode('ascii')
+                bodies.append((body, client.post('/echo', body).body))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=post, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert len(bodies) == 200
+    assert all(sent == received for sent, received in bodies)
+
+
+def test_large_request_body(client):
+    body = expected_large(4 * 1024 * 1024)
+    response = client.post('/echo', body)
+    assert response.header('Content-Length') == str(len(body))
+    assert response.body == body
+
+
+def test_large_response_body(client):
+    size = 8 * 1024 * 1024 + 17
+    response = client.get('/large?size=%d' % (size,))
+    assert response.body == expected_large(size)
+
+
+def test_slow_reader(client):
+    # the receiver has to wait on a full socket buffer rather than
+    # give up on the client
+    size = 2 * 1024 * 1024
+    sock = client.connect()
+    try:
+        client.send_request(sock, 'GET', '/large?size=%d' % (size,))
+        f = sock.makefile('rb')
+        status, _ = read_response_head(f)
+        assert status == '200 OK'
+        chunks = []
+        received = 0
+        while received < size:
+            chunk = f.read(256 * 1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            received += len(chunk)
+            time.sleep(0.02)
+        f.close()
+    finally:
+        sock.close()
+    assert b''.join(chunks) == expected_large(size)
+
+
+def test_mid_response_disconnect(lone_client):
+    before = int(lone_client.get('/closed').body)
+    sock = lone_client.connect()
+    try:
+        lone_client.send_request(sock, 'GET', '/stream')
+        assert sock.recv(4096)
+    finally:
+        sock.close()
+    # the abandoned response is closed and the receiver serves on
+    for _ in range(40):
+        if int(lone_client.get('/closed').body) > before:
+            break
+        time.sleep(0.05)
+    assert int(lone_client.get('/closed').body) == before + 1
+    assert lone_client.get('/').body == b'hello'
+
+
+def test_spooled_slow_upload(request, workdir):
+    body = expected_large(512 * 1024)
+    with serving(workdir.mkdir(request.node.name),
+                 receiver_options=['--spool', '--spool-memory', '65536']
+                 ) as client:
+        sock = client.connect()
+        try:
+            sock.sendall(encode_scgi_headers(
+                request_environ('POST', '/echo', body=body)))
+            for i in range(0, len(body), 64 * 1024):
+                sock.sendall(body[i:i + 64 * 1024])
+                time.sleep(0.01)
+            f = sock.makefile('rb')
+            status, _ = read_response_head(f)
+            received = f.read()
+            f.close()
+        finally:
+            sock.close()
+    assert status == '200 OK'
+    assert received == body
+
+
+def exited(pid, retries=40, delay=0.05):
+    # a receiver that's exited lingers only as a zombie
+    for _ in range(retries):
+        try:
+            with open('/proc/%d/stat' % (pid,)) as f:
+                if f.read().rsplit(')', 1)[1].split()[0] == 'Z':
+                    return True
+        except IOError:
+            return True
+        time.sleep(delay)
+    return False
+
+
+def test_sigterm_finishes_the_response(lone_client):
+    pid = int(lone_client.get('/pid').body)
+    sock = lone_client.connect()
+    try:
+        lone_client.send_request(sock, 'GET', '/slow?ms=500')
+        f = sock.makefile('rb')
+        status, _ = read_response_head(f)
+        assert f.read(16) == b'the first half, '
+        os.kill(pid, signal.SIGTERM)
+        assert f.read() == b'then..'
+        f.close()
+    finally:
+        sock.close()
+    assert status == '200 OK'
+    assert exited(pid)
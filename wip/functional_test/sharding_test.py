@@ -0,0 +1,33 @@
+from wip.common import allowed_cpus
+from wip.functional_test.conftest import serving
+
+
+def test_each_receiver_serves_its_shard(workdir):
+    cpus = allowed_cpus() or [0]
+
+    def placement(index):
+        return ['--shard', str(index),
+                '--cpu', str(cpus[index % len(cpus)])]
+
+    with serving(workdir.mkdir('sharding'), receivers=2, shards=2,
+                 placement=placement) as client:
+        pids = set()
+        for _ in range(200):
+            response = client.get('/pid')
+            assert response.status_code == 200
+            pids.add(response.body)
+    # connections from different ports hash to both shards, and only
+    # their own receiver accepts from each
+    assert len(pids) == 2
+
+
+def test_receiver_without_a_shard_serves_them_all(workdir):
+    with serving(workdir.mkdir('unsharded'), receivers=1,
+                 shards=4) as client:
+        client.timeout = 2.0
+        pids = set()
+        for _ in range(100):
+            response = client.get('/pid')
+            assert response.status_code == 200
+            pids.add(response.body)
+    assert len(pids) == 1
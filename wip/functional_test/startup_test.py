@@ -0,0 +1,176 @@
+import errno
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+from wip.functional_test.conftest import (subprocess_context,
+                                          wait_until_accessible_or_death)
+
+
+CLIENTS = 40
+DEADLINE = 30
+
+# runs wip.handoff with every Twisted endpoint taking a while to report
+# that it is listening, as endpoints that do real work before listen()
+# fires (TLS contexts, name lookups, plugins) can.  a server port the
+# reactor reads while waiting for that has its backlog accepted, and
+# dropped, before there is anywhere to send it.
+SLOW_LISTEN = '''
+import sys
+from twisted.internet import endpoints, task
+from wip import handoff
+
+server_from_string = endpoints.serverFromString
+
+
+class SlowEndpoint(object):
+
+    def __init__(self, reactor, endpoint):
+        self.reactor = reactor
+        self.endpoint = endpoint
+
+    def listen(self, factory):
+        return self.endpoint.listen(factory).addCallback(
+            lambda port: task.deferLater(self.reactor, 0.5, lambda: port))
+
+
+endpoints.serverFromString = lambda reactor, description: SlowEndpoint(
+    reactor, server_from_string(reactor, description))
+task.react(handoff.main, sys.argv[1:])
+'''
+
+
+def hammer(path, responses, deadline):
+    # keep trying until the daemon is listening, then demand a full
+    # response.  a connection the daemon accepted and dropped shows up
+    # as a reset or an empty response.
+    while time.time() < deadline:
+        sock = socket.socket(socket.AF_UNIX)
+        try:
+            sock.connect(path)
+        except socket.error as e:
+            sock.close()
+            if e.args[0] not in (errno.ENOENT, errno.ECONNREFUSED):
+                raise
+            time.sleep(0.005)
+            continue
+        break
+    else:
+        responses.append(b'never connected')
+        return
+
+    chunks = []
+    try:
+        sock.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except socket.error as e:
+        chunks.append(repr(e).encode())
+    finally:
+        sock.close()
+    responses.append(b''.join(chunks))
+
+
+def wait_until_connectable(proc, path, retries=40, delay=0.125):
+    # a socket left behind by a daemon that was killed exists but
+    # refuses connections
+    for ign in range(retries):
+        sock = socket.socket(socket.AF_UNIX)
+        try:
+            sock.connect(str(path))
+        except socket.error as e:
+            if e.args[0] not in (errno.ENOENT, errno.ECONNREFUSED):
+                raise
+        else:
+            return
+        finally:
+            sock.close()
+        if proc.poll() is not None:
+            raise RuntimeError('process died waiting for:', path)
+        time.sleep(delay)
+    raise RuntimeError('never accepted connections:', path)
+
+
+@pytest.fixture
+def startup_dir(workdir):
+    return workdir.ensure('startup', dir=True)
+
+
+def test_no_connections_dropped_during_startup(startup_dir):
+    server_path = startup_dir.join('server.sock')
+    handoff_path = startup_dir.join('handoff.sock')
+    deadline = time.time() + DEADLINE
+    responses = []
+    clients = [threading.Thread(target=hammer,
+                                args=(str(server_path), responses, deadline))
+               for _ in range(CLIENTS)]
+    for client in clients:
+        client.start()
+
+    handoff_args = [
+        sys.executable, '-c', SLOW_LISTEN,
+        '--backlog', str(CLIENTS * 2),
+        'unix:{}'.format(server_path.basename),
+        'unix:{}'.format(handoff_path.basename),
+    ]
+    receiver_args = [
+        sys.executable, '-m', 'wip.receiver', '--protocol', 'http',
+        handoff_path.basename,
+    ]
+    cwd = str(startup_dir)
+    with startup_dir.join('handoff.log').open('w') as handoff_log, \
+            startup_dir.join('receiver.log').open('w') as receiver_log:
+        with subprocess_context(handoff_args, handoff_log, cwd=cwd) as proc:
+            wait_until_accessible_or_death(proc, handoff_path)
+            wait_until_connectable(proc, handoff_path)
+            # clients pile up in the backlog with nobody to accept them
+            time.sleep(0.5)
+            with subprocess_context(receiver_args, receiver_log, cwd=cwd):
+                for client in clients:
+                    client.join(max(deadline - time.time(), 0))
+
+    assert len(responses) == CLIENTS
+    assert all(response.startswith(b'HTTP/1.1 200 OK\r\n')
+               for response in responses), responses
+
+
+def test_restart_after_kill(startup_dir):
+    # nothing cleans up after SIGKILL, so the next daemon finds the old
+    # server and handoff sockets still on disk
+    server_path = startup_dir.join('restart-server.sock')
+    handoff_path = startup_dir.join('restart-handoff.sock')
+    handoff_args = [
+        sys.executable, '-m', 'wip.handoff',
+        'unix:{}'.format(server_path.basename),
+        'unix:{}'.format(handoff_path.basename),
+    ]
+    receiver_args = [
+        sys.executable, '-m', 'wip.receiver', '--protocol', 'http',
+        handoff_path.basename,
+    ]
+    cwd = str(startup_dir)
+    with startup_dir.join('restart-handoff.log').open('w') as handoff_log, \
+            startup_dir.join('restart-receiver.log').open('w') as receiver_log:
+        with subprocess_context(handoff_args, handoff_log, cwd=cwd) as proc:
+            wait_until_connectable(proc, handoff_path)
+            wait_until_connectable(proc, server_path)
+            proc.kill()
+            proc.wait()
+        assert server_path.check()
+        assert handoff_path.check()
+
+        with subprocess_context(handoff_args, handoff_log, cwd=cwd) as proc:
+            wait_until_connectable(proc, handoff_path)
+            with subprocess_context(receiver_args, receiver_log, cwd=cwd):
+                responses = []
+                hammer(str(server_path), responses, time.time() + DEADLINE)
+            assert proc.poll() is None
+
+    [response] = responses
+    assert response.startswith(b'HTTP/1.1 200 OK\r\n'), response
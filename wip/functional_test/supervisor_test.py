@@ -0,0 +1,49 @@
+import sys
+
+from wip.client import SCGIClient
+from wip.functional_test.conftest import (subprocess_context,
+                                          wait_until_accessible_or_death,
+                                          wait_until_serving)
+from wip.scoreboard import Scoreboard
+
+
+def test_supervisor_starts_and_stops_receivers(workdir):
+    directory = workdir.mkdir('supervisor')
+    server_path = directory.join('server.sock')
+    handoff_path = directory.join('handoff.sock')
+    handoff_args = [
+        sys.executable, '-m', 'wip.handoff',
+        'unix:{}'.format(server_path.basename),
+        'unix:{}'.format(handoff_path.basename),
+    ]
+    supervisor_args = [
+        sys.executable, '-m', 'wip.supervisor',
+        '--min', '2', '--max', '3', '--interval', '0.1',
+        handoff_path.basename, '--',
+        '--app', 'wip.functional_test.apps:app',
+    ]
+    cwd = str(directory)
+    with directory.join('handoff.log').open('w') as handoff_log, \
+            directory.join('supervisor.log').open('w') as supervisor_log, \
+            subprocess_context(handoff_args, handoff_log, cwd=cwd) as proc:
+        wait_until_accessible_or_death(proc, server_path)
+        wait_until_accessible_or_death(proc, handoff_path)
+        with subprocess_context(supervisor_args, supervisor_log,
+                                cwd=cwd) as supervisor:
+            client = SCGIClient(str(server_path))
+            wait_until_serving(proc, client)
+            for _ in range(10):
+                assert client.get('/').status_code == 200
+            scoreboard = Scoreboard(
+                str(directory.join('handoff.sock.scoreboard')), 3)
+            try:
+                slots = [scoreboard.read(index, 0.0) for index in range(3)]
+            finally:
+                scoreboard.close()
+            # both of the minimum receivers have their slots; the
+            # third's never been needed
+            assert all(slot[0] for slot in slots[:2])
+            assert slots[2][0] == 0
+            assert sum(slot[3] for slot in slots) >= 10
+            supervisor.terminate()
+            assert supervisor.wait() == 0
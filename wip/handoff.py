@@ -1,61 +1,706 @@
+import collections
+import errno
+import json
+import os
+import socket
+import stat
+import struct
 import sys
+import time
 
-from twisted.internet import defer, endpoints, protocol, task
-from twisted.internet.main import CONNECTION_LOST
-from twisted import logger
+from wip.common import (accept_queue,
+                        adopt_fd,
+                        describe_socket,
+                        DISPATCH_REQUEST,
+                        encode_handoff,
+                        headers_to_bytes,
+                        listen_fds,
+                        parse_socket_option,
+                        shard_name,
+                        SocketTuning,
+                        DEFAULT_LISTENER,
+                        DESCRIPTION_LENGTH,
+                        HANDOFF_VERSION,
+                        MAX_HANDOFF_SOCKETS,
+                        MAX_LISTENER_NAME_LENGTH,
+                        READY_BYTE,
+                        UNREADY_BYTE,
+                        VERSION_REQUEST)
 
+# importing twisted.internet.endpoints consumes LISTEN_FDS on behalf of
+# its own systemd: endpoint, so take note of activated sockets first.
+ACTIVATED = listen_fds()
 
-from wip.common import describe_socket, READY_BYTE
+from twisted.internet import defer, endpoints, protocol, task  # noqa: E402
+from twisted.internet.error import CannotListenError  # noqa: E402
+from twisted.internet.interfaces import IReadDescriptor  # noqa: E402
+from twisted.internet.main import CONNECTION_LOST  # noqa: E402
+from twisted.python.sendmsg import SCM_RIGHTS, sendmsg  # noqa: E402
+from twisted.python import lockfile, usage  # noqa: E402
+from twisted.python.util import untilConcludes  # noqa: E402
+from twisted import logger  # noqa: E402
+from zope.interface import implementer  # noqa: E402
+
+
+log = logger.Logger()
+
+
+class HandoffStats(object):
+
+    def __init__(self, seconds=time.time):
+        self._seconds = seconds
+        self.started = seconds()
+        self.handoffs = 0
+        self.rejected = 0
+        self.last_handoff = None
+
+    def handed_off(self):
+        self.handoffs += 1
+        self.last_handoff = self._seconds()
+
+    def rejected_connection(self):
+        self.rejected += 1
+
+    def report(self, listeners):
+        now = self._seconds()
+        since_last_handoff = None
+        if self.last_handoff is not None:
+            since_last_handoff = now - self.last_handoff
+        report = {
+            'uptime': now - self.started,
+            'handoffs': self.handoffs,
+            'rejected': self.rejected,
+            'seconds_since_last_handoff': since_last_handoff,
+            'listeners': {},
+        }
+        for name, port, _ in listeners:
+            queue = accept_queue(port.socket)
+            depth, backlog = queue if queue is not None else (None, None)
+            report['listeners'][name] = {'queue_depth': depth,
+                                         'backlog': backlog}
+        return report
 
 
 class AlwaysAbortFactory(protocol.Factory):
     log = logger.Logger()
 
+    def __init__(self, stats=None):
+        self.stats = stats
+
     def buildProtocol(self, addr):
         self.log.warn('rejecting incoming connection: {addr}', addr=addr)
+        if self.stats is not None:
+            self.stats.rejected_connection()
         return None
 
 
 class HandoffProtocol(protocol.Protocol):
     done = False
+    dispatching = False
+    _buffer = b''
 
-    def dataReceived(self, datum):
-        if self.done or datum != READY_BYTE:
-            return
+    def _handoff_v1(self):
         self.transport.write(self.factory.handoff_port_description)
         self.transport.sendFileDescriptor(self.factory.handoff_port.fileno())
+
+    def _handoff_v2(self):
+        listeners = self.factory.listeners
+        payload = encode_handoff(
+            [(headers_to_bytes(name), description)
+             for name, _, description in listeners])
+        fds = [port.fileno() for _, port, _ in listeners]
+        # Twisted sends one descriptor per byte and per syscall; all of
+        # them go in a single SCM_RIGHTS message instead, so the
+        # receiver gets everything from one recvmsg.
+        self._send_descriptors(payload, fds)
+
+    def _send_descriptors(self, payload, fds):
+        sent = untilConcludes(
+            sendmsg, self.transport.socket, payload,
+            [(socket.SOL_SOCKET, SCM_RIGHTS,
+              struct.pack('%di' % len(fds), *fds))])
+        if sent < len(payload):
+            self.transport.write(payload[sent:])
+
+    def send_connection(self, skt):
+        # one accepted connection, described like a version 1 listener
+        self._send_descriptors(describe_socket(skt), [skt.fileno()])
+
+    def _dispatch_requests(self, data):
+        for ready in bytearray(data):
+            if ready == ord(UNREADY_BYTE):
+                self.factory.dispatcher.detach(self)
+                self.transport.loseConnection()
+                self.done = True
+                return
+            if ready != ord(READY_BYTE):
+                self.transport.abortConnection()
+                return
+            self.factory.dispatcher.ready(self)
+
+    def dataReceived(self, datum):
+        if self.dispatching:
+            if not self.done:
+                self._dispatch_requests(datum)
+            return
+        if self.done:
+            return
+        self._buffer += datum
+        dispatcher = self.factory.dispatcher
+        if self._buffer.startswith(DISPATCH_REQUEST):
+            if dispatcher is None:
+                self.transport.loseConnection()
+                self.done = True
+                return
+            self.dispatching = True
+            dispatcher.attach(self)
+            self._dispatch_requests(self._buffer[len(DISPATCH_REQUEST):])
+            self._buffer = b''
+            return
+        if dispatcher is not None and self._buffer.startswith(
+                (READY_BYTE, VERSION_REQUEST)):
+            # the daemon accepts from its listeners itself, and nothing
+            # may race it to
+            self.factory.log.warn('refusing a listener handoff in '
+                                  'dispatch mode')
+            self.transport.loseConnection()
+            self.done = True
+            return
+        if self._buffer.startswith(READY_BYTE):
+            self._handoff_v1()
+        elif self._buffer.startswith(VERSION_REQUEST):
+            if len(self._buffer) < len(VERSION_REQUEST) + 1:
+                return
+            version = ord(self._buffer[len(VERSION_REQUEST):][:1])
+            if version < HANDOFF_VERSION:
+                self._handoff_v1()
+            else:
+                self._handoff_v2()
+        else:
+            self._buffer = b''
+            return
         self.transport.loseConnection()
         self.done = True
+        self.factory.stats.handed_off()
+
+    def connectionLost(self, reason):
+        if self.dispatching:
+            self.factory.dispatcher.detach(self)
 
 
 class HandoffFactory(protocol.Factory):
     protocol = HandoffProtocol
     log = logger.Logger()
 
-    def __init__(self, handoff_port, handoff_port_description):
-        self.handoff_port = handoff_port
-        self.handoff_port_description = handoff_port_description
+    def __init__(self, listeners, stats=None, dispatcher=None):
+        # (name, port, description) for each listener; version 1
+        # receivers only ever get the first.
+        self.listeners = listeners
+        self.stats = stats if stats is not None else HandoffStats()
+        # with a Dispatcher, connections are handed off instead of
+        # listeners
+        self.dispatcher = dispatcher
+        _, self.handoff_port, description = listeners[0]
+        # version 1 descriptions carry no tuning
+        self.handoff_port_description = description[:DESCRIPTION_LENGTH]
 
     def doStop(self):
-        self.log.info("Stopping server port {handoff_port!r}",
-                      handoff_port=self.handoff_port)
-        self.handoff_port.connectionLost(CONNECTION_LOST)
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+        for _, handoff_port, _ in self.listeners:
+            self.log.info("Stopping server port {handoff_port!r}",
+                          handoff_port=handoff_port)
+            handoff_port.connectionLost(CONNECTION_LOST)
+
+
+DEFAULT_MAX_QUEUED = 128
+DEFAULT_MAX_WAIT = 30.0
+# connections accepted per listener each time the reactor says it's
+# readable, so one busy listener can't starve the rest
+_ACCEPTS_PER_READ = 32
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+@implementer(IReadDescriptor)
+class _ListenerReader(object):
+
+    def __init__(self, dispatcher, port):
+        self.dispatcher = dispatcher
+        self.port = port
+
+    def fileno(self):
+        return self.port.fileno()
+
+    def logPrefix(self):
+        return repr(self.port)
+
+    def doRead(self):
+        for _ in range(_ACCEPTS_PER_READ):
+            if self.dispatcher.paused:
+                return
+            try:
+                skt, _ = self.port.socket.accept()
+            except socket.error as e:
+                if e.args[0] in _WOULD_BLOCK or e.args[0] == errno.EINTR:
+                    return
+                # e.g. EMFILE; the connection waits in the backlog
+                # until the next read
+                self.dispatcher.log.failure('accepting a connection')
+                return
+            self.dispatcher.accepted(skt)
+
+    def connectionLost(self, reason):
+        pass
+
+
+class Dispatcher(object):
+    # in dispatch mode the daemon accepts connections itself, whether or
+    # not any receiver's attached, and queues them, oldest first, for
+    # receivers as they say they're ready.  once max_queued are waiting
+    # the listeners aren't read, so the rest wait in their backlogs.
+    # connections that wait max_wait seconds are closed.
+    log = logger.Logger()
+
+    def __init__(self, reactor, ports, tuning=None,
+                 max_queued=DEFAULT_MAX_QUEUED, max_wait=DEFAULT_MAX_WAIT):
+        self.reactor = reactor
+        self.tuning = tuning
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.paused = True
+        self.running = False
+        self.receivers = set()
+        self.dispatched = 0
+        self.expired = 0
+        # (accepted at, socket)
+        self._queue = collections.deque()
+        # a receiver for each READY_BYTE it's sent, in order
+        self._ready = collections.deque()
+        self._readers = [_ListenerReader(self, port) for port in ports]
+        self._expiry = None
+
+    def start(self):
+        for reader in self._readers:
+            reader.port.socket.setblocking(False)
+        self.running = True
+        self._resume()
+        if self.max_wait:
+            self._expiry = task.LoopingCall(self.expire)
+            self._expiry.clock = self.reactor
+            self._expiry.start(min(1.0, self.max_wait / 4.0), now=False)
+
+    def stop(self):
+        self.running = False
+        self._pause()
+        if self._expiry is not None and self._expiry.running:
+            self._expiry.stop()
+        while self._queue:
+            self._queue.popleft()[1].close()
+
+    def _pause(self):
+        if not self.paused:
+            self.paused = True
+            for reader in self._readers:
+                self.reactor.removeReader(reader)
+
+    def _resume(self):
+        if self.paused and self.running:
+            self.paused = False
+            for reader in self._readers:
+                self.reactor.addReader(reader)
+
+    def accepted(self, skt):
+        if self.tuning is not None:
+            self.tuning.apply_to_connection(skt)
+        self._queue.append((self.reactor.seconds(), skt))
+        self._dispatch()
+        if len(self._queue) >= self.max_queued:
+            self._pause()
+
+    def attach(self, receiver):
+        self.receivers.add(receiver)
+
+    def detach(self, receiver):
+        self.receivers.discard(receiver)
+        self._ready = collections.deque(
+            ready for ready in self._ready if ready is not receiver)
+
+    def ready(self, receiver):
+        self._ready.append(receiver)
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._queue and self._ready:
+            receiver = self._ready.popleft()
+            accepted_at, skt = self._queue.popleft()
+            try:
+                receiver.send_connection(skt)
+            except socket.error:
+                # the receiver's gone; someone else can have it
+                self._queue.appendleft((accepted_at, skt))
+                self.detach(receiver)
+                receiver.transport.abortConnection()
+                continue
+            # the receiver has its own copy now
+            skt.close()
+            self.dispatched += 1
+        if len(self._queue) < self.max_queued:
+            self._resume()
+
+    def expire(self):
+        now = self.reactor.seconds()
+        while self._queue and now - self._queue[0][0] >= self.max_wait:
+            self._queue.popleft()[1].close()
+            self.expired += 1
+        if len(self._queue) < self.max_queued:
+            self._resume()
+
+    def report(self):
+        oldest = None
+        if self._queue:
+            oldest = self.reactor.seconds() - self._queue[0][0]
+        return {'queued': len(self._queue),
+                'ready': len(self._ready),
+                'receivers': len(self.receivers),
+                'dispatched': self.dispatched,
+                'expired': self.expired,
+                'oldest_wait': oldest,
+                'reading': not self.paused}
+
+
+class ControlProtocol(protocol.Protocol):
+
+    def connectionMade(self):
+        handoff_factory = self.factory.handoff_factory
+        report = handoff_factory.stats.report(handoff_factory.listeners)
+        if handoff_factory.dispatcher is not None:
+            report['dispatch'] = handoff_factory.dispatcher.report()
+        self.transport.write(
+            json.dumps(report, sort_keys=True).encode('ascii') + b'\n')
+        self.transport.loseConnection()
+
+
+class ControlFactory(protocol.Factory):
+    protocol = ControlProtocol
+
+    def __init__(self, handoff_factory):
+        self.handoff_factory = handoff_factory
+
+
+def parse_listener(argument):
+    # NAME=ENDPOINT; endpoint descriptions may themselves contain '='
+    # but names may not contain ':'
+    name, sep, endpoint = argument.partition('=')
+    if not sep or not name or ':' in name:
+        raise ValueError('expected NAME=ENDPOINT, got %r' % (argument,))
+    return name, endpoint
+
+
+def listener_names(listeners):
+    # the names (name, endpoint) listeners are handed off under, one
+    # for each shard
+    names = []
+    for name, endpoint_string in listeners:
+        shards = int(parse_endpoint(endpoint_string)[2].get('shards', 1))
+        names.extend(shard_name(name, shard) for shard in range(shards))
+    return names
+
+
+class UnreadPort(object):
+    # a listening socket the reactor never sees, so nothing but a
+    # receiver ever accepts from it
+
+    def __init__(self, skt, path=None, lock=None):
+        self.socket = skt
+        self.path = path
+        self.lock = lock
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def connectionLost(self, reason):
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        if self.lock is not None:
+            self.lock.unlock()
+        self.socket.close()
+
+    def __repr__(self):
+        return '<%s on %r>' % (self.__class__.__name__,
+                               self.path or self.socket.getsockname())
+
+
+def parse_endpoint(description):
+    # the same syntax as twisted.internet.endpoints.serverFromString:
+    # colon separated, backslash escaped, with optional key=value
+    # parameters.  returns (type, args, kwargs)
+    parts = [[]]
+    characters = iter(description)
+    for character in characters:
+        if character == '\\':
+            parts[-1].append(next(characters, ''))
+        elif character == ':':
+            parts.append([])
+        else:
+            parts[-1].append(character)
+    parts = [''.join(part) for part in parts]
+    args, kwargs = [], {}
+    for part in parts[1:]:
+        key, sep, value = part.partition('=')
+        if sep:
+            kwargs[key] = value
+        else:
+            args.append(part)
+    return parts[0], args, kwargs
+
+
+_INET_FAMILIES = {'tcp': (socket.AF_INET, ''),
+                  'tcp6': (socket.AF_INET6, '::')}
+
+
+def listen_raw(description, activated=()):
+    # bind and listen, or adopt an inherited socket, without involving
+    # the reactor.  activated is what listen_fds returned.  returns None
+    # for endpoint types only Twisted knows how to create.
+    kind, args, kwargs = parse_endpoint(description)
+    backlog = int(kwargs.get('backlog', 50))
+    if kind in _INET_FAMILIES:
+        return UnreadPort(_listen_inet(kind, args, kwargs, backlog))
+    elif kind == 'unix':
+        path = args[0] if args else kwargs['address']
+        lock = None
+        if int(kwargs.get('lockfile', 1)):
+            lock = _lock_unix_path(path)
+        skt = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            skt.bind(path)
+            os.chmod(path, int(kwargs.get('mode', '666'), 8))
+            skt.listen(backlog)
+        except Exception:
+            skt.close()
+            if lock is not None:
+                lock.unlock()
+            raise
+        return UnreadPort(skt, path, lock)
+    elif kind == 'fd':
+        return UnreadPort(adopt_fd(int(args[0] if args else kwargs['fd'])))
+    elif kind == 'systemd':
+        return UnreadPort(adopt_fd(_activated_fd(activated, args, kwargs)))
+    return None
+
+
+def _lock_unix_path(path):
+    # what Twisted's unix: endpoint does with lockfile=1: PATH.lock names
+    # the daemon that owns PATH, so a socket left behind by one that
+    # died can be removed while a live one's cannot.
+    lock = lockfile.FilesystemLock(path + '.lock')
+    if not lock.lock():
+        raise CannotListenError(None, path, 'Cannot acquire lock')
+    if not lock.clean:
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except OSError:
+            pass
+    return lock
+
+
+def _listen_inet(kind, args, kwargs, backlog, port=None, reuseport=False):
+    family, default_interface = _INET_FAMILIES[kind]
+    if port is None:
+        port = int(args[0] if args else kwargs['port'])
+    skt = socket.socket(family, socket.SOCK_STREAM)
+    skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    skt.bind((kwargs.get('interface', default_interface), port))
+    skt.listen(backlog)
+    return skt
+
+
+def listen_shards(description):
+    # a TCP endpoint with shards=N: N SO_REUSEPORT sockets on the same
+    # port, between which the kernel spreads connections.  each can be
+    # served by its own receivers, which may steer it to their CPU.
+    kind, args, kwargs = parse_endpoint(description)
+    if kind not in _INET_FAMILIES:
+        raise ValueError('only TCP endpoints have shards: %r'
+                         % (description,))
+    shards = int(kwargs['shards'])
+    if not 0 < shards <= MAX_HANDOFF_SOCKETS:
+        raise ValueError('bad shard count in %r' % (description,))
+    backlog = int(kwargs.get('backlog', 50))
+    ports = []
+    try:
+        port = None
+        for _ in range(shards):
+            skt = _listen_inet(kind, args, kwargs, backlog, port,
+                               reuseport=True)
+            # the rest join whatever port the first was given
+            port = skt.getsockname()[1]
+            ports.append(UnreadPort(skt))
+    except Exception:
+        for server_port in ports:
+            server_port.socket.close()
+        raise
+    return ports
+
+
+def _activated_fd(activated, args, kwargs):
+    # systemd:NAME, systemd:name=NAME or systemd:index=N.  Twisted's
+    # domain= is accepted but ignored; the kernel is asked instead.
+    name = kwargs.get('name') or (args[0] if args else None)
+    if name is not None:
+        for activated_name, fd in activated:
+            if activated_name == name:
+                return fd
+        raise ValueError('no activated socket named %r' % (name,))
+    index = int(kwargs.get('index', 0))
+    if index >= len(activated):
+        raise ValueError('no activated socket at index %d' % (index,))
+    return activated[index][1]
+
+
+def listen_unread(reactor, endpoint_string, stats=None, activated=()):
+    server_port = listen_raw(endpoint_string, activated)
+    if server_port is not None:
+        return defer.succeed(server_port)
+
+    # the reactor starts reading the port as soon as it listens, so
+    # connections that arrive before removeReader are dropped
+    log.warn('{endpoint} is not a raw-listenable endpoint; connections '
+             'may be rejected during startup', endpoint=endpoint_string)
+
+    def stop_reading(server_port):
+        reactor.removeReader(server_port)
+        return server_port
+
+    server_endpoint = endpoints.serverFromString(reactor, endpoint_string)
+    return server_endpoint.listen(
+        AlwaysAbortFactory(stats)).addCallback(stop_reading)
+
+
+class Options(usage.Options):
+    synopsis = ('[options] SERVER_ENDPOINT HANDOFF_ENDPOINT '
+                '[NAME=SERVER_ENDPOINT ...]')
+
+    optParameters = [
+        ['backlog', None, 0,
+         'Resize the listen backlog of every server port.', int],
+        ['control', None, None,
+         'Report statistics as JSON to connections on this endpoint.'],
+        ['queue', None, DEFAULT_MAX_QUEUED,
+         'With --dispatch, stop accepting while this many connections '
+         'wait for a receiver.', int],
+        ['max-wait', None, DEFAULT_MAX_WAIT,
+         'With --dispatch, close connections that wait this many seconds '
+         'for a receiver; 0 waits forever.', float],
+    ]
+
+    optFlags = [
+        ['dispatch', None,
+         'Accept connections here and pass them to receivers started with '
+         '--dispatched as they are ready, instead of passing the listeners '
+         'on.'],
+    ]
+
+    def __init__(self):
+        usage.Options.__init__(self)
+        self['listener-options'] = []
+        self['connection-options'] = []
+
+    def _socket_option(self, key, option):
+        try:
+            self[key].append(parse_socket_option(option))
+        except ValueError as e:
+            raise usage.UsageError(str(e))
+
+    def opt_listener_option(self, option):
+        """Set NAME=VALUE, e.g. TCP_DEFER_ACCEPT=5, on every server port."""
+        self._socket_option('listener-options', option)
+
+    def opt_connection_option(self, option):
+        """Have receivers set NAME=VALUE, e.g. TCP_NODELAY=1, on accept."""
+        self._socket_option('connection-options', option)
+
+    def parseArgs(self, server_endpoint, handoff_endpoint, *listeners):
+        self['handoff-endpoint'] = handoff_endpoint
+        try:
+            self['listeners'] = [(DEFAULT_LISTENER, server_endpoint)] + [
+                parse_listener(argument) for argument in listeners]
+        except ValueError as e:
+            raise usage.UsageError(str(e))
+
+    def postOptions(self):
+        if self['dispatch']:
+            # connections are handed off, not listeners
+            return
+        # or the daemon starts, but every version 2 handoff fails
+        try:
+            names = listener_names(self['listeners'])
+        except ValueError as e:
+            raise usage.UsageError(str(e))
+        if len(names) > MAX_HANDOFF_SOCKETS:
+            raise usage.UsageError(
+                '%d listening sockets, shards and all, but a handoff '
+                'carries at most %d' % (len(names), MAX_HANDOFF_SOCKETS))
+        for name in names:
+            if len(headers_to_bytes(name)) > MAX_LISTENER_NAME_LENGTH:
+                raise usage.UsageError(
+                    'listener names are at most %d bytes: %r'
+                    % (MAX_LISTENER_NAME_LENGTH, name))
+
+    def tuning(self):
+        return SocketTuning(self['backlog'],
+                            self['listener-options'],
+                            self['connection-options'])
 
 
 @defer.inlineCallbacks
-def main(reactor, server_endpoint_string, handoff_endpoint_string):
+def main(reactor, *argv):
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError as e:
+        sys.stderr.write('%s\n%s\n' % (options, e))
+        raise SystemExit(2)
     logger.globalLogBeginner.beginLoggingTo(
         [logger.textFileLogObserver(sys.stderr)])
-    server_endpoint = endpoints.serverFromString(
-        reactor, server_endpoint_string)
-    server_port = yield server_endpoint.listen(AlwaysAbortFactory())
-    handoff_factory = HandoffFactory(server_port,
-                                     describe_socket(server_port.socket))
-    reactor.removeReader(server_port)
+
+    tuning = options.tuning()
+    stats = HandoffStats(reactor.seconds)
+    listeners = []
+    for name, endpoint_string in options['listeners']:
+        if 'shards' in parse_endpoint(endpoint_string)[2]:
+            server_ports = listen_shards(endpoint_string)
+        else:
+            server_ports = [(yield listen_unread(reactor, endpoint_string,
+                                                 stats, ACTIVATED))]
+        for shard, server_port in enumerate(server_ports):
+            tuning.apply_to_listener(server_port.socket)
+            listeners.append((shard_name(name, shard), server_port,
+                              describe_socket(server_port.socket, tuning)))
+    dispatcher = None
+    if options['dispatch']:
+        dispatcher = Dispatcher(reactor,
+                                [port for _, port, _ in listeners],
+                                tuning=tuning,
+                                max_queued=options['queue'],
+                                max_wait=options['max-wait'])
+    handoff_factory = HandoffFactory(listeners, stats, dispatcher)
 
     handoff_endpoint = endpoints.serverFromString(
-        reactor, handoff_endpoint_string)
+        reactor, options['handoff-endpoint'])
     yield handoff_endpoint.listen(handoff_factory)
+    if dispatcher is not None:
+        dispatcher.start()
+    if options['control'] is not None:
+        control_endpoint = endpoints.serverFromString(
+            reactor, options['control'])
+        yield control_endpoint.listen(ControlFactory(handoff_factory))
     yield defer.Deferred()
 
 
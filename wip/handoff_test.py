@@ -0,0 +1,664 @@
+import json
+import os
+import socket
+import stat
+import struct
+
+from twisted.internet import task
+from twisted.internet.error import CannotListenError
+from twisted.internet.testing import (MemoryReactor, MemoryReactorClock,
+                                      StringTransport)
+from twisted.python import usage
+import pytest
+
+from wip import common, handoff, receiver
+
+
+class FakeTransport(object):
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.lost = False
+
+    def write(self, data):
+        self.socket.sendall(data)
+
+    def sendFileDescriptor(self, fd):
+        self.socket.sendmsg([b'\0'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                       struct.pack('i', fd))])
+
+    def loseConnection(self):
+        self.lost = True
+
+    def abortConnection(self):
+        self.lost = True
+
+
+class FakePort(object):
+
+    def __init__(self, sock):
+        self.socket = sock
+
+    def fileno(self):
+        return self.socket.fileno()
+
+
+@pytest.fixture
+def listeners():
+    socks = []
+    for family in (socket.AF_INET, socket.AF_UNIX):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        socks.append(sock)
+    yield [(name, FakePort(sock), common.describe_socket(sock))
+           for name, sock in zip(['default', 'admin'], socks)]
+    for sock in socks:
+        sock.close()
+
+
+@pytest.fixture
+def connected(listeners):
+    server, client = socket.socketpair()
+    factory = handoff.HandoffFactory(listeners)
+    proto = factory.buildProtocol(None)
+    proto.makeConnection(FakeTransport(server))
+    yield proto, client
+    server.close()
+    client.close()
+
+
+def test_handoff_round_trip():
+    listeners = [(b'default', b'x' * common.DESCRIPTION_LENGTH),
+                 (b'admin', b'')]
+    encoded = common.encode_handoff(listeners)
+    assert common.handoff_length(encoded) == len(encoded)
+    assert common.decode_handoff(encoded) == listeners
+
+
+@pytest.mark.parametrize('bad_handoff', [
+    b'\x02\x01',
+    b'\x01\x00\x00\x00',
+    b'\x02\x01\x00\x00',
+    b'\x02\x01\x00\x03\x05\x00a',
+    b'\x02\x00\x00\x01x',
+])
+def test_decode_handoff_fails(bad_handoff):
+    with pytest.raises(RuntimeError):
+        common.decode_handoff(bad_handoff)
+
+
+def test_version_1_handoff(connected, listeners):
+    proto, client = connected
+    proto.dataReceived(common.READY_BYTE)
+
+    description = client.recv(common.DESCRIPTION_LENGTH, socket.MSG_WAITALL)
+    assert description[1:] == listeners[0][2][1:]
+    assert proto.transport.lost
+
+
+def test_version_2_handoff(connected, listeners):
+    proto, client = connected
+    # the request may arrive split across reads
+    request = common.version_request()
+    proto.dataReceived(request[:1])
+    assert not proto.transport.lost
+    proto.dataReceived(request[1:])
+    assert proto.transport.lost
+
+    received = receiver.read_handoff(client)
+    try:
+        assert [(name, description)
+                for name, _, description in received] == [
+            (name, description) for name, _, description in listeners]
+        for (_, fd, _), (_, port, _) in zip(received, listeners):
+            assert os.fstat(fd).st_ino == os.fstat(port.fileno()).st_ino
+    finally:
+        for _, fd, _ in received:
+            os.close(fd)
+
+
+def test_garbage_is_ignored(connected):
+    proto, client = connected
+    proto.dataReceived(b'x')
+    assert not proto.transport.lost
+
+
+@pytest.mark.parametrize('argument,parsed', [
+    ('admin=tcp:8081:interface=127.0.0.1',
+     ('admin', 'tcp:8081:interface=127.0.0.1')),
+    ('x=unix:a.sock', ('x', 'unix:a.sock')),
+])
+def test_parse_listener(argument, parsed):
+    assert handoff.parse_listener(argument) == parsed
+
+
+@pytest.mark.parametrize('argument', ['tcp:8081', '=tcp:80', 'unix:x=y'])
+def test_parse_listener_fails(argument):
+    with pytest.raises(ValueError):
+        handoff.parse_listener(argument)
+
+
+def test_options_count_shards():
+    options = handoff.Options()
+    options.parseOptions(['tcp:80:shards=3', 'unix:handoff.sock',
+                          'admin=tcp:81'])
+    assert handoff.listener_names(options['listeners']) == [
+        'default', 'default:1', 'default:2', 'admin']
+
+
+@pytest.mark.parametrize('argv', [
+    # too many sockets for one handoff
+    ['tcp:80:shards=40', 'unix:handoff.sock', 'admin=tcp:81:shards=40'],
+    ['tcp:80', 'unix:handoff.sock', 'x' * 256 + '=tcp:81'],
+])
+def test_options_refuse_what_cannot_be_handed_off(argv):
+    with pytest.raises(usage.UsageError):
+        handoff.Options().parseOptions(argv)
+    # connections are handed off one at a time instead
+    handoff.Options().parseOptions(['--dispatch'] + argv)
+
+
+def test_options_refuse_nonsense_shards():
+    with pytest.raises(usage.UsageError):
+        handoff.Options().parseOptions(['tcp:80:shards=lots',
+                                        'unix:handoff.sock'])
+
+
+def test_encode_handoff_refuses_long_names():
+    with pytest.raises(RuntimeError):
+        common.encode_handoff([(b'x' * 256, b'')])
+
+
+@pytest.mark.parametrize('option,parsed', [
+    ('TCP_NODELAY', (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)),
+    ('so_sndbuf=65536', (socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)),
+])
+def test_parse_socket_option(option, parsed):
+    assert common.parse_socket_option(option) == parsed
+
+
+@pytest.mark.parametrize('option', ['IP_TOS=1', 'TCP_NOT_REAL=1',
+                                    'TCP_NODELAY=yes'])
+def test_parse_socket_option_fails(option):
+    with pytest.raises(ValueError):
+        common.parse_socket_option(option)
+
+
+def test_socket_tuning_round_trip():
+    tuning = common.SocketTuning(
+        backlog=1024,
+        listener_options=[common.parse_socket_option('SO_RCVBUF=4096')],
+        connection_options=[common.parse_socket_option('TCP_NODELAY=1'),
+                            common.parse_socket_option('SO_SNDBUF=8192')])
+    sock = socket.socket()
+    try:
+        description = common.describe_socket(sock, tuning)
+    finally:
+        sock.close()
+    assert len(description) > common.DESCRIPTION_LENGTH
+    assert common.socket_tuning(description) == tuning
+    assert common.socket_tuning(
+        description[:common.DESCRIPTION_LENGTH]) is None
+
+
+def test_socket_tuning_decode_fails():
+    encoded = common.SocketTuning(
+        connection_options=[(1, 2, 3)]).encode()
+    with pytest.raises(RuntimeError):
+        common.SocketTuning.decode(encoded[:-1])
+
+
+def test_socket_tuning_skips_tcp_options_on_unix_sockets():
+    tuning = common.SocketTuning(
+        backlog=5,
+        listener_options=[common.parse_socket_option('TCP_NODELAY=1'),
+                          common.parse_socket_option('SO_SNDBUF=65536')])
+    tcp, unix = socket.socket(), socket.socket(socket.AF_UNIX)
+    try:
+        tcp.bind(('127.0.0.1', 0))
+        unix.bind('\0wip-tuning-test-%d' % os.getpid())
+        for sock in tcp, unix:
+            sock.listen(1)
+        tuning.apply_to_listener(tcp)
+        tuning.apply_to_listener(unix)
+        assert tcp.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        assert unix.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) >= 65536
+    finally:
+        tcp.close()
+        unix.close()
+
+
+def test_version_1_handoff_omits_tuning():
+    sock = socket.socket()
+    try:
+        description = common.describe_socket(
+            sock, common.SocketTuning(backlog=10))
+        factory = handoff.HandoffFactory(
+            [('default', FakePort(sock), description)])
+    finally:
+        sock.close()
+    assert factory.handoff_port_description == (
+        description[:common.DESCRIPTION_LENGTH])
+
+
+def test_accept_queue():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(7)
+    clients = [socket.create_connection(listener.getsockname())
+               for _ in range(3)]
+    try:
+        depth, backlog = common.accept_queue(listener)
+        assert backlog == 7
+        # the handshake completes asynchronously
+        assert depth <= 3
+    finally:
+        for client in clients:
+            client.close()
+        listener.close()
+
+
+def test_accept_queue_unknown():
+    unix = socket.socket(socket.AF_UNIX)
+    try:
+        assert common.accept_queue(unix) is None
+    finally:
+        unix.close()
+
+
+def test_stats_report(connected, listeners):
+    clock = task.Clock()
+    clock.advance(100)
+    stats = handoff.HandoffStats(clock.seconds)
+    proto, client = connected
+    proto.factory.stats = stats
+
+    handoff.AlwaysAbortFactory(stats).buildProtocol(None)
+    clock.advance(5)
+    proto.dataReceived(common.READY_BYTE)
+    clock.advance(2)
+
+    transport = StringTransport()
+    control = handoff.ControlFactory(proto.factory).buildProtocol(None)
+    control.makeConnection(transport)
+
+    assert transport.disconnecting
+    assert json.loads(transport.value().decode('ascii')) == {
+        'uptime': 7,
+        'handoffs': 1,
+        'rejected': 1,
+        'seconds_since_last_handoff': 2,
+        'listeners': {
+            'default': {'queue_depth': None, 'backlog': None},
+            'admin': {'queue_depth': None, 'backlog': None},
+        },
+    }
+
+
+@pytest.mark.parametrize('description,parsed', [
+    ('tcp:8080', ('tcp', ['8080'], {})),
+    ('tcp:port=80:interface=127.0.0.1',
+     ('tcp', [], {'port': '80', 'interface': '127.0.0.1'})),
+    (r'tcp6:80:interface=\:\:1', ('tcp6', ['80'], {'interface': '::1'})),
+    ('unix:a.sock:mode=600', ('unix', ['a.sock'], {'mode': '600'})),
+])
+def test_parse_endpoint(description, parsed):
+    assert handoff.parse_endpoint(description) == parsed
+
+
+def test_listen_raw_tcp():
+    port = handoff.listen_raw('tcp:0:interface=127.0.0.1:backlog=7')
+    try:
+        assert common.accept_queue(port.socket) == (0, 7)
+    finally:
+        port.connectionLost(None)
+    assert port.socket.fileno() == -1
+
+
+def test_listen_raw_unix(tmpdir):
+    path = str(tmpdir.join('raw.sock'))
+    port = handoff.listen_raw('unix:%s:mode=600' % (path,))
+    try:
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        assert port.socket.getsockopt(socket.SOL_SOCKET,
+                                      socket.SO_ACCEPTCONN)
+    finally:
+        port.connectionLost(None)
+    assert not os.path.exists(path)
+
+
+def test_listen_raw_unix_locks(tmpdir):
+    path = str(tmpdir.join('raw.sock'))
+    port = handoff.listen_raw('unix:%s' % (path,))
+    try:
+        assert os.path.islink(path + '.lock')
+        with pytest.raises(CannotListenError):
+            handoff.listen_raw('unix:%s' % (path,))
+        assert port.socket.getsockopt(socket.SOL_SOCKET,
+                                      socket.SO_ACCEPTCONN)
+    finally:
+        port.connectionLost(None)
+    assert not os.path.lexists(path + '.lock')
+
+
+def test_listen_raw_unix_replaces_stale_socket(tmpdir):
+    path = str(tmpdir.join('raw.sock'))
+    pid = os.fork()
+    if not pid:
+        # die holding the lock without cleaning up, as after SIGKILL
+        handoff.listen_raw('unix:%s' % (path,))
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert stat.S_ISSOCK(os.stat(path).st_mode)
+
+    port = handoff.listen_raw('unix:%s' % (path,))
+    try:
+        client = socket.socket(socket.AF_UNIX)
+        client.connect(path)
+        client.close()
+    finally:
+        port.connectionLost(None)
+
+
+def test_listen_raw_unix_without_lockfile(tmpdir):
+    path = str(tmpdir.join('raw.sock'))
+    port = handoff.listen_raw('unix:%s:lockfile=0' % (path,))
+    try:
+        assert not os.path.lexists(path + '.lock')
+    finally:
+        port.connectionLost(None)
+
+
+def test_listen_raw_unsupported():
+    assert handoff.listen_raw('ssl:443') is None
+
+
+def test_listen_shards():
+    ports = handoff.listen_shards('tcp:0:interface=127.0.0.1:shards=3')
+    try:
+        assert len(ports) == 3
+        [address] = set(port.socket.getsockname() for port in ports)
+        assert address[1] != 0
+        for port in ports:
+            assert port.socket.getsockopt(socket.SOL_SOCKET,
+                                          socket.SO_REUSEPORT)
+        # the kernel spreads connections across all of them
+        clients = [socket.create_connection(address) for _ in range(30)]
+        accepted = 0
+        for port in ports:
+            port.socket.setblocking(False)
+            while True:
+                try:
+                    port.socket.accept()[0].close()
+                except socket.error:
+                    break
+                accepted += 1
+        assert accepted == len(clients)
+        for client in clients:
+            client.close()
+    finally:
+        for port in ports:
+            port.connectionLost(None)
+
+
+@pytest.mark.parametrize('description', [
+    'unix:shards.sock:shards=2',
+    'tcp:0:shards=0',
+])
+def test_listen_shards_fails(description):
+    with pytest.raises(ValueError):
+        handoff.listen_shards(description)
+
+
+@pytest.fixture
+def inherited():
+    # a listening socket whose descriptor stands in for one passed by
+    # a supervisor
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    yield sock.getsockname(), sock.detach()
+
+
+@pytest.mark.parametrize('description', [
+    'fd:%d', 'systemd:index=1', 'systemd:web', 'systemd:name=web'])
+def test_listen_raw_adopts(inherited, description):
+    address, fd = inherited
+    activated = [('admin', -1), ('web', fd)]
+    if '%d' in description:
+        description %= (fd,)
+    port = handoff.listen_raw(description, activated)
+    try:
+        assert port.socket.getsockname() == address
+        assert port.socket.family == socket.AF_INET
+        with pytest.raises(OSError):
+            os.fstat(fd)
+    finally:
+        port.connectionLost(None)
+
+
+@pytest.mark.parametrize('description', ['systemd:index=1', 'systemd:x'])
+def test_listen_raw_missing_activated_socket(description):
+    with pytest.raises(ValueError):
+        handoff.listen_raw(description, [('web', 3)])
+
+
+def test_listen_fds():
+    environ = {'LISTEN_PID': str(os.getpid()), 'LISTEN_FDS': '2',
+               'LISTEN_FDNAMES': 'web:admin', 'UNRELATED': 'x'}
+    assert common.listen_fds(environ) == [('web', 3), ('admin', 4)]
+    assert environ == {'UNRELATED': 'x'}
+
+
+@pytest.mark.parametrize('environ', [
+    {},
+    {'LISTEN_PID': '1', 'LISTEN_FDS': '1'},
+    {'LISTEN_PID': 'x', 'LISTEN_FDS': '1'},
+])
+def test_listen_fds_not_for_us(environ):
+    assert common.listen_fds(dict(environ)) == []
+
+
+# with no names at all, a lone socket is unknown too
+@pytest.mark.parametrize('fdnames', ['a:b', None])
+def test_listen_fds_mismatched_names(fdnames):
+    environ = {'LISTEN_PID': str(os.getpid()), 'LISTEN_FDS': '1'}
+    if fdnames is not None:
+        environ['LISTEN_FDNAMES'] = fdnames
+    assert common.listen_fds(environ, unset_environment=False) == [
+        ('unknown', 3)]
+    assert 'LISTEN_FDS' in environ
+
+
+def test_describe_fd():
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    try:
+        # the kernel reports the protocol the socket was created with
+        assert struct.unpack('iii', common.describe_fd(sock.fileno())) == (
+            socket.AF_INET6, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    finally:
+        sock.close()
+
+
+def test_listen_unread_never_touches_the_reactor():
+    reactor = MemoryReactor()
+    ports = []
+    handoff.listen_unread(
+        reactor, 'tcp:0:interface=127.0.0.1').addCallback(ports.append)
+    [port] = ports
+    try:
+        assert isinstance(port, handoff.UnreadPort)
+        assert not reactor.tcpServers
+        assert not reactor.getReaders()
+    finally:
+        port.connectionLost(None)
+
+
+@pytest.fixture
+def tcp_listener():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(16)
+    yield sock
+    sock.close()
+
+
+@pytest.fixture
+def dispatching(tcp_listener):
+    reactor = MemoryReactorClock()
+    port = FakePort(tcp_listener)
+    dispatcher = handoff.Dispatcher(reactor, [port], max_queued=2,
+                                    max_wait=10)
+    factory = handoff.HandoffFactory(
+        [('default', port, common.describe_socket(tcp_listener))],
+        dispatcher=dispatcher)
+    dispatcher.start()
+    pairs = []
+
+    def attach():
+        server, client = socket.socketpair()
+        pairs.append((server, client))
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(FakeTransport(server))
+        proto.dataReceived(common.DISPATCH_REQUEST)
+        return proto, client
+
+    yield reactor, dispatcher, attach
+    dispatcher.stop()
+    for server, client in pairs:
+        server.close()
+        client.close()
+
+
+def connect_and_accept(listener, reactor):
+    # a client connection, which the dispatcher accepts once the
+    # reactor says the listener's readable
+    client = socket.create_connection(listener.getsockname())
+    for reader in reactor.getReaders():
+        reader.doRead()
+    return client
+
+
+def received_peer(client):
+    received = receiver.receive_socket(client)
+    try:
+        return received.getpeername()
+    finally:
+        received.close()
+
+
+def test_dispatch_in_order(dispatching, tcp_listener):
+    reactor, dispatcher, attach = dispatching
+    # nobody's attached, so connections queue
+    clients = [connect_and_accept(tcp_listener, reactor) for _ in range(2)]
+    assert dispatcher.report()['queued'] == 2
+    first, first_client = attach()
+    second, second_client = attach()
+    # the oldest connection to whichever receiver was ready first
+    second.dataReceived(common.READY_BYTE)
+    first.dataReceived(common.READY_BYTE)
+    assert received_peer(second_client) == clients[0].getsockname()
+    assert received_peer(first_client) == clients[1].getsockname()
+    # and the next to whoever's still ready
+    first.dataReceived(common.READY_BYTE + common.READY_BYTE)
+    clients.append(connect_and_accept(tcp_listener, reactor))
+    assert received_peer(first_client) == clients[2].getsockname()
+    report = dispatcher.report()
+    assert (report['queued'], report['ready'], report['receivers'],
+            report['dispatched']) == (0, 1, 2, 3)
+    for client in clients:
+        client.close()
+
+
+def test_dispatch_full_queue_stops_reading(dispatching, tcp_listener):
+    reactor, dispatcher, attach = dispatching
+    clients = [connect_and_accept(tcp_listener, reactor) for _ in range(2)]
+    assert not reactor.getReaders()
+    assert not dispatcher.report()['reading']
+    # the third waits in the kernel's backlog
+    clients.append(socket.create_connection(tcp_listener.getsockname()))
+    proto, client = attach()
+    proto.dataReceived(common.READY_BYTE)
+    received_peer(client)
+    assert reactor.getReaders()
+    for reader in reactor.getReaders():
+        reader.doRead()
+    assert dispatcher.report()['queued'] == 2
+    for client in clients:
+        client.close()
+
+
+def test_dispatch_closes_connections_that_wait_too_long(dispatching,
+                                                        tcp_listener):
+    reactor, dispatcher, attach = dispatching
+    old = connect_and_accept(tcp_listener, reactor)
+    reactor.advance(6)
+    new = connect_and_accept(tcp_listener, reactor)
+    reactor.advance(4)
+    old.settimeout(1)
+    assert old.recv(1) == b''
+    report = dispatcher.report()
+    assert (report['queued'], report['expired']) == (1, 1)
+    assert report['oldest_wait'] == 4
+    proto, client = attach()
+    proto.dataReceived(common.READY_BYTE)
+    assert received_peer(client) == new.getsockname()
+    old.close()
+    new.close()
+
+
+def test_dispatch_forgets_receivers_that_leave(dispatching, tcp_listener):
+    reactor, dispatcher, attach = dispatching
+    gone, _ = attach()
+    gone.dataReceived(common.READY_BYTE * 3)
+    gone.connectionLost(None)
+    staying, client = attach()
+    staying.dataReceived(common.READY_BYTE)
+    connection = connect_and_accept(tcp_listener, reactor)
+    assert received_peer(client) == connection.getsockname()
+    assert dispatcher.report()['receivers'] == 1
+    connection.close()
+
+
+def test_dispatch_unready_lets_the_receiver_go(dispatching, tcp_listener):
+    reactor, dispatcher, attach = dispatching
+    leaving, _ = attach()
+    leaving.dataReceived(common.READY_BYTE + common.UNREADY_BYTE +
+                         common.READY_BYTE)
+    assert leaving.transport.lost
+    report = dispatcher.report()
+    assert (report['ready'], report['receivers']) == (0, 0)
+    # so the next connection waits for someone else
+    connection = connect_and_accept(tcp_listener, reactor)
+    assert dispatcher.report()['queued'] == 1
+    connection.close()
+
+
+@pytest.mark.parametrize('request_bytes', [
+    common.READY_BYTE, common.version_request()])
+def test_dispatch_refuses_listener_handoffs(dispatching, request_bytes):
+    reactor, dispatcher, attach = dispatching
+    proto, _ = attach()
+    factory = proto.factory
+    server, client = socket.socketpair()
+    try:
+        other = factory.buildProtocol(None)
+        other.makeConnection(FakeTransport(server))
+        other.dataReceived(request_bytes)
+        assert other.transport.lost
+        assert factory.stats.handoffs == 0
+    finally:
+        server.close()
+        client.close()
+
+
+def test_dispatch_request_without_dispatcher(connected):
+    proto, client = connected
+    proto.dataReceived(common.DISPATCH_REQUEST)
+    assert proto.transport.lost
+
+
+def test_dispatch_garbage_drops_the_receiver(dispatching):
+    reactor, dispatcher, attach = dispatching
+    proto, _ = attach()
+    proto.dataReceived(b'x')
+    assert proto.transport.lost
@@ -0,0 +1,416 @@
+import socket
+
+from wip.lazy import types as t
+from wip.common import (headers_to_bytes,
+                        headers_to_native_strings,
+                        url_unquote)
+from wip.receiver import WSGIRequestProcessor
+
+
+MAX_LINE = 8192
+MAX_HEADERS = 100
+MAX_DRAIN = 64 * 1024
+KEEPALIVE_TIMEOUT = 5.0
+
+_CRLF = b'\r\n'
+_LAST_CHUNK = b'0\r\n\r\n'
+_CONTINUE = b'HTTP/1.1 100 Continue\r\n\r\n'
+_BAD_REQUEST = (b'HTTP/1.1 400 Bad Request\r\n'
+                b'Content-Length: 0\r\n'
+                b'Connection: close\r\n'
+                b'\r\n')
+_SPECIAL_HEADERS = frozenset(['CONTENT_TYPE', 'CONTENT_LENGTH'])
+_HEX_DIGITS = b'0123456789abcdefABCDEF'
+
+
+def _is_blank(line):
+    return line in (b'\r\n', b'\n')
+
+
+def read_request_line(f):
+    line = f.readline(MAX_LINE)
+    # RFC 7230 section 3.5: ignore an empty line before the request line
+    if _is_blank(line):
+        line = f.readline(MAX_LINE)
+    if not line:
+        return None
+    if not line.endswith(b'\n'):
+        raise RuntimeError()
+    parts = line.rstrip(b'\r\n').split(b' ')
+    if len(parts) != 3 or not all(parts):
+        raise RuntimeError()
+    method, uri, version = headers_to_native_strings(parts)
+    if version not in ('HTTP/1.0', 'HTTP/1.1'):
+        raise RuntimeError()
+    return method, uri, version
+
+
+def read_http_headers(f):
+    headers = []
+    while True:
+        line = f.readline(MAX_LINE)
+        if not line.endswith(b'\n'):
+            raise RuntimeError()
+        if _is_blank(line):
+            break
+        # obsolete line folding (RFC 7230 section 3.2.4) is rejected
+        if len(headers) == MAX_HEADERS or line[:1] in (b' ', b'\t'):
+            raise RuntimeError()
+        name, sep, value = line.partition(b':')
+        if not sep or not name or name != name.strip():
+            raise RuntimeError()
+        headers.extend((name, value.strip()))
+    headers = headers_to_native_strings(headers)
+    return list(zip(*[iter(headers)] * 2))
+
+
+def read_request(f):
+    with t.HTTP_PARSE():
+        request_line = read_request_line(f)
+        if request_line is None:
+            return None
+        return request_line, read_http_headers(f)
+
+
+def _tokens(value):
+    return [token.strip().lower() for token in value.split(',')]
+
+
+class BadBody(RuntimeError):
+    # a request body that ended early or was framed wrong; the client's
+    # fault, so it costs only its connection
+    pass
+
+
+class _BodyReader(object):
+    # a request body as a file.  subclasses do the framing: _available()
+    # says how much can be read before the next framing, reading it if
+    # need be, and _consume(amount) is told how much was.
+
+    def __init__(self, instream, on_first_read=None):
+        self._instream = instream
+        self._on_first_read = on_first_read
+
+    def _started(self):
+        if self._on_first_read is not None:
+            on_first_read, self._on_first_read = self._on_first_read, None
+            on_first_read()
+
+    def read(self, size=-1):
+        self._started()
+        if size is None:
+            size = -1
+        chunks = []
+        while size:
+            available = self._available()
+            if not available:
+                break
+            amount = available if size < 0 else min(size, available)
+            data = self._instream.read(amount)
+            if len(data) < amount:
+                raise BadBody()
+            self._consume(amount)
+            chunks.append(data)
+            if size > 0:
+                size -= amount
+        return b''.join(chunks)
+
+    def readline(self, size=-1):
+        self._started()
+        if size is None:
+            size = -1
+        chunks = []
+        while size:
+            available = self._available()
+            if not available:
+                break
+            amount = available if size < 0 else min(size, available)
+            data = self._instream.readline(amount)
+            if not data:
+                raise BadBody()
+            self._consume(len(data))
+            chunks.append(data)
+            if data.endswith(b'\n'):
+                break
+            if size > 0:
+                size -= len(data)
+        return b''.join(chunks)
+
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if 0 < hint <= total:
+                break
+        return lines
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def drain(self, limit):
+        # discard whatever the application left unread, so the next
+        # pipelined request can be parsed.  bodies larger than limit
+        # aren't worth reading; the connection is closed instead.
+        self._on_first_read = None
+        while limit > 0:
+            data = self.read(min(limit, MAX_LINE))
+            if not data:
+                return True
+            limit -= len(data)
+        return not self._available()
+
+
+class LengthReader(_BodyReader):
+
+    def __init__(self, instream, length, on_first_read=None):
+        super(LengthReader, self).__init__(instream, on_first_read)
+        self._remaining = length
+
+    def _available(self):
+        return self._remaining
+
+    def _consume(self, amount):
+        self._remaining -= amount
+
+
+class ChunkedReader(_BodyReader):
+
+    def __init__(self, instream, on_first_read=None):
+        super(ChunkedReader, self).__init__(instream, on_first_read)
+        self._chunk_remaining = 0
+        self._done = False
+
+    def _next_chunk(self):
+        line = self._instream.readline(MAX_LINE)
+        if not line.endswith(b'\n'):
+            raise BadBody()
+        # chunk extensions are ignored.  int() alone would also take
+        # signs, underscores and 0x, which nothing upstream agrees on.
+        size = line.split(b';', 1)[0].strip()
+        if not size or size.strip(_HEX_DIGITS):
+            raise BadBody()
+        self._chunk_remaining = int(size, 16)
+        if not self._chunk_remaining:
+            # trailers are discarded
+            try:
+                read_http_headers(self._instream)
+            except RuntimeError:
+                raise BadBody()
+            self._done = True
+
+    def _available(self):
+        if not (self._done or self._chunk_remaining):
+            self._next_chunk()
+        return self._chunk_remaining
+
+    def _consume(self, amount):
+        self._chunk_remaining -= amount
+        if not self._chunk_remaining:
+            if not _is_blank(self._instream.readline(MAX_LINE)):
+                raise BadBody()
+
+
+def address_environ(sock):
+    if sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return {'SERVER_NAME': 'localhost', 'SERVER_PORT': '0'}
+    server, client = sock.getsockname(), sock.getpeername()
+    return {'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1])}
+
+
+class HTTPRequestProcessor(WSGIRequestProcessor):
+    half_close_is_hangup = False
+
+    @classmethod
+    def from_sock(cls, sock, keepalive_timeout=KEEPALIVE_TIMEOUT):
+        # bounds both how long an idle keep-alive connection holds
+        # this worker and how long a single read or write may stall.
+        sock.settimeout(keepalive_timeout)
+        return cls(sock.makefile('rb'), sock.makefile('wb'),
+                   base_environ=address_environ(sock), peer=sock)
+
+    def __init__(self, instream, outstream, base_environ=None, peer=None):
+        super(HTTPRequestProcessor, self).__init__(instream, outstream, peer)
+        self._base_environ = base_environ or {}
+        self._reset()
+
+    def _reset(self):
+        self._headers = None
+        self._headers_sent = False
+        self._version = 'HTTP/1.1'
+        self._method = None
+        self._request_keep_alive = False
+        self._keep_alive = False
+        self._chunked = False
+        self._bodyless = False
+        self._body = None
+        self._content_length = None
+        self._body_written = 0
+        # the client sent Expect: 100-continue and hasn't been answered
+        self._expecting = False
+
+    def _send_continue(self):
+        if not self._headers_sent:
+            self._outstream.write(_CONTINUE)
+            self._outstream.flush()
+            self._expecting = False
+
+    def _body_reader(self, environ):
+        on_first_read = None
+        if (self._version == 'HTTP/1.1' and
+                environ.get('HTTP_EXPECT', '').lower() == '100-continue'):
+            on_first_read = self._send_continue
+            self._expecting = True
+
+        transfer_encoding = environ.get('HTTP_TRANSFER_ENCODING')
+        if transfer_encoding is not None:
+            # RFC 7230 section 3.3.3: a message with both is an
+            # attempt at request smuggling.
+            if (_tokens(transfer_encoding)[-1] != 'chunked' or
+                    'CONTENT_LENGTH' in environ):
+                raise RuntimeError()
+            return ChunkedReader(self._instream, on_first_read)
+
+        content_length = environ.get('CONTENT_LENGTH', '0')
+        if not content_length.isdigit():
+            raise RuntimeError()
+        return LengthReader(self._instream, int(content_length),
+                            on_first_read)
+
+    def _determine_environment(self, _read_request=read_request):
+        request = _read_request(self._instream)
+        if request is None:
+            return None
+        (method, uri, version), headers = request
+        self._method, self._version = method, version
+
+        environ = dict(self._base_environ)
+        environ.update(REQUEST_METHOD=method,
+                       REQUEST_URI=uri,
+                       SERVER_PROTOCOL=version)
+        for name, value in headers:
+            key = name.upper().replace('-', '_')
+            if key not in _SPECIAL_HEADERS:
+                key = 'HTTP_' + key
+            if key in environ:
+                environ[key] += ',' + value
+            else:
+                environ[key] = value
+
+        connection = _tokens(environ.get('HTTP_CONNECTION', ''))
+        if version == 'HTTP/1.1':
+            self._request_keep_alive = 'close' not in connection
+        else:
+            self._request_keep_alive = 'keep-alive' in connection
+
+        self._body = self._body_reader(environ)
+        environ = self._populate_environment(environ, self._body)
+        environ['PATH_INFO'] = url_unquote(environ['PATH_INFO'])
+        return environ
+
+    def _format_headers(self, status, response_headers):
+        names = set(name.lower() for name, _ in response_headers)
+        self._keep_alive = self._request_keep_alive
+        code = status[:3]
+        self._bodyless = (self._method == 'HEAD' or
+                          code in ('204', '304') or
+                          code.startswith('1'))
+        for name, value in response_headers:
+            name = name.lower()
+            if name == 'connection' and 'close' in _tokens(value):
+                self._keep_alive = False
+            elif (name == 'content-length' and not self._bodyless and
+                    value.strip().isdigit()):
+                self._content_length = int(value)
+        self._chunked = False
+        extra = []
+        if 'content-length' not in names and not self._bodyless:
+            if self._version == 'HTTP/1.1':
+                self._chunked = True
+                extra.append(('Transfer-Encoding', 'chunked'))
+            else:
+                # the end of the body is only marked by closing
+                self._keep_alive = False
+        if 'connection' not in names:
+            if not self._keep_alive:
+                extra.append(('Connection', 'close'))
+            elif self._version == 'HTTP/1.0':
+                extra.append(('Connection', 'keep-alive'))
+
+        headers = 'HTTP/1.1 %s\r\n%s\r\n' % (
+            status,
+            ''.join('%s: %s\r\n' % header
+                    for header in list(response_headers) + extra))
+        return headers_to_bytes(headers)
+
+    def _write(self, data):
+        self._body_written += len(data)
+        if self._bodyless:
+            data = b''
+        elif data and self._chunked:
+            data = b''.join([('%x\r\n' % len(data)).encode('ascii'),
+                             data,
+                             _CRLF])
+        super(HTTPRequestProcessor, self)._write(data)
+
+    def _finish_response(self):
+        super(HTTPRequestProcessor, self)._finish_response()
+        if self._chunked:
+            self._outstream.write(_LAST_CHUNK)
+            self._outstream.flush()
+            self._bytes_written += len(_LAST_CHUNK)
+
+    def _bad_request(self):
+        try:
+            self._outstream.write(_BAD_REQUEST)
+            self._outstream.flush()
+        except socket.error:
+            pass
+
+    def run_app(self, app):
+        while True:
+            self._reset()
+            try:
+                environ = self._determine_environment()
+            except socket.error:
+                # includes an idle keep-alive connection timing out
+                return
+            except RuntimeError:
+                self._bad_request()
+                return
+            if environ is None:
+                return
+            try:
+                responded = self._respond(app, environ)
+            except BadBody:
+                if not self._headers_sent:
+                    self._bad_request()
+                return
+            except socket.timeout:
+                # a client that stalls sending its body or reading the
+                # response is as good as gone
+                t.CLIENT_GONE().write()
+                return
+            if not responded:
+                # the response was abandoned part way through
+                return
+            if (self._content_length is not None and
+                    self._body_written < self._content_length):
+                # the client is still waiting for the rest of the body,
+                # and only closing tells it there's no more
+                return
+            if self._expecting:
+                # the client may or may not send the body it was never
+                # asked for, so there's no telling where the next
+                # request starts
+                return
+            try:
+                reusable = self._keep_alive and self._body.drain(MAX_DRAIN)
+            except (RuntimeError, socket.error):
+                return
+            if not reusable:
+                return
@@ -0,0 +1,350 @@
+import io
+import select
+import socket
+
+from eliot.testing import LoggedAction
+import pytest
+
+from wip import http11, types
+
+
+@pytest.mark.parametrize('request_line,parsed', [
+    (b'GET / HTTP/1.1\r\n', ('GET', '/', 'HTTP/1.1')),
+    (b'\r\nPOST /x?y=1 HTTP/1.0\r\n', ('POST', '/x?y=1', 'HTTP/1.0')),
+    (b'', None),
+])
+def test_read_request_line_succeeds(request_line, parsed):
+    assert http11.read_request_line(io.BytesIO(request_line)) == parsed
+
+
+@pytest.mark.parametrize('bad_request_line', [
+    b'GET / HTTP/1.1',
+    b'GET /  HTTP/1.1\r\n',
+    b'GET / HTTP/2.0\r\n',
+    b'GET /\r\n',
+    b'GET /' + b'x' * http11.MAX_LINE + b' HTTP/1.1\r\n',
+])
+def test_read_request_line_fails(bad_request_line):
+    with pytest.raises(RuntimeError):
+        http11.read_request_line(io.BytesIO(bad_request_line))
+
+
+def test_read_http_headers_succeeds():
+    headers = io.BytesIO(b'Host: example.com\r\n'
+                         b'X-Spaces:   padded  \r\n'
+                         b'\r\n'
+                         b'body')
+    assert http11.read_http_headers(headers) == [
+        ('Host', 'example.com'),
+        ('X-Spaces', 'padded')]
+    assert headers.read() == b'body'
+
+
+@pytest.mark.parametrize('bad_headers', [
+    b'Host: example.com\r\n',
+    b'No-Colon\r\n\r\n',
+    b'Host : example.com\r\n\r\n',
+    b'Host: example.com\r\n folded\r\n\r\n',
+    b'X: y\r\n' * (http11.MAX_HEADERS + 1) + b'\r\n',
+])
+def test_read_http_headers_fails(bad_headers):
+    with pytest.raises(RuntimeError):
+        http11.read_http_headers(io.BytesIO(bad_headers))
+
+
+def test_read_request_logs(capture_logging):
+    with capture_logging() as logger:
+        http11.read_request(io.BytesIO(b'GET / HTTP/1.1\r\n\r\n'))
+
+    actions = LoggedAction.ofType(logger.messages, types.HTTP_PARSE)
+    assert actions and actions[0].succeeded
+
+
+_CHUNKED = (b'4\r\nWiki\r\n'
+            b'5;ext=1\r\npedia\r\n'
+            b'0\r\nTrailer: ignored\r\n\r\n'
+            b'next')
+
+
+def test_chunked_reader_read():
+    instream = io.BytesIO(_CHUNKED)
+    reader = http11.ChunkedReader(instream)
+    assert reader.read(2) == b'Wi'
+    assert reader.read() == b'kipedia'
+    assert reader.read() == b''
+    assert instream.read() == b'next'
+
+
+def test_chunked_reader_readline():
+    reader = http11.ChunkedReader(
+        io.BytesIO(b'3\r\nab\n\r\n3\r\ncd\n\r\n0\r\n\r\n'))
+    assert list(reader) == [b'ab\n', b'cd\n']
+
+
+@pytest.mark.parametrize('bad_chunked', [
+    b'x\r\n',
+    b'-1\r\n',
+    b'-0\r\n\r\n',
+    b'+4\r\nWiki\r\n0\r\n\r\n',
+    b'0x4\r\nWiki\r\n0\r\n\r\n',
+    b'0_4\r\nWiki\r\n0\r\n\r\n',
+    b';ext\r\n',
+    b'4\r\nWikiX\r\n',
+    b'4\r\nWi',
+])
+def test_chunked_reader_fails(bad_chunked):
+    with pytest.raises(RuntimeError):
+        http11.ChunkedReader(io.BytesIO(bad_chunked)).read()
+
+
+def test_chunked_reader_sizes():
+    reader = http11.ChunkedReader(
+        io.BytesIO(b'A ;name=value\r\n0123456789\r\n'
+                   b'000b\r\n0123456789a\r\n0\r\n\r\n'))
+    assert reader.read() == b'01234567890123456789a'
+
+
+def test_length_reader_stops_at_length():
+    instream = io.BytesIO(b'line one\nline two\nnext')
+    reader = http11.LengthReader(instream, 18)
+    assert reader.readlines() == [b'line one\n', b'line two\n']
+    assert instream.read() == b'next'
+
+
+def test_length_reader_premature_eof():
+    with pytest.raises(http11.BadBody):
+        http11.LengthReader(io.BytesIO(b'short'), 10).read()
+
+
+def echo_app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    headers = [('Content-Type', 'text/plain')]
+    if environ['PATH_INFO'] == '/sized':
+        headers.append(('Content-Length', str(len(body))))
+    start_response('200 OK', headers)
+    return [body]
+
+
+def run(raw_request, app=echo_app):
+    outstream = io.BytesIO()
+    processor = http11.HTTPRequestProcessor(io.BytesIO(raw_request),
+                                            outstream)
+    processor.run_app(app)
+    return outstream.getvalue()
+
+
+def test_pipelined_keep_alive(capture_logging):
+    with capture_logging():
+        response = run(b'POST /sized HTTP/1.1\r\n'
+                       b'Content-Length: 5\r\n'
+                       b'\r\n'
+                       b'hello'
+                       b'POST /chunked%20path HTTP/1.1\r\n'
+                       b'Transfer-Encoding: chunked\r\n'
+                       b'Connection: close\r\n'
+                       b'\r\n'
+                       b'5\r\nworld\r\n0\r\n\r\n')
+
+    assert response == (b'HTTP/1.1 200 OK\r\n'
+                        b'Content-Type: text/plain\r\n'
+                        b'Content-Length: 5\r\n'
+                        b'\r\n'
+                        b'hello'
+                        b'HTTP/1.1 200 OK\r\n'
+                        b'Content-Type: text/plain\r\n'
+                        b'Transfer-Encoding: chunked\r\n'
+                        b'Connection: close\r\n'
+                        b'\r\n'
+                        b'5\r\nworld\r\n'
+                        b'0\r\n\r\n')
+
+
+def test_http_1_0_closes_without_length(capture_logging):
+    with capture_logging():
+        response = run(b'GET / HTTP/1.0\r\n\r\n'
+                       b'GET / HTTP/1.0\r\n\r\n')
+
+    assert response == (b'HTTP/1.1 200 OK\r\n'
+                        b'Content-Type: text/plain\r\n'
+                        b'Connection: close\r\n'
+                        b'\r\n')
+
+
+def test_unread_body_is_drained(capture_logging):
+    def ignores_body(environ, start_response):
+        start_response('204 No Content', [])
+        return []
+
+    with capture_logging():
+        response = run(b'POST / HTTP/1.1\r\n'
+                       b'Content-Length: 3\r\n'
+                       b'\r\n'
+                       b'abc'
+                       b'HEAD / HTTP/1.1\r\n'
+                       b'\r\n', ignores_body)
+
+    assert response == b'HTTP/1.1 204 No Content\r\n\r\n' * 2
+
+
+def test_expect_continue(capture_logging):
+    with capture_logging():
+        response = run(b'POST /sized HTTP/1.1\r\n'
+                       b'Expect: 100-continue\r\n'
+                       b'Content-Length: 2\r\n'
+                       b'Connection: close\r\n'
+                       b'\r\n'
+                       b'hi')
+
+    assert response.startswith(b'HTTP/1.1 100 Continue\r\n\r\n'
+                               b'HTTP/1.1 200 OK\r\n')
+    assert response.endswith(b'\r\n\r\nhi')
+
+
+def test_unanswered_expect_closes_connection(capture_logging):
+    def ignores_body(environ, start_response):
+        start_response('403 Forbidden', [('Content-Length', '0')])
+        return []
+
+    with capture_logging():
+        response = run(b'POST / HTTP/1.1\r\n'
+                       b'Expect: 100-continue\r\n'
+                       b'Content-Length: 5\r\n'
+                       b'\r\n'
+                       # the client decided against sending its body
+                       b'GET / HTTP/1.1\r\n\r\n', ignores_body)
+
+    assert response == (b'HTTP/1.1 403 Forbidden\r\n'
+                        b'Content-Length: 0\r\n'
+                        b'\r\n')
+
+
+@pytest.mark.parametrize('bad_request', [
+    b'GET / HTTP/1.1\r\n'
+    b'Content-Length: 1\r\n'
+    b'Transfer-Encoding: chunked\r\n'
+    b'\r\n',
+    b'GET / HTTP/1.1\r\n'
+    b'Content-Length: nope\r\n'
+    b'\r\n',
+    b'garbage\r\n\r\n',
+])
+def test_bad_request(capture_logging, bad_request):
+    def never_called(environ, start_response):
+        raise AssertionError()
+
+    with capture_logging():
+        response = run(bad_request, never_called)
+
+    assert response.startswith(b'HTTP/1.1 400 Bad Request\r\n')
+
+
+def test_abandoned_response_closes_connection(capture_logging):
+    class HungUp(http11.HTTPRequestProcessor):
+        def _client_gone(self):
+            return True
+
+    def streams(environ, start_response):
+        start_response('200 OK', [])
+        while True:
+            yield b'x'
+
+    outstream = io.BytesIO()
+    processor = HungUp(io.BytesIO(b'GET / HTTP/1.1\r\n\r\n' * 2), outstream)
+    with capture_logging():
+        processor.run_app(streams)
+
+    # one unterminated chunk, and the second request is never answered
+    assert outstream.getvalue() == (b'HTTP/1.1 200 OK\r\n'
+                                    b'Transfer-Encoding: chunked\r\n'
+                                    b'\r\n'
+                                    b'1\r\nx\r\n')
+
+
+def test_short_response_closes_connection(capture_logging):
+    def falls_short(environ, start_response):
+        start_response('200 OK', [('Content-Length', '5')])
+        return [b'abc']
+
+    with capture_logging():
+        response = run(b'GET / HTTP/1.1\r\n\r\n' * 2, falls_short)
+
+    # the second response would be read as the rest of the first
+    assert response == (b'HTTP/1.1 200 OK\r\n'
+                        b'Content-Length: 5\r\n'
+                        b'\r\n'
+                        b'abc')
+
+
+def test_half_closed_client_still_gets_its_response(capture_logging):
+    listener = socket.socket()
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.create_connection(listener.getsockname())
+        server, _ = listener.accept()
+    finally:
+        listener.close()
+
+    def streams(environ, start_response):
+        start_response('200 OK', [])
+        for _ in range(3):
+            yield b'x'
+
+    try:
+        # done sending, but still listening
+        client.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        client.shutdown(socket.SHUT_WR)
+        select.select([server], [], [], 5)
+        processor = http11.HTTPRequestProcessor.from_sock(server)
+        with capture_logging() as logger:
+            processor.run_app(streams)
+        server.shutdown(socket.SHUT_RDWR)
+        client.settimeout(5)
+        assert client.makefile('rb').read().endswith(b'\r\n\r\nxxx')
+    finally:
+        server.close()
+        client.close()
+    assert not [message for message in logger.messages
+                if message.get('message_type') == 'wip:client_gone']
+
+
+def test_short_body_is_a_bad_request(capture_logging):
+    with capture_logging():
+        response = run(b'POST / HTTP/1.1\r\n'
+                       b'Content-Length: 100\r\n'
+                       b'\r\n'
+                       b'abc')
+    assert response.startswith(b'HTTP/1.1 400 Bad Request\r\n')
+
+
+def test_short_body_after_the_headers_closes(capture_logging):
+    def reads_late(environ, start_response):
+        write = start_response('200 OK', [])
+        write(b'started')
+        yield environ['wsgi.input'].read()
+
+    with capture_logging():
+        response = run(b'POST / HTTP/1.1\r\n'
+                       b'Transfer-Encoding: chunked\r\n'
+                       b'\r\n'
+                       b'zz\r\n', reads_late)
+    assert response.startswith(b'HTTP/1.1 200 OK\r\n')
+    assert b'400' not in response
+
+
+def test_stalled_upload_is_a_client_gone(capture_logging):
+    server, client = socket.socketpair()
+    try:
+        client.sendall(b'POST / HTTP/1.1\r\n'
+                       b'Content-Length: 100\r\n'
+                       b'\r\n'
+                       b'abc')
+        processor = http11.HTTPRequestProcessor.from_sock(
+            server, keepalive_timeout=0.1)
+        with capture_logging() as logger:
+            processor.run_app(echo_app)
+    finally:
+        server.close()
+        client.close()
+    assert [message for message in logger.messages
+            if message.get('message_type') == 'wip:client_gone']
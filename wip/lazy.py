@@ -0,0 +1,52 @@
+class _NullAction(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add_success_fields(self, **fields):
+        pass
+
+    def write(self, *args, **kwargs):
+        pass
+
+
+_NULL_ACTION = _NullAction()
+
+
+def _null_type(**fields):
+    return _NULL_ACTION
+
+
+class LazyTypes(object):
+    # stands in for wip.types, so that eliot is imported the first time
+    # a message or action is written rather than at startup, and never
+    # if logging is disabled
+
+    def __init__(self):
+        self._enabled = True
+
+    def disable_logging(self):
+        self._enabled = False
+        # forget anything resolved so far; it's only a cache
+        for name in list(vars(self)):
+            if name != '_enabled':
+                delattr(self, name)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._enabled:
+            from wip import types
+            value = getattr(types, name)
+        else:
+            value = _null_type
+        # cached as an instance attribute, so __getattr__ only runs once
+        # per name
+        setattr(self, name, value)
+        return value
+
+
+types = LazyTypes()
@@ -0,0 +1,30 @@
+import subprocess
+import sys
+
+from wip import lazy, types
+
+
+def test_lazy_types_resolve_to_wip_types():
+    lazy_types = lazy.LazyTypes()
+    assert lazy_types.SCGI_PARSE is types.SCGI_PARSE
+
+
+def test_disabled_logging_writes_nothing(capture_logging):
+    lazy_types = lazy.LazyTypes()
+    lazy_types.SCGI_ACCEPTED
+    lazy_types.disable_logging()
+    with capture_logging() as logger:
+        with lazy_types.HANDOFF(path='x') as action:
+            action.add_success_fields(family=1)
+        lazy_types.SCGI_ACCEPTED().write()
+    assert not logger.messages
+
+
+def test_receiver_imports_no_heavy_dependencies():
+    # a fresh interpreter, since this one has them all loaded already
+    imported = subprocess.check_output([
+        sys.executable, '-c',
+        'import sys, wip.receiver, wip.http11, wip.uwsgi, wip.fastcgi; '
+        'print(" ".join(sys.modules))']).decode('ascii').split()
+    heavy = set(['eliot', 'twisted', 'six', 'paste.lint'])
+    assert not heavy.intersection(imported)
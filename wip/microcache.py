@@ -0,0 +1,323 @@
+import collections
+import struct
+import threading
+import time
+
+from wip.common import headers_to_bytes, headers_to_native_strings
+
+
+DEFAULT_STORE_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_ENTRY_BYTES = 1024 * 1024
+DEFAULT_LOCK_TIMEOUT = 5.0
+
+_CACHEABLE_METHODS = frozenset(['GET', 'HEAD'])
+_CACHEABLE_STATUSES = frozenset([200, 203, 204, 300, 301, 404, 410])
+_UNCACHEABLE_DIRECTIVES = frozenset(['no-store', 'no-cache', 'private'])
+# when it was stored, then the length of the status line and headers
+_ENTRY_HEADER = struct.Struct('!dI')
+
+
+def encode_entry(created, status, response_headers, body):
+    head = headers_to_bytes('%s\r\n%s' % (
+        status,
+        ''.join('%s: %s\r\n' % header for header in response_headers)))
+    return b''.join([_ENTRY_HEADER.pack(created, len(head)), head, body])
+
+
+def decode_entry(entry):
+    # (created, status, response_headers, body)
+    created, head_length = _ENTRY_HEADER.unpack_from(entry)
+    head_end = _ENTRY_HEADER.size + head_length
+    [head] = headers_to_native_strings([bytes(entry[_ENTRY_HEADER.size:
+                                                    head_end])])
+    lines = head.split('\r\n')
+    response_headers = [tuple(line.split(': ', 1)) for line in lines[1:-1]]
+    return created, lines[0], response_headers, entry[head_end:]
+
+
+class MemoryStore(object):
+    # a thread safe LRU of encoded entries, bounded by their total size,
+    # whose entries also expire
+
+    def __init__(self, max_bytes=DEFAULT_STORE_BYTES, seconds=time.time):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._seconds = seconds
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        _, value = self._entries.pop(key)
+        self.size -= len(value)
+
+    def get(self, key):
+        with self._lock:
+            found = self._entries.pop(key, None)
+            if found is None:
+                return None
+            expires, value = found
+            if expires <= self._seconds():
+                self.size -= len(value)
+                return None
+            self._entries[key] = found
+            return value
+
+    def put(self, key, value, ttl):
+        if len(value) > self.max_bytes:
+            return
+        now = self._seconds()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (now + ttl, value)
+            self.size += len(value)
+            if self.size <= self.max_bytes:
+                return
+            # expired entries go first, then the least recently used
+            for stale, (expires, _) in list(self._entries.items()):
+                if expires <= now:
+                    self._remove(stale)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+
+def _cache_control(value):
+    directives = {}
+    for directive in value.split(','):
+        name, _, argument = directive.partition('=')
+        name = name.strip().lower()
+        if name:
+            directives[name] = argument.strip().strip('"')
+    return directives
+
+
+class _Flight(object):
+    # one application call that concurrent misses for a key wait on
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+
+
+class MicroCache(object):
+    # WSGI middleware that answers repeated GET and HEAD requests from
+    # store for as long as the response's Cache-Control max-age allows,
+    # or ttl seconds if it doesn't say.  requests are keyed on the
+    # method, path, query string and the request headers named in vary.
+    # concurrent misses for the same key wait, up to lock_timeout, for
+    # the first one to finish instead of all calling the application.
+    #
+    # with zero_copy, hits from a store with get_view are sent straight
+    # from the store's memory as memoryviews, rather than as the bytes
+    # pep 3333 asks for.
+
+    def __init__(self, app, store=None, ttl=0, vary=(),
+                 max_entry_bytes=DEFAULT_MAX_ENTRY_BYTES,
+                 lock_timeout=DEFAULT_LOCK_TIMEOUT, zero_copy=False,
+                 seconds=time.time):
+        self.app = app
+        self.store = MemoryStore(seconds=seconds) if store is None else store
+        self.ttl = ttl
+        self.vary = [name.lower() for name in vary]
+        self._vary_keys = ['HTTP_' + name.upper().replace('-', '_')
+                           for name in vary]
+        self.max_entry_bytes = max_entry_bytes
+        self.lock_timeout = lock_timeout
+        self._get_view = (getattr(self.store, 'get_view', None)
+                          if zero_copy else None)
+        self._seconds = seconds
+        self.stats = collections.Counter()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _key(self, environ):
+        parts = [environ['REQUEST_METHOD'],
+                 environ.get('SCRIPT_NAME', ''),
+                 environ.get('PATH_INFO', ''),
+                 environ.get('QUERY_STRING', '')]
+        parts.extend(environ.get(key, '') for key in self._vary_keys)
+        return headers_to_bytes('\0'.join(parts))
+
+    def _ttl(self, status, response_headers):
+        # how long a response may be cached, or None if it mustn't be
+        if int(status.split(None, 1)[0]) not in _CACHEABLE_STATUSES:
+            return None
+        ttl = self.ttl
+        for name, value in response_headers:
+            name = name.lower()
+            if name == 'set-cookie':
+                return None
+            elif name == 'vary':
+                varies = set(header.strip().lower()
+                             for header in value.split(','))
+                # responses that vary on anything not in the key can't
+                # be told apart
+                if not varies.issubset(self.vary):
+                    return None
+            elif name == 'cache-control':
+                directives = _cache_control(value)
+                if _UNCACHEABLE_DIRECTIVES.intersection(directives):
+                    return None
+                max_age = directives.get('s-maxage',
+                                         directives.get('max-age'))
+                if max_age is not None:
+                    try:
+                        ttl = int(max_age)
+                    except ValueError:
+                        return None
+        return ttl if ttl > 0 else None
+
+    def __call__(self, environ, start_response):
+        if (environ['REQUEST_METHOD'] not in _CACHEABLE_METHODS or
+                'HTTP_AUTHORIZATION' in environ):
+            self._count('bypass')
+            return self.app(environ, start_response)
+
+        key = self._key(environ)
+        if self._get_view is not None:
+            found = self._get_view(key)
+            if found is not None:
+                self._count('hits')
+                return self._replay_view(found, environ, start_response)
+            entry = None
+        else:
+            entry = self.store.get(key)
+        if entry is None:
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+            if leader:
+                return self._fill(environ, start_response, key, flight)
+            flight.done.wait(self.lock_timeout)
+            entry = flight.entry
+            if entry is None:
+                # the response couldn't be cached, or took too long
+                self._count('coalesce_failed')
+                return self.app(environ, start_response)
+            self._count('coalesced')
+        else:
+            self._count('hits')
+        return self._replay(entry, start_response)
+
+    def _replay(self, entry, start_response):
+        created, status, response_headers, body = decode_entry(entry)
+        age = max(0, int(self._seconds() - created))
+        start_response(status, response_headers + [('Age', str(age))])
+        return [bytes(body)]
+
+    def _replay_view(self, found, environ, start_response):
+        entry, intact = found
+        # the status and headers are copied out here ...
+        created, status, response_headers, body = decode_entry(entry)
+        if not intact():
+            # ... so they must not have been overwritten meanwhile
+            self._count('torn')
+            return self(environ, start_response)
+        age = max(0, int(self._seconds() - created))
+        response_headers = response_headers + [('Age', str(age))]
+        if (environ['REQUEST_METHOD'] != 'HEAD' and
+                not any(name.lower() == 'content-length'
+                        for name, _ in response_headers)):
+            # so a body cut short by _send_view is seen to be
+            response_headers.append(('Content-Length', str(len(body))))
+        start_response(status, response_headers)
+        return self._send_view(body, intact)
+
+    def _send_view(self, body, intact):
+        # the body can be overwritten while it's being sent, and by then
+        # it's too late to fall back to a miss.  hold back a copy of the
+        # last byte until it's known that it wasn't, and end the body
+        # short of its Content-Length if it was, so the server drops
+        # the connection and the client sees it cut short.
+        last = body[-1:].tobytes()
+        if len(body) > 1:
+            yield body[:-1]
+        if not intact():
+            self._count('torn')
+            return
+        yield last
+
+    def _fill(self, environ, start_response, key, flight):
+        self._count('misses')
+        response = {}
+
+        def recording_start_response(status, response_headers,
+                                     exc_info=None):
+            response['status'] = status
+            response['headers'] = list(response_headers)
+            response['ttl'] = (None if exc_info is not None
+                               else self._ttl(status, response_headers))
+            write = start_response(status, response_headers, exc_info)
+
+            def recording_write(data):
+                body.append(data)
+                write(data)
+            return recording_write
+
+        body = []
+        try:
+            result = self.app(environ, recording_start_response)
+        except Exception:
+            self._land(key, flight)
+            raise
+        return _Recording(self, result, response, body, key, flight)
+
+    def _land(self, key, flight, entry=None):
+        with self._lock:
+            del self._flights[key]
+        flight.entry = entry
+        flight.done.set()
+
+
+class _Recording(object):
+    # passes the leader's response through while keeping a copy.  the
+    # waiting followers are released by close, which pep 3333 promises
+    # will be called even if iteration never starts.
+
+    def __init__(self, cache, result, response, body, key, flight):
+        self._cache = cache
+        self._result = result
+        self._response = response
+        self._body = body
+        self._key = key
+        self._flight = flight
+        self._entry = None
+        self._landed = False
+
+    def __iter__(self):
+        cache = self._cache
+        body = self._body
+        size = sum(len(chunk) for chunk in body)
+        for chunk in self._result:
+            if size <= cache.max_entry_bytes:
+                body.append(chunk)
+                size += len(chunk)
+            yield chunk
+        ttl = self._response.get('ttl')
+        if ttl is not None and size <= cache.max_entry_bytes:
+            self._entry = encode_entry(
+                cache._seconds(), self._response['status'],
+                self._response['headers'], b''.join(body))
+            cache.store.put(self._key, self._entry, ttl)
+        else:
+            cache._count('uncacheable')
+
+    def close(self):
+        if self._landed:
+            return
+        self._landed = True
+        close = getattr(self._result, 'close', None)
+        try:
+            if close is not None:
+                close()
+        finally:
+            self._cache._land(self._key, self._flight, self._entry)
@@ -0,0 +1,259 @@
+import threading
+import time
+
+import pytest
+
+from wip import microcache
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Counting(object):
+    # an application that counts its calls
+
+    def __init__(self, headers=(('Cache-Control', 'max-age=10'),),
+                 status='200 OK', started=None, release=None):
+        self.headers = list(headers)
+        self.status = status
+        self.calls = 0
+        self.started = started
+        self.release = release
+
+    def __call__(self, environ, start_response):
+        self.calls += 1
+        if self.started is not None:
+            self.started.set()
+            self.release.wait(5)
+        start_response(self.status,
+                       [('Content-Type', 'text/plain')] + self.headers)
+        return [b'call ', str(self.calls).encode('ascii')]
+
+
+def request(app, path='/', method='GET', **environ):
+    environ.update({'REQUEST_METHOD': method, 'PATH_INFO': path,
+                    'QUERY_STRING': ''})
+    started = []
+
+    def start_response(status, response_headers, exc_info=None):
+        started.append((status, dict(response_headers)))
+        return lambda data: None
+
+    result = app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        close = getattr(result, 'close', None)
+        if close is not None:
+            close()
+    [(status, headers)] = started
+    return status, headers, body
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def test_entry_round_trip():
+    entry = microcache.encode_entry(
+        12.5, '200 OK', [('A', 'b'), ('C', 'd: e')], b'body')
+    assert microcache.decode_entry(entry) == (
+        12.5, '200 OK', [('A', 'b'), ('C', 'd: e')], b'body')
+    assert microcache.decode_entry(memoryview(entry))[-1] == b'body'
+
+
+def test_hit_until_max_age(clock):
+    app = Counting()
+    cache = microcache.MicroCache(app, seconds=clock)
+
+    assert request(cache)[2] == b'call 1'
+    clock.now += 3
+    status, headers, body = request(cache)
+    assert body == b'call 1'
+    assert headers['Age'] == '3'
+    assert app.calls == 1
+
+    clock.now += 7
+    assert request(cache)[2] == b'call 2'
+    assert cache.stats == {'misses': 2, 'hits': 1}
+
+
+@pytest.mark.parametrize('first,second', [
+    ({'path': '/a'}, {'path': '/b'}),
+    ({'method': 'GET'}, {'method': 'HEAD'}),
+    ({'HTTP_ACCEPT_LANGUAGE': 'en'}, {'HTTP_ACCEPT_LANGUAGE': 'fr'}),
+])
+def test_key(clock, first, second):
+    app = Counting()
+    cache = microcache.MicroCache(app, vary=['Accept-Language'],
+                                  seconds=clock)
+    request(cache, **first)
+    request(cache, **second)
+    assert app.calls == 2
+    request(cache, **first)
+    assert app.calls == 2
+
+
+def test_unvaried_headers_share_entries(clock):
+    app = Counting()
+    cache = microcache.MicroCache(app, seconds=clock)
+    request(cache, HTTP_ACCEPT_LANGUAGE='en')
+    request(cache, HTTP_ACCEPT_LANGUAGE='fr')
+    assert app.calls == 1
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'headers': []},
+    {'headers': [('Cache-Control', 'max-age=0')]},
+    {'headers': [('Cache-Control', 'max-age=10, private')]},
+    {'headers': [('Cache-Control', 'no-store')]},
+    {'headers': [('Cache-Control', 'max-age=ten')]},
+    {'headers': [('Cache-Control', 'max-age=10'), ('Set-Cookie', 'a=b')]},
+    {'headers': [('Cache-Control', 'max-age=10'), ('Vary', 'Cookie')]},
+    {'headers': [('Cache-Control', 'max-age=10')],
+     'status': '500 Internal Server Error'},
+])
+def test_uncacheable(clock, kwargs):
+    app = Counting(**kwargs)
+    cache = microcache.MicroCache(app, seconds=clock)
+    request(cache)
+    request(cache)
+    assert app.calls == 2
+    assert cache.stats['uncacheable'] == 2
+
+
+def test_default_ttl_and_s_maxage(clock):
+    app = Counting(headers=[])
+    cache = microcache.MicroCache(app, ttl=5, seconds=clock)
+    request(cache)
+    clock.now += 4
+    request(cache)
+    assert app.calls == 1
+
+    app = Counting(headers=[('Cache-Control', 'max-age=1, s-maxage=60')])
+    cache = microcache.MicroCache(app, seconds=clock)
+    request(cache)
+    clock.now += 30
+    request(cache)
+    assert app.calls == 1
+
+
+@pytest.mark.parametrize('environ', [
+    {'method': 'POST'},
+    {'HTTP_AUTHORIZATION': 'Basic eDp5'},
+])
+def test_bypass(clock, environ):
+    app = Counting()
+    cache = microcache.MicroCache(app, seconds=clock)
+    request(cache, **environ)
+    request(cache, **environ)
+    assert app.calls == 2
+    assert cache.stats == {'bypass': 2}
+
+
+def test_oversized_bodies_are_not_cached(clock):
+    app = Counting()
+    cache = microcache.MicroCache(app, max_entry_bytes=5, seconds=clock)
+    assert request(cache)[2] == b'call 1'
+    assert request(cache)[2] == b'call 2'
+
+
+class WatchedEvent(object):
+    # a threading.Event that knows how many threads are waiting on it
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self.waiting = 0
+
+    def set(self):
+        self._event.set()
+
+    def wait(self, timeout=None):
+        with self._lock:
+            self.waiting += 1
+        return self._event.wait(timeout)
+
+
+def test_concurrent_misses_coalesce(clock, monkeypatch):
+    flights = []
+
+    class WatchedFlight(microcache._Flight):
+        def __init__(self):
+            super(WatchedFlight, self).__init__()
+            self.done = WatchedEvent()
+            flights.append(self)
+
+    monkeypatch.setattr(microcache, '_Flight', WatchedFlight)
+    started, release = threading.Event(), threading.Event()
+    app = Counting(started=started, release=release)
+    cache = microcache.MicroCache(app, seconds=clock)
+    bodies = []
+
+    def client():
+        bodies.append(request(cache)[2])
+
+    threads = [threading.Thread(target=client) for _ in range(4)]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    [flight] = flights
+    deadline = time.time() + 5
+    while flight.done.waiting < 3:
+        assert time.time() < deadline
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert bodies == [b'call 1'] * 4
+    assert app.calls == 1
+    assert cache.stats == {'misses': 1, 'coalesced': 3}
+
+
+@pytest.mark.parametrize('fails', [False, True])
+def test_flight_lands(clock, fails):
+    def app(environ, start_response):
+        if fails:
+            raise ValueError()
+        start_response('200 OK', [])
+        return [b'uncacheable']
+
+    cache = microcache.MicroCache(app, seconds=clock)
+    try:
+        request(cache)
+    except ValueError:
+        pass
+    assert not cache._flights
+
+
+def test_memory_store_evicts(clock):
+    store = microcache.MemoryStore(10, seconds=clock)
+    store.put(b'a', b'aaaa', 100)
+    store.put(b'b', b'bbbb', 1)
+    clock.now += 2
+    assert store.get(b'a') == b'aaaa'
+    # b has expired, so it goes before the least recently used
+    store.put(b'c', b'cccc', 100)
+    assert len(store) == 2
+    assert store.get(b'a') == b'aaaa'
+    store.put(b'd', b'dddd', 100)
+    assert store.get(b'c') is None
+    assert store.get(b'a') == b'aaaa'
+    assert store.size == 8
+
+
+def test_memory_store_expires(clock):
+    store = microcache.MemoryStore(seconds=clock)
+    store.put(b'a', b'aaaa', 1)
+    clock.now += 1
+    assert store.get(b'a') is None
+    assert store.size == 0
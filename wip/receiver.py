@@ -1,23 +1,56 @@
+import argparse
+import collections
 import contextlib
 import errno
+import functools
+import importlib
 import io
+import os
+import select
 import signal
 import socket
 import struct
 import sys
 
-from twisted.python.sendmsg import recvmsg
-import eliot
-import six
-
-from wip import types as t
-from wip.common import (reconstitute_socket,
+from wip.lazy import types as t
+from wip.common import (accept_queue,
+                        adopt_fd,
+                        decode_handoff,
+                        handoff_length,
+                        listen_fds,
+                        parse_cpus,
+                        pin_to_cpus,
+                        reconstitute_socket,
+                        resource_usage,
+                        send_queue,
+                        shard_name,
+                        socket_tuning,
+                        steer_to_cpu,
+                        usage_fields,
+                        version_request,
+                        DEFAULT_LISTENER,
                         DESCRIPTION_LENGTH,
+                        DISPATCH_REQUEST,
+                        HANDOFF_HEADER_LENGTH,
+                        MAX_HANDOFF_SOCKETS,
                         READY_BYTE,
+                        UNREADY_BYTE,
                         headers_to_native_strings,
                         headers_to_bytes)
 
 
+_FD = struct.Struct('i')
+
+
+def recvmsg(sock, bufsize, ancbufsize):
+    # (data, ancillary data, flags)
+    if hasattr(sock, 'recvmsg'):
+        return sock.recvmsg(bufsize, ancbufsize)[:3]
+    # python 2 has no socket.recvmsg
+    from twisted.python.sendmsg import recvmsg
+    return recvmsg(sock, maxSize=bufsize, cmsgSize=ancbufsize)
+
+
 @contextlib.contextmanager
 def socket_shutdown(s):
     try:
@@ -30,69 +63,179 @@ def socket_shutdown(s):
         s.close()
 
 
-def read_netstring(f):
+# the most digits a netstring's length may have
+MAX_LENGTH_DIGITS = 7
+# limits on what a web server may send as one request's headers
+MAX_HEADER_LENGTH = 256 * 1024
+MAX_HEADERS = 1000
+
+# what names and values may be made of.  names are printable ASCII;
+# values anything but control characters other than tab.  the NULs
+# between them are allowed here and checked by splitting.
+_NAME_BYTES = bytes(bytearray(range(0x21, 0x7f)))
+_VALUE_BYTES = bytes(bytearray([0x00, 0x09] + list(range(0x20, 0x7f)) +
+                               list(range(0x80, 0x100))))
+
+
+class MalformedHeaders(RuntimeError):
+    # a header block that's no good; the message says why
+    pass
+
+
+_BAD_LENGTH = ('headers must start with their length: up to %d digits '
+               'and a colon' % (MAX_LENGTH_DIGITS,))
+
+
+def _read_length(f, max_length):
+    peek = getattr(f, 'peek', None)
+    if peek is not None:
+        # a buffered file can say where the colon is without a read
+        # per digit
+        head = peek(MAX_LENGTH_DIGITS + 1)[:MAX_LENGTH_DIGITS + 1]
+        colon = head.find(b':')
+        if colon > 0:
+            digits = f.read(colon + 1)[:colon]
+            if not digits.isdigit():
+                raise MalformedHeaders(_BAD_LENGTH)
+            length = int(digits)
+            if max_length is not None and length > max_length:
+                raise MalformedHeaders('%d bytes of headers is too many'
+                                       % (length,))
+            return length
     length = []
-    while len(length) < 7:
+    while True:
         c = f.read(1)
         if c == b':':
             break
-        elif not c.isdigit():
-            raise RuntimeError()
+        elif not c.isdigit() or len(length) == MAX_LENGTH_DIGITS:
+            raise MalformedHeaders(_BAD_LENGTH)
         else:
             length.append(c)
-    else:
-        raise RuntimeError()
+    if not length:
+        raise MalformedHeaders(_BAD_LENGTH)
     length = int(b''.join(length))
-    if length:
-        ret = f.read(length)
-    else:
-        ret = b''
-    if f.read(1) != b',':
-        raise RuntimeError()
-    return ret
+    if max_length is not None and length > max_length:
+        raise MalformedHeaders('%d bytes of headers is too many' % (length,))
+    return length
+
+
+def read_netstring(f, max_length=None):
+    length = _read_length(f, max_length)
+    # the data and its trailing comma in one read
+    ret = f.read(length + 1)
+    if ret[-1:] != b',' or len(ret) != length + 1:
+        raise MalformedHeaders('headers must be followed by a comma')
+    return ret[:-1]
+
+
+def parse_headers(block, max_headers=MAX_HEADERS):
+    # the environ from a header block of NUL terminated names and
+    # values, checked a whole block at a time rather than field by
+    # field, and decoded once
+    if block[-1:] != b'\0':
+        raise MalformedHeaders('headers must end with a NUL')
+    if block.translate(None, _VALUE_BYTES):
+        raise MalformedHeaders('control characters in headers')
+    fields = headers_to_native_strings([block])[0].split('\0')
+    # every name and value, then the empty string after the last NUL
+    count = len(fields) // 2
+    if not len(fields) % 2:
+        raise MalformedHeaders('a header name without a value')
+    if count > max_headers:
+        raise MalformedHeaders('%d headers is too many' % (count,))
+    names = fields[0:-1:2]
+    if '' in names:
+        raise MalformedHeaders('an empty header name')
+    if headers_to_bytes(''.join(names)).translate(None, _NAME_BYTES):
+        raise MalformedHeaders('header names must be printable ASCII')
+    environ = dict(zip(names, fields[1::2]))
+    if len(environ) != count:
+        # two CONTENT_LENGTHs would be one too many
+        raise MalformedHeaders('repeated header names')
+    return environ
+
+
+def read_headers(f, max_length=MAX_HEADER_LENGTH, max_headers=MAX_HEADERS):
+    with t.SCGI_PARSE():
+        return parse_headers(read_netstring(f, max_length), max_headers)
 
 
-def read_headers(f):
-    with t.SCGI_PARSE():
-        whole_header = read_netstring(f)
-        headers = whole_header.split(b'\0')
-        if headers[-1] != b'':
-            raise RuntimeError()
-        headers = headers_to_native_strings(headers)
-        return dict(zip(*[iter(headers)] * 2))
+def cgi_headers(status, response_headers):
+    headers = 'Status: %s\r\n%s\r\n\r\n' % (
+        status,
+        '\r\n'.join('%s: %s' % header for header in response_headers))
+    return headers_to_bytes(headers)
+
+
+class CountingInput(object):
+    # a wsgi.input that counts the bytes read from it
+
+    def __init__(self, wsgi_input):
+        self._input = wsgi_input
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self._input.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def readline(self, size=-1):
+        line = self._input.readline(size)
+        self.bytes_read += len(line)
+        return line
 
+    def readlines(self, hint=-1):
+        lines = self._input.readlines(hint)
+        self.bytes_read += sum(len(line) for line in lines)
+        return lines
 
-class SCGIRequestProcessor(object):
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+
+# POLLRDHUP is Linux's; elsewhere only a full hangup is noticed
+_HALF_CLOSED = getattr(select, 'POLLRDHUP', 0)
+_HUNG_UP = select.POLLHUP | select.POLLERR
+
+
+class WSGIRequestProcessor(object):
+    # runs one request, or a connection's worth, through a WSGI
+    # application.  subclasses speak the protocol: _determine_environment()
+    # reads a request and returns its environ, and
+    # _format_headers(status, response_headers) returns the bytes that
+    # start the response.
+    multithread = False
+    # whether a peer that's stopped sending has gone.  a web server
+    # doesn't half-close a request's connection, but an HTTP client
+    # may once it's sent its request and still want the response.
+    half_close_is_hangup = True
 
     @classmethod
     def from_sock(cls, sock):
-        instream = sock.makefile('r')
-        # unbuffered writes
-        outstream = sock.makefile('w', 0)
-        return cls(instream, outstream)
+        instream = sock.makefile('rb')
+        # buffered, but flushed after every write
+        outstream = sock.makefile('wb')
+        return cls(instream, outstream, peer=sock)
 
-    def __init__(self, instream, outstream):
+    def __init__(self, instream, outstream, peer=None):
         self._instream = instream
         self._outstream = outstream
         self._headers = None
         self._headers_sent = False
+        # the connected socket, when there is one, to notice hangups
+        # and report on the send buffer
+        self._peer = peer
+        self._poller = None
+        self._bytes_written = 0
 
-    def _determine_environment(self,
-                               _read_headers=read_headers,
-                               _io_factory=io.BytesIO):
-        environ = _read_headers(self._instream)
-
+    def _populate_environment(self, environ, wsgi_input):
         environ['wsgi.version'] = 1, 0
         environ['wsgi.url_scheme'] = 'http'
         if environ.get('HTTPS') in ('on', '1'):
             environ['wsgi.url_scheme'] = 'https'
-        content_length = int(environ['CONTENT_LENGTH'])
-        if content_length:
-            environ['wsgi.input'] = self._instream
-        else:
-            environ['wsgi.input'] = _io_factory()
+        environ['wsgi.input'] = wsgi_input
         environ['wsgi.errors'] = sys.stderr
-        environ['wsgi.multithread'] = False
+        environ['wsgi.multithread'] = self.multithread
         environ['wsgi.multiprocess'] = True
         environ['wsgi.run_once'] = False
 
@@ -101,12 +244,17 @@ class SCGIRequestProcessor(object):
         environ['SCRIPT_NAME'] = ''
         environ['PATH_INFO'] = path
 
+        if self._peer is not None:
+            environ['wip.send_queue'] = functools.partial(
+                send_queue, self._peer)
+
         return environ
 
     def _start_response(self, status, response_headers, exc_info=None):
         if exc_info is not None:
             try:
                 if self._headers_sent:
+                    import six
                     six.reraise(*exc_info)
             finally:
                 exc_info = None
@@ -114,11 +262,7 @@ class SCGIRequestProcessor(object):
             raise RuntimeError()
 
         t.RESPONSE_STARTED(status=status).write()
-        headers = 'Status: %s\r\n%s\r\n\r\n' % (
-            status,
-            '\r\n'.join('%s: %s' % header for header in response_headers))
-
-        self._headers = headers_to_bytes(headers)
+        self._headers = self._format_headers(status, response_headers)
 
         return self._write
 
@@ -127,56 +271,389 @@ class SCGIRequestProcessor(object):
             if self._headers is None:
                 raise RuntimeError()
             self._outstream.write(self._headers)
+            self._bytes_written += len(self._headers)
             self._headers_sent = True
             self._headers = None
         if data:
             self._outstream.write(data)
+            self._bytes_written += len(data)
+        self._outstream.flush()
 
-    def run_app(self, app):
-        environ = self._determine_environment()
-        with t.WSGI_REQUEST(path=environ['PATH_INFO']):
-            response = app(environ, self._start_response)
+    def _finish_response(self):
+        if not self._headers_sent:
+            self._write(b'')
+
+    def _client_gone(self):
+        if self._peer is None:
+            return False
+        hung_up = _HUNG_UP
+        if self.half_close_is_hangup:
+            hung_up |= _HALF_CLOSED
+        if self._poller is None:
+            self._poller = select.poll()
+            self._poller.register(self._peer, hung_up)
+        return any(events & hung_up for _, events in self._poller.poll(0))
+
+    def _respond(self, app, environ):
+        with t.WSGI_REQUEST(path=environ['PATH_INFO']) as action:
+            wsgi_input = environ.get('wsgi.input')
+            if wsgi_input is not None:
+                wsgi_input = environ['wsgi.input'] = CountingInput(
+                    wsgi_input)
+            bytes_written = self._bytes_written
+            before = resource_usage()
+            try:
+                return self._run_response(app, environ)
+            finally:
+                fields = usage_fields(before, resource_usage())
+                fields['bytes_read'] = (0 if wsgi_input is None
+                                        else wsgi_input.bytes_read)
+                fields['bytes_written'] = self._bytes_written - bytes_written
+                action.add_success_fields(**fields)
+
+    def _run_response(self, app, environ):
+        response = app(environ, self._start_response)
+        # a list was produced up front; there's nothing to save by
+        # stopping early.  anything else is checked for a hangup
+        # between chunks, so an application that's waiting on
+        # something can yield b'' to find out if anyone's listening.
+        streaming = not isinstance(response, (list, tuple))
+        try:
             for chunk in response:
                 self._write(chunk)
-            if not self._headers_sent:
-                self._write('')
+                if streaming and self._client_gone():
+                    t.CLIENT_GONE().write()
+                    return False
+            self._finish_response()
+            return True
+        finally:
             close = getattr(response, 'close', None)
             if close is not None:
                 close()
 
+    def run_app(self, app):
+        self._respond(app, self._determine_environment())
+
+
+class SCGIRequestProcessor(WSGIRequestProcessor):
+
+    def _determine_environment(self,
+                               _read_headers=read_headers,
+                               _io_factory=io.BytesIO):
+        environ = _read_headers(self._instream)
+        content_length = environ.get('CONTENT_LENGTH', '')
+        if not content_length.isdigit():
+            raise MalformedHeaders('CONTENT_LENGTH must be a number')
+        content_length = int(content_length)
+        if content_length:
+            wsgi_input = self._instream
+        else:
+            wsgi_input = _io_factory()
+        return self._populate_environment(environ, wsgi_input)
+
+    def _format_headers(self, status, response_headers):
+        return cgi_headers(status, response_headers)
+
+
+def read_handoff(sock):
+    data, ancillary, flags = recvmsg(
+        sock, 8192, socket.CMSG_SPACE(MAX_HANDOFF_SOCKETS * _FD.size))
+    fds = []
+    for level, kind, cmsg_data in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            count = len(cmsg_data) // _FD.size
+            fds.extend(struct.unpack('%di' % count,
+                                     cmsg_data[:count * _FD.size]))
+    try:
+        # everything normally arrives with the descriptors, but a large
+        # description may not
+        while len(data) < HANDOFF_HEADER_LENGTH:
+            more = sock.recv(HANDOFF_HEADER_LENGTH - len(data))
+            if not more:
+                raise RuntimeError()
+            data += more
+        missing = handoff_length(data) - len(data)
+        if missing > 0:
+            data += sock.recv(missing, socket.MSG_WAITALL)
+        listeners = decode_handoff(data)
+        if len(fds) != len(listeners):
+            raise RuntimeError()
+    except Exception:
+        for fd in fds:
+            os.close(fd)
+        raise
+    return [(headers_to_native_strings([name])[0], fd, description)
+            for (name, description), fd in zip(listeners, fds)]
+
+
+def receive_socket(sock, eliot_action=None):
+    # a socket sent with its description, or None if the sender hung up
+    description, ancillary, flags = recvmsg(
+        sock, 1, socket.CMSG_SPACE(_FD.size))
+    if not description and not ancillary:
+        return None
+    if not ancillary:
+        raise RuntimeError()
+    # OOB data, like ancillary data, interrupts MSG_WAITALL.  so
+    # do this in two syscalls.
+    description += sock.recv(DESCRIPTION_LENGTH - 1, socket.MSG_WAITALL)
+    [fd] = _FD.unpack(ancillary[0][2])
+    try:
+        return reconstitute_socket(fd, description, eliot_action)
+    finally:
+        # fromfd duplicated it
+        os.close(fd)
+
+
+def receive_handoff(sock):
+    sock.sendall(version_request())
+    return read_handoff(sock)
+
+
+_CLIENT_GONE_ERRNOS = (errno.EPIPE, errno.ECONNRESET)
+
 
 class SocketPassProcessor(object):
-    def __init__(self, sock):
+    # every receiver's copy of a listener shares one open file
+    # description, and with it O_NONBLOCK, so one receiver's blocking
+    # mode is everyone's.  listeners are only ever made non-blocking,
+    # and serve waits for them with select.
+    waits_in_accept = False
+
+    def __init__(self, sock, request_processor=SCGIRequestProcessor.from_sock,
+                 tuning=None):
         self._sock = sock
+        self._request_processor = request_processor
+        self._tuning = tuning
 
     @classmethod
-    def from_handoff_socket(cls, sock, eliot_action=None):
+    def from_handoff_socket(cls, sock, eliot_action=None, **kwargs):
         sock.sendall(READY_BYTE)
-        description, ancillary, flags = recvmsg(sock, maxSize=1)
-        # OOB data, like ancillary data, interrupts MSG_WAITALL.  so
-        # do this in two syscalls.
-        description += sock.recv(DESCRIPTION_LENGTH - 1, socket.MSG_WAITALL)
-        [fd] = struct.unpack('i', ancillary[0][2])
-        new_sock = reconstitute_socket(fd, description, eliot_action)
-        new_sock.setblocking(True)
-        ret = cls(new_sock)
+        new_sock = receive_socket(sock, eliot_action)
+        if new_sock is None:
+            raise RuntimeError()
+        new_sock.setblocking(False)
+        ret = cls(new_sock, **kwargs)
         return ret
 
     @classmethod
-    def from_path(cls, path):
+    def from_path(cls, path, **kwargs):
         with t.HANDOFF(path=path) as action:
             sock = socket.socket(socket.AF_UNIX)
             with socket_shutdown(sock):
                 sock.connect(path)
-                return cls.from_handoff_socket(sock, action)
+                return cls.from_handoff_socket(sock, action, **kwargs)
+
+    @classmethod
+    def all_from_path(cls, path, **kwargs):
+        with t.HANDOFF_LISTENERS(path=path) as action:
+            sock = socket.socket(socket.AF_UNIX)
+            with socket_shutdown(sock):
+                sock.connect(path)
+                listeners = receive_handoff(sock)
+            processors = collections.OrderedDict()
+            try:
+                while listeners:
+                    name, fd, description = listeners.pop(0)
+                    try:
+                        new_sock = reconstitute_socket(fd, description)
+                    finally:
+                        # fromfd duplicated it
+                        os.close(fd)
+                    new_sock.setblocking(False)
+                    processors[name] = cls(
+                        new_sock, tuning=socket_tuning(description),
+                        **kwargs)
+            except Exception:
+                for _, fd, _ in listeners:
+                    os.close(fd)
+                for processor in processors.values():
+                    processor.close()
+                raise
+            action.add_success_fields(names=list(processors))
+            return processors
+
+    @classmethod
+    def from_fd(cls, fd, **kwargs):
+        with t.ADOPT_SOCKET(fd=fd) as action:
+            new_sock = adopt_fd(fd, action)
+            new_sock.setblocking(False)
+            return cls(new_sock, **kwargs)
+
+    @classmethod
+    def all_from_environment(cls, environ=None, **kwargs):
+        processors = collections.OrderedDict()
+        for name, fd in listen_fds(environ):
+            processors[name] = cls.from_fd(fd, **kwargs)
+        return processors
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    @property
+    def family(self):
+        return self._sock.family
+
+    @property
+    def tuning(self):
+        return self._tuning
 
-    def handle_request(self, app):
+    def setblocking(self, flag):
+        self._sock.setblocking(flag)
+
+    def close(self):
+        self._sock.close()
+
+    def accept_queue(self):
+        return accept_queue(self._sock)
+
+    def steer_to_cpu(self, cpu):
+        return steer_to_cpu(self._sock, cpu)
+
+    def _accept(self, graceful=None):
         # TODO: the billion things that go wrong with accept
         new_sock, addr = self._sock.accept()
+        return new_sock
+
+    def handle_request(self, app, graceful=None):
+        # graceful: a GracefulExit to wait with, if accepting blocks
+        new_sock = self._accept(graceful)
         t.SCGI_ACCEPTED().write()
         new_sock.setblocking(True)
+        if self._tuning is not None:
+            self._tuning.apply_to_connection(new_sock)
         with t.SCGI_REQUEST(), socket_shutdown(new_sock):
-            SCGIRequestProcessor.from_sock(new_sock).run_app(app)
+            try:
+                self._request_processor(new_sock).run_app(app)
+            except socket.timeout:
+                # stalled past the socket's timeout, which has no errno
+                t.CLIENT_GONE().write()
+            except socket.error as e:
+                # the client went away mid-response; that's no reason
+                # to stop serving everyone else
+                if e.args[0] not in _CLIENT_GONE_ERRNOS:
+                    raise
+                t.CLIENT_GONE().write()
+            except MalformedHeaders as e:
+                # nothing can be said to a peer that can't be
+                # understood; dropping it costs only this connection
+                t.MALFORMED_HEADERS(reason=str(e)).write()
+
+
+class DispatchedProcessor(SocketPassProcessor):
+    # serves the connections a handoff daemon in dispatch mode accepted,
+    # asking for each with a READY_BYTE once the last is done
+
+    # the channel's only readable once READY_BYTE's been sent
+    waits_in_accept = True
+
+    @classmethod
+    def from_path(cls, path, **kwargs):
+        with t.DISPATCH_ATTACH(path=path):
+            sock = socket.socket(socket.AF_UNIX)
+            try:
+                sock.connect(path)
+                sock.sendall(DISPATCH_REQUEST)
+            except Exception:
+                sock.close()
+                raise
+            return cls(sock, **kwargs)
+
+    def _accept(self, graceful=None):
+        try:
+            self._sock.sendall(READY_BYTE)
+            if (graceful is not None and
+                    not graceful.readable([self._sock.fileno()])):
+                # the daemon may have sent a connection already, which
+                # is still served; otherwise it just hangs up
+                self._sock.sendall(UNREADY_BYTE)
+            new_sock = receive_socket(self._sock)
+        except socket.error as e:
+            if e.args[0] not in _CLIENT_GONE_ERRNOS:
+                raise
+            new_sock = None
+        if new_sock is None:
+            if graceful is not None:
+                graceful.check()
+            raise SystemExit('the handoff daemon went away')
+        return new_sock
+
+
+class GracefulExit(object):
+    # once installed, SIGTERM only takes note, and wakes wait(), so a
+    # receiver finishes the request it's running before it exits
+
+    def __init__(self):
+        self.requested = False
+        self._wakeup, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup, False)
+        os.set_blocking(self._wakeup_write, False)
+
+    def install(self):
+        signal.set_wakeup_fd(self._wakeup_write)
+        signal.signal(signal.SIGTERM, self._handle)
+
+    def _handle(self, signum, frame):
+        self.requested = True
+
+    def check(self):
+        if self.requested:
+            raise SystemExit(0)
+
+    def readable(self, filenos):
+        # those of filenos that are readable, once any are, or nothing
+        # if SIGTERM arrives first
+        while not self.requested:
+            readable, _, _ = select.select(
+                list(filenos) + [self._wakeup], [], [])
+            if self._wakeup in readable:
+                readable.remove(self._wakeup)
+                # any signal writes here; only SIGTERM's handler says stop
+                try:
+                    while os.read(self._wakeup, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+            if readable:
+                return readable
+        return []
+
+    def wait(self, filenos):
+        # like readable, but raises SystemExit once SIGTERM's arrived
+        readable = self.readable(filenos)
+        self.check()
+        return readable
+
+
+def _select_readable(filenos):
+    readable, _, _ = select.select(filenos, [], [])
+    return readable
+
+
+def serve(processors, app, graceful=None):
+    # with a GracefulExit, SIGTERM stops the receiver between requests
+    if len(processors) == 1 and processors[0].waits_in_accept:
+        [processor] = processors
+        while True:
+            processor.handle_request(app, graceful)
+            if graceful is not None:
+                graceful.check()
+
+    # other receivers may win the race to accept, so don't block in it
+    for processor in processors:
+        processor.setblocking(False)
+    by_fileno = dict((processor.fileno(), processor)
+                     for processor in processors)
+    wait = _select_readable if graceful is None else graceful.wait
+    while True:
+        for fileno in wait(list(by_fileno)):
+            if graceful is not None:
+                graceful.check()
+            try:
+                by_fileno[fileno].handle_request(app)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
 
 
 def test_app(environ, start_response):
@@ -185,23 +662,323 @@ def test_app(environ, start_response):
         yield
 
 
-def main():
-    eliot.to_file(sys.stdout)
+def load_app(spec):
+    module_name, _, name = spec.partition(':')
+    module = importlib.import_module(module_name)
+    return getattr(module, name or 'application')
+
+
+def wrap_app(app, mode):
+    if mode == 'debug':
+        from paste import lint
+        from wip.debug import check_invariants
+        # outermost, so the invariants see exactly what the server does
+        app = check_invariants(lint.middleware(app))
+    return app
+
+
+def request_processor_for(protocol, threads=1):
+    if protocol == 'http':
+        from wip.http11 import HTTPRequestProcessor
+        return HTTPRequestProcessor.from_sock
+    elif protocol == 'uwsgi':
+        from wip.uwsgi import UWSGIRequestProcessor
+        return UWSGIRequestProcessor.from_sock
+    elif protocol == 'fastcgi':
+        from multiprocessing.pool import ThreadPool
+        from wip.fastcgi import FastCGIRequestProcessor
+        return functools.partial(FastCGIRequestProcessor.from_sock,
+                                 pool=ThreadPool(threads),
+                                 max_requests=threads)
+    return SCGIRequestProcessor.from_sock
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='wip.receiver')
+    parser.add_argument('handoff_path', nargs='?',
+                        help='omit to adopt sockets passed by systemd '
+                             'or with --fd')
+    parser.add_argument('--protocol',
+                        choices=('scgi', 'uwsgi', 'http', 'fastcgi'),
+                        default='scgi')
+    parser.add_argument('--app', metavar='MODULE:CALLABLE',
+                        help='the WSGI application to serve (default: a '
+                             'test application that answers 200 OK)')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='size of the FastCGI or Twisted request '
+                             'thread pool')
+    parser.add_argument('--twisted', action='store_true',
+                        help='read SCGI requests from a Twisted reactor '
+                             'and run the application on --threads '
+                             'threads, so idle and slow clients only '
+                             'cost a connection')
+    parser.add_argument('--stats-interval', type=int, default=60,
+                        metavar='SECONDS',
+                        help='with --twisted, log connection and queue '
+                             'counts this often; 0 never does')
+    parser.add_argument('--listener', action='append', dest='listeners',
+                        metavar='NAME',
+                        help='serve this named listener; may be repeated')
+    parser.add_argument('--fd', action='append', dest='fds', type=int,
+                        default=[],
+                        help='serve this inherited listening socket; '
+                             'may be repeated')
+    parser.add_argument('--dispatched', action='store_true',
+                        help='serve connections a handoff daemon started '
+                             'with --dispatch accepted, one at a time, '
+                             'rather than its listeners')
+    parser.add_argument('--cpu', type=parse_cpus, dest='cpus',
+                        metavar='CPUS',
+                        help='run only on these CPUs, like 0-3,8, or '
+                             'nodeN for NUMA node N\'s')
+    parser.add_argument('--shard', type=int, metavar='N',
+                        help='of listeners split into shards by the '
+                             'handoff daemon, serve shard N modulo their '
+                             'number; with --cpu naming one CPU, the '
+                             'kernel is asked to send the shard the '
+                             'connections that CPU handles')
+    parser.add_argument('--no-log', action='store_false', dest='log',
+                        help="don't log; eliot is then never imported")
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument('--debug', action='store_const', dest='mode',
+                       const='debug',
+                       help='check requests and responses with paste.lint '
+                            'and wip.debug (the default)')
+    modes.add_argument('--production', action='store_const', dest='mode',
+                       const='production',
+                       help='serve the application unchecked')
+    parser.set_defaults(mode='debug')
+    compression = parser.add_argument_group('compression')
+    compression.add_argument('--compress', action='store_true',
+                             help='gzip or deflate responses for clients '
+                                  'that accept it')
+    compression.add_argument('--compress-level', type=int, default=6,
+                             choices=range(1, 10), metavar='1-9')
+    compression.add_argument('--compress-min-size', type=int, default=512,
+                             metavar='BYTES',
+                             help='leave smaller responses alone')
+    compression.add_argument('--compress-type', action='append',
+                             dest='compress_types', metavar='CONTENT_TYPE',
+                             help='compress this content type instead of '
+                                  'the defaults; may be repeated')
+    compression.add_argument('--compress-cache', type=int,
+                             default=8 * 1024 * 1024, metavar='BYTES',
+                             help='memory for compressed bodies with strong '
+                                  'ETags; 0 disables the cache')
+    microcache = parser.add_argument_group('micro-cache')
+    microcache.add_argument('--microcache', action='store_true',
+                            help='answer repeated GET and HEAD requests '
+                                 'from memory while Cache-Control allows')
+    microcache.add_argument('--microcache-size', type=int,
+                            default=64 * 1024 * 1024, metavar='BYTES')
+    microcache.add_argument('--microcache-shared', nargs='?', const='',
+                            metavar='PATH',
+                            help='share the cache with every receiver '
+                                 'mapping PATH, which defaults to the '
+                                 'handoff path plus .microcache; '
+                                 '--microcache-size is then ignored')
+    microcache.add_argument('--microcache-ttl', type=int, default=0,
+                            metavar='SECONDS',
+                            help='cache responses without a max-age this '
+                                 'long (default: not at all)')
+    microcache.add_argument('--microcache-vary', action='append',
+                            dest='microcache_vary', default=[],
+                            metavar='HEADER',
+                            help='also key the cache on this request '
+                                 'header; may be repeated')
+    spooling = parser.add_argument_group('request body spooling')
+    spooling.add_argument('--spool', action='store_true',
+                          help='read request bodies in full before calling '
+                               'the application')
+    spooling.add_argument('--spool-memory', type=int, metavar='BYTES',
+                          help='keep bodies up to this size in memory and '
+                               'larger ones in a temporary file (default: '
+                               '1MiB); with --spool or --twisted')
+    spooling.add_argument('--spool-max', type=int, metavar='BYTES',
+                          help='refuse larger bodies with a 413')
+    spooling.add_argument('--spool-dir', metavar='PATH',
+                          help='where temporary files go (default: the '
+                               'system temporary directory)')
+    routes = parser.add_argument_group('per-route accounting')
+    routes.add_argument('--routes', action='store_true',
+                        help='log request counts, times, bytes and '
+                             'status classes per route as wip:route_stats')
+    routes.add_argument('--route', action='append', dest='route_templates',
+                        default=[], metavar='TEMPLATE',
+                        help='count paths matching TEMPLATE, like '
+                             '/users/{id}, /static/* or a regular '
+                             'expression starting with ^, as one route; '
+                             'may be repeated.  other paths have their '
+                             'numeric and hex segments collapsed.')
+    routes.add_argument('--routes-interval', type=int, default=60,
+                        metavar='SECONDS',
+                        help='log the totals this often; SIGUSR1 logs '
+                             'them after the next request')
+    parser.add_argument('--scoreboard', metavar='PATH',
+                        help='say how busy this receiver is in a slot of '
+                             'the scoreboard at PATH, for wip.supervisor')
+    parser.add_argument('--scoreboard-slot', type=int, default=0,
+                        metavar='N')
+    args = parser.parse_args(argv)
+    if args.twisted and args.protocol != 'scgi':
+        parser.error('--twisted only speaks SCGI')
+    if not (args.spool or args.twisted) and args.spool_memory is not None:
+        parser.error('--spool-memory needs --spool or --twisted')
+    if not args.spool and (args.spool_max is not None or
+                           args.spool_dir is not None):
+        parser.error('--spool-max and --spool-dir need --spool')
+    if args.spool_memory is None:
+        args.spool_memory = 1024 * 1024
+    if args.dispatched and (args.handoff_path is None or args.twisted or
+                            args.fds or args.listeners or
+                            args.shard is not None):
+        parser.error('--dispatched needs a handoff path, and no --twisted, '
+                     '--fd, --listener or --shard')
+    return args
+
+
+def shard_processors(processors, shard=None, cpu=None):
+    # by listener name, the processors serving it.  of each listener the
+    # handoff daemon split into shards, that's shard number shard, modulo
+    # their number, steered to cpu if given; without a shard, or for
+    # listeners that weren't split, it's all of them.
+    shards = collections.Counter(name.partition(':')[0]
+                                 for name in processors)
+    chosen = collections.OrderedDict()
+    for name, processor in processors.items():
+        if ':' in name:
+            continue
+        if shard is None or shards[name] == 1:
+            chosen[name] = [processors[shard_name(name, index)]
+                            for index in range(shards[name])]
+            continue
+        name_of_shard = shard_name(name, shard % shards[name])
+        chosen[name] = [processors[name_of_shard]]
+        if cpu is not None and chosen[name][0].steer_to_cpu(cpu):
+            t.STEER_LISTENER(name=name_of_shard, cpu=cpu).write()
+    return chosen
+
+
+def find_processors(args, cpu=None, **kwargs):
+    if args.dispatched:
+        return [DispatchedProcessor.from_path(args.handoff_path, **kwargs)]
+    if args.fds:
+        return [SocketPassProcessor.from_fd(fd, **kwargs)
+                for fd in args.fds]
+    if args.handoff_path is None:
+        available = SocketPassProcessor.all_from_environment(**kwargs)
+        names = args.listeners
+    else:
+        available = SocketPassProcessor.all_from_path(
+            args.handoff_path, **kwargs)
+        # without --shard or --listener, only what version 1 of the
+        # handoff protocol would have passed
+        names = args.listeners or (
+            None if args.shard is not None else [DEFAULT_LISTENER])
+    by_listener = shard_processors(available, args.shard, cpu)
+    if names is None:
+        names = list(by_listener)
+    unknown = [name for name in names if name not in by_listener]
+    chosen = [processor for name in names if name in by_listener
+              for processor in by_listener[name]]
+    # the rest would only hold their listeners open
+    for processor in available.values():
+        if unknown or processor not in chosen:
+            processor.close()
+    if unknown:
+        raise SystemExit('no listener named %s; there are: %s' % (
+            ', '.join(unknown), ', '.join(by_listener) or 'none'))
+    return chosen
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.log:
+        import eliot
+        eliot.to_file(sys.stdout)
+    else:
+        t.disable_logging()
     allowed_signals = {signal.SIGINT, signal.SIGTERM}
     for sig in range(1, signal.NSIG):
         if sig in allowed_signals:
             continue
         try:
             signal.siginterrupt(sig, False)
-        except RuntimeError as e:
+        except (RuntimeError, OSError) as e:
             if e.args[0] != errno.EINVAL:
                 raise
 
-    from paste import lint
-    proc = SocketPassProcessor.from_path(sys.argv[1])
-    app = lint.middleware(test_app)
-    while True:
-        proc.handle_request(app)
+    cpu = None
+    if args.cpus is not None:
+        # before any threads start, so they're all pinned
+        if pin_to_cpus(args.cpus):
+            t.PIN_CPUS(cpus=args.cpus).write()
+            if len(args.cpus) == 1:
+                [cpu] = args.cpus
+    processors = find_processors(
+        args, cpu=cpu,
+        request_processor=request_processor_for(args.protocol, args.threads))
+    if not processors:
+        raise SystemExit('no listening sockets to serve')
+    app = test_app if args.app is None else load_app(args.app)
+    if args.compress:
+        from wip.compress import Compress, DEFAULT_CONTENT_TYPES
+        # inside the debug checks, so they see the compressed response
+        app = Compress(app, level=args.compress_level,
+                       min_size=args.compress_min_size,
+                       content_types=(args.compress_types or
+                                      DEFAULT_CONTENT_TYPES),
+                       cache_bytes=args.compress_cache)
+    if args.microcache:
+        from wip.microcache import MemoryStore, MicroCache
+        vary = list(args.microcache_vary)
+        if args.compress and 'accept-encoding' not in map(str.lower, vary):
+            # compressed and uncompressed responses must be kept apart
+            vary.append('Accept-Encoding')
+        if args.microcache_shared is None:
+            store = MemoryStore(args.microcache_size)
+        else:
+            from wip.sharedcache import SharedStore
+            path = args.microcache_shared
+            if not path:
+                if args.handoff_path is None:
+                    raise SystemExit('--microcache-shared needs a PATH '
+                                     'without a handoff path')
+                path = args.handoff_path + '.microcache'
+            store = SharedStore(path)
+        # lint insists on bytes
+        app = MicroCache(app, store=store, ttl=args.microcache_ttl,
+                         vary=vary, zero_copy=args.mode == 'production')
+    if args.spool:
+        from wip.spool import SpoolBody
+        # outside the rest, so nothing runs until the body's arrived
+        app = SpoolBody(app, max_memory=args.spool_memory,
+                        max_body=args.spool_max, directory=args.spool_dir)
+    if args.routes:
+        from wip.routes import AccountRoutes, RouteNormalizer
+        # outermost, so the time spent spooling is charged to the route
+        app = accounting = AccountRoutes(
+            app, normalize=RouteNormalizer(args.route_templates),
+            flush_interval=args.routes_interval)
+        signal.signal(signal.SIGUSR1,
+                      lambda signum, frame: accounting.request_flush())
+        signal.siginterrupt(signal.SIGUSR1, False)
+    if args.scoreboard is not None:
+        from wip.scoreboard import MarkBusy, Scoreboard
+        capacity = (args.threads if args.twisted or args.protocol == 'fastcgi'
+                    else 1)
+        scoreboard = Scoreboard(args.scoreboard, args.scoreboard_slot + 1)
+        app = MarkBusy(app, scoreboard.slot(args.scoreboard_slot, capacity))
+    app = wrap_app(app, args.mode)
+    if args.twisted:
+        from wip import evented
+        evented.serve(processors, app, args.threads,
+                      spool_memory=args.spool_memory,
+                      stats_interval=args.stats_interval)
+    else:
+        graceful = GracefulExit()
+        graceful.install()
+        serve(processors, app, graceful)
 
 
 if __name__ == '__main__':
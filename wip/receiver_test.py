@@ -1,11 +1,19 @@
+import errno
+import fcntl
 import io
+import os
+import random
+import select
+import signal
 import socket
+import struct
+import threading
 
 from eliot.testing import LoggedAction
 import pytest
 import six
 
-from wip import receiver, types
+from wip import common, receiver, types
 
 
 class RecordsFakeSocket(object):
@@ -132,3 +140,791 @@ def test_read_headers_fails(capture_logging):
 
     fail_actions = LoggedAction.ofType(logger.messages, types.SCGI_PARSE)
     assert fail_actions and not fail_actions[0].succeeded
+
+
+def netstring(block):
+    return str(len(block)).encode('ascii') + b':' + block + b','
+
+
+@pytest.mark.parametrize('block', [
+    b'CONTENT_LENGTH\x000\x00X\x00',
+    b'CONTENT_LENGTH\x000\x00\x00value\x00',
+    b'CONTENT_LENGTH\x000\x00HTTP_X\x00a\r\nb\x00',
+    b'CONTENT_LENGTH\x000\x00HTTP X\x00y\x00',
+    b'CONTENT_LENGTH\x000\x00HTTP_\xbf\x00y\x00',
+    b'CONTENT_LENGTH\x000\x00CONTENT_LENGTH\x005\x00',
+    b'CONTENT_LENGTH\x000\x00HTTP_X\x00\x7f\x00',
+])
+def test_read_headers_rejects_malformed(capture_logging, block):
+    with pytest.raises(receiver.MalformedHeaders) as excinfo, \
+            capture_logging() as logger:
+        receiver.read_headers(io.BytesIO(netstring(block)))
+    assert str(excinfo.value)
+    [action] = LoggedAction.ofType(logger.messages, types.SCGI_PARSE)
+    assert not action.succeeded
+
+
+def test_read_headers_limits(capture_logging):
+    block = b''.join(b'H%d\x00v\x00' % (i,) for i in range(11))
+    with capture_logging():
+        assert len(receiver.read_headers(io.BytesIO(netstring(block)),
+                                         max_headers=11)) == 11
+        with pytest.raises(receiver.MalformedHeaders):
+            receiver.read_headers(io.BytesIO(netstring(block)),
+                                  max_headers=10)
+        # refused before the block's read
+        unread = io.BytesIO(netstring(block))
+        with pytest.raises(receiver.MalformedHeaders):
+            receiver.read_headers(unread, max_length=len(block) - 1)
+        assert unread.tell() == len(str(len(block))) + 1
+
+
+def test_read_headers_allows_tabs_and_latin_1_values(capture_logging):
+    block = b'CONTENT_LENGTH\x000\x00HTTP_X\x00a\tb\xff\x00'
+    with capture_logging():
+        environ = receiver.read_headers(io.BytesIO(netstring(block)))
+    assert environ['HTTP_X'] == u'a\tb\N{LATIN SMALL LETTER Y WITH DIAERESIS}'
+
+
+@pytest.mark.parametrize('buffered', [False, True])
+@pytest.mark.parametrize('data,parsed', [
+    (b'0:,', b''),
+    (b'5:hello,rest', b'hello'),
+    (b'0000005:hello,', b'hello'),
+])
+def test_netstring_buffered_or_not(buffered, data, parsed):
+    f = io.BytesIO(data)
+    if buffered:
+        f = io.BufferedReader(f)
+    assert receiver.read_netstring(f) == parsed
+
+
+@pytest.mark.parametrize('buffered', [False, True])
+@pytest.mark.parametrize('data', [b':,', b'5:hell', b'5:hello;', b'12345678:',
+                                  b'1a:x,', b'-1:,'])
+def test_netstring_fails_buffered_or_not(buffered, data):
+    f = io.BytesIO(data)
+    if buffered:
+        f = io.BufferedReader(f)
+    with pytest.raises(RuntimeError):
+        receiver.read_netstring(f)
+
+
+def fuzzed_environ(rng):
+    names = set()
+    while len(names) < rng.randint(1, 30):
+        names.add(bytes(bytearray(rng.randint(0x21, 0x7e)
+                                  for _ in range(rng.randint(1, 20)))))
+    values = [bytes(bytearray(rng.choice([0x09] + list(range(0x20, 0x7f)) +
+                                         list(range(0x80, 0x100)))
+                              for _ in range(rng.randint(0, 40))))
+              for _ in names]
+    return list(zip(names, values))
+
+
+def test_fuzzed_headers_round_trip(capture_logging):
+    rng = random.Random(0)
+    with capture_logging():
+        for _ in range(300):
+            variables = fuzzed_environ(rng)
+            block = b''.join(name + b'\x00' + value + b'\x00'
+                             for name, value in variables)
+            f = io.BufferedReader(io.BytesIO(netstring(block) + b'body'))
+            environ = receiver.read_headers(f)
+            assert environ == dict(
+                (name.decode('latin-1'), value.decode('latin-1'))
+                for name, value in variables)
+            assert f.read() == b'body'
+
+
+def test_fuzzed_garbage_is_refused_cleanly(capture_logging):
+    # whatever arrives, parsing either succeeds or fails with a
+    # RuntimeError, which is what callers expect
+    rng = random.Random(1)
+    valid = netstring(b'CONTENT_LENGTH\x000\x00HTTP_X\x00y\x00')
+    alphabet = bytearray(b'0123456789:,\x00\r\n\x7fAZ_ \xff')
+    with capture_logging() as logger:
+        for _ in range(2000):
+            data = bytearray(valid)
+            for _ in range(rng.randint(1, 4)):
+                position = rng.randrange(len(data) + 1)
+                action = rng.randrange(3)
+                if action == 0:
+                    data[position:position + 1] = b''
+                elif action == 1:
+                    data.insert(position, rng.choice(alphabet))
+                else:
+                    data[position:position + 1] = bytearray(
+                        [rng.choice(alphabet)])
+            for f in (io.BytesIO(bytes(data)),
+                      io.BufferedReader(io.BytesIO(bytes(data)))):
+                try:
+                    environ = receiver.read_headers(f)
+                except RuntimeError:
+                    continue
+                assert isinstance(environ, dict)
+        logger.flushTracebacks(RuntimeError)
+
+
+def test_handle_request_applies_connection_tuning(capture_logging):
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    tuning = common.SocketTuning(connection_options=[
+        common.parse_socket_option('TCP_NODELAY=1')])
+    nodelay = []
+
+    class RecordsNoDelay(object):
+        def __init__(self, sock):
+            nodelay.append(
+                sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+
+        def run_app(self, app):
+            pass
+
+    processor = receiver.SocketPassProcessor(
+        listener, request_processor=RecordsNoDelay, tuning=tuning)
+    try:
+        with capture_logging():
+            processor.handle_request(None)
+    finally:
+        client.close()
+        listener.close()
+    assert nodelay == [1]
+
+
+@pytest.mark.parametrize('error,survives', [
+    (socket.error(errno.EPIPE, os.strerror(errno.EPIPE)), True),
+    (socket.error(errno.ECONNRESET, os.strerror(errno.ECONNRESET)), True),
+    # a client that stalls past the socket's timeout
+    (socket.timeout('timed out'), True),
+    (socket.error(errno.EBADF, os.strerror(errno.EBADF)), False),
+])
+def test_handle_request_survives_client_going_away(capture_logging,
+                                                   error, survives):
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+
+    class Fails(object):
+        def __init__(self, sock):
+            pass
+
+        def run_app(self, app):
+            raise error
+
+    processor = receiver.SocketPassProcessor(listener,
+                                             request_processor=Fails)
+    try:
+        with capture_logging() as logger:
+            if survives:
+                processor.handle_request(None)
+            else:
+                with pytest.raises(socket.error):
+                    processor.handle_request(None)
+                logger.flushTracebacks(socket.error)
+    finally:
+        client.close()
+        listener.close()
+    gone = [message for message in logger.messages
+            if message.get('message_type') == 'wip:client_gone']
+    assert len(gone) == (1 if survives else 0)
+
+
+@pytest.mark.parametrize('garbage', [
+    b'nonsense',
+    b'5:abcde,',
+    b'12:CONTENT_LENGTH\x000\x00,',
+    b'4:A\x00B\x00;',
+])
+def test_handle_request_survives_malformed_headers(capture_logging, garbage):
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(2)
+    clients = [socket.create_connection(listener.getsockname())
+               for _ in range(2)]
+
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        return [environ['wsgi.input'].read(27)]
+
+    processor = receiver.SocketPassProcessor(listener)
+    try:
+        clients[0].sendall(garbage)
+        clients[1].sendall(SPEC_REQUEST)
+        with capture_logging() as logger:
+            processor.handle_request(app)
+            processor.handle_request(app)
+        # the first is dropped without an answer, and the next served
+        assert clients[0].makefile('rb').read() == b''
+        assert clients[1].makefile('rb').read().endswith(b'meaning of life')
+    finally:
+        for client in clients:
+            client.close()
+        listener.close()
+    [message] = [message for message in logger.messages
+                 if message.get('message_type') == 'wip:malformed_headers']
+    assert message['reason']
+
+
+def test_all_from_environment_adopts_inherited_sockets(capture_logging,
+                                                       monkeypatch):
+    listener = socket.socket(socket.AF_INET6)
+    listener.bind(('::1', 0))
+    listener.listen(1)
+    address = listener.getsockname()
+    # pretend the descriptor was inherited at the start of the range
+    fd = listener.detach()
+    environ = {'LISTEN_PID': str(os.getpid()), 'LISTEN_FDS': '1',
+               'LISTEN_FDNAMES': 'web'}
+    monkeypatch.setattr(receiver, 'listen_fds', lambda environ: [
+        (name, fd) for name, _ in common.listen_fds(environ)])
+    with capture_logging() as logger:
+        processors = receiver.SocketPassProcessor.all_from_environment(
+            environ)
+
+    [(name, processor)] = processors.items()
+    try:
+        assert name == 'web'
+        assert processor._sock.family == socket.AF_INET6
+        assert processor._sock.getsockname() == address
+        assert nonblocking(processor.fileno())
+    finally:
+        processor._sock.close()
+
+    [action] = LoggedAction.ofType(logger.messages, types.ADOPT_SOCKET)
+    assert action.succeeded
+    assert action.end_message['family'] == socket.AF_INET6
+
+
+class Streams(object):
+    # an application that streams until told to stop
+
+    def __init__(self, on_chunk=lambda count: None):
+        self.on_chunk = on_chunk
+        self.produced = 0
+        self.closed = False
+        self.send_queues = []
+
+    def __call__(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        self.send_queues.append(environ['wip.send_queue']())
+        return self._stream()
+
+    def _stream(self):
+        try:
+            while self.produced < 100:
+                self.produced += 1
+                self.on_chunk(self.produced)
+                yield b'x' * 10
+        finally:
+            self.closed = True
+
+
+def tcp_pair():
+    listener = socket.socket()
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.create_connection(listener.getsockname())
+        server, _ = listener.accept()
+    finally:
+        listener.close()
+    return server, client
+
+
+def test_streaming_stops_when_client_hangs_up(capture_logging):
+    # over TCP, writes after the client closes succeed for a while
+    server, client = tcp_pair()
+
+    def hang_up(count):
+        if count == 3:
+            # a client that closes with unread data resets the
+            # connection instead, and then writes fail anyway
+            received = b''
+            while not received.endswith(b'x' * 20):
+                received += client.recv(4096)
+            client.close()
+            # wait for the FIN
+            select.select([server], [], [], 5)
+
+    app = Streams(hang_up)
+    processor = receiver.SCGIRequestProcessor.from_sock(server)
+    try:
+        with capture_logging() as logger:
+            processor._respond(app, processor._populate_environment(
+                {'REQUEST_URI': '/'}, io.BytesIO()))
+    finally:
+        server.close()
+        client.close()
+    assert app.produced == 3
+    assert app.closed
+    assert len(LoggedAction.ofType(logger.messages, types.WSGI_REQUEST)) == 1
+    assert [message for message in logger.messages
+            if message.get('message_type') == u'wip:client_gone']
+
+
+def test_streaming_runs_to_completion(capture_logging):
+    server, client = socket.socketpair()
+    app = Streams()
+    processor = receiver.SCGIRequestProcessor.from_sock(server)
+    try:
+        with capture_logging():
+            processor._respond(app, processor._populate_environment(
+                {'REQUEST_URI': '/'}, io.BytesIO()))
+        server.shutdown(socket.SHUT_WR)
+        received = b''.join(iter(lambda: client.recv(4096), b''))
+    finally:
+        server.close()
+        client.close()
+    assert app.produced == 100
+    assert received.endswith(b'\r\n\r\n' + b'x' * 1000)
+    [(queued, capacity)] = app.send_queues
+    assert 0 <= queued <= capacity
+
+
+def test_send_queue_counts_unread_bytes():
+    server, client = socket.socketpair()
+    try:
+        before, capacity = common.send_queue(server)
+        server.sendall(b'x' * 1000)
+        after, _ = common.send_queue(server)
+    finally:
+        server.close()
+        client.close()
+    assert capacity > 0
+    assert after > before
+
+
+def test_requests_record_resource_usage(capture_logging):
+    def app(environ, start_response):
+        body = environ['wsgi.input'].read(5)
+        environ['wsgi.input'].readline()
+        start_response('200 OK', [])
+        return [body, str(sum(range(100000))).encode('ascii')]
+
+    outstream = io.BytesIO()
+    processor = receiver.SCGIRequestProcessor(None, outstream)
+    with capture_logging() as logger:
+        processor._respond(app, processor._populate_environment(
+            {'REQUEST_URI': '/'}, io.BytesIO(b'hello world\nmore')))
+    [action] = LoggedAction.ofType(logger.messages, types.WSGI_REQUEST)
+    fields = action.endMessage
+    assert fields['bytes_read'] == len(b'hello world\n')
+    assert fields['bytes_written'] == len(outstream.getvalue())
+    assert fields['cpu_seconds'] > 0
+    for name in ('user_seconds', 'system_seconds', 'voluntary_switches',
+                 'involuntary_switches', 'major_faults'):
+        assert fields[name] >= 0
+
+
+@pytest.mark.parametrize('text,cpus', [
+    ('0', [0]),
+    ('3,1', [1, 3]),
+    ('0-3,8', [0, 1, 2, 3, 8]),
+    ('2-2, 1', [1, 2]),
+    ('node1', [4, 5, 6, 7]),
+    ('node0,node1', [0, 1, 4, 5, 6, 7]),
+])
+def test_parse_cpus(tmpdir, text, cpus):
+    tmpdir.join('node0').write('0-1\n')
+    tmpdir.join('node1').write('4-7\n')
+    node_cpulist = str(tmpdir.join('node%d'))
+    assert common.parse_cpus(text, node_cpulist) == cpus
+
+
+@pytest.mark.parametrize('text', ['', 'x', '3-1', '-1', '1-', 'node9',
+                                  'nodex'])
+def test_parse_cpus_fails(tmpdir, text):
+    with pytest.raises(ValueError):
+        common.parse_cpus(text, str(tmpdir.join('node%d')))
+
+
+@pytest.mark.skipif(not hasattr(os, 'sched_setaffinity'),
+                    reason='no CPU affinity here')
+def test_pin_to_cpus():
+    allowed = common.allowed_cpus()
+    try:
+        assert common.pin_to_cpus(allowed[:1])
+        assert common.allowed_cpus() == allowed[:1]
+    finally:
+        os.sched_setaffinity(0, allowed)
+
+
+class FakeShard(object):
+
+    def __init__(self):
+        self.steered = None
+
+    def steer_to_cpu(self, cpu):
+        self.steered = cpu
+        return True
+
+
+def test_shard_processors(capture_logging):
+    names = ['default', 'default:1', 'default:2', 'admin']
+    processors = dict((name, FakeShard()) for name in names)
+    available = receiver.collections.OrderedDict(
+        (name, processors[name]) for name in names)
+    with capture_logging() as logger:
+        chosen = receiver.shard_processors(available, 4, cpu=3)
+    # shards wrap around; listeners without any are shared
+    assert list(chosen) == ['default', 'admin']
+    assert chosen['default'] == [processors['default:1']]
+    assert chosen['admin'] == [processors['admin']]
+    assert processors['default:1'].steered == 3
+    assert processors['admin'].steered is None
+    [message] = [message for message in logger.messages
+                 if message.get('message_type') == 'wip:steer_listener']
+    assert (message['name'], message['cpu']) == ('default:1', 3)
+    assert receiver.shard_processors(available, 0)['default'] == [
+        processors['default']]
+
+
+def test_shard_processors_without_a_shard_serves_them_all():
+    names = ['default', 'default:1', 'default:2', 'admin']
+    processors = dict((name, FakeShard()) for name in names)
+    available = receiver.collections.OrderedDict(
+        (name, processors[name]) for name in names)
+    chosen = receiver.shard_processors(available)
+    assert chosen == {
+        'default': [processors[name] for name in names[:3]],
+        'admin': [processors['admin']],
+    }
+    assert all(processor.steered is None for processor in processors.values())
+
+
+def test_steer_to_cpu():
+    tcp = socket.socket()
+    unix = socket.socket(socket.AF_UNIX)
+    try:
+        if common.SO_INCOMING_CPU is None:
+            assert not common.steer_to_cpu(tcp, 0)
+        else:
+            assert common.steer_to_cpu(tcp, 0)
+            assert tcp.getsockopt(socket.SOL_SOCKET,
+                                  common.SO_INCOMING_CPU) == 0
+        assert not common.steer_to_cpu(unix, 0)
+    finally:
+        tcp.close()
+        unix.close()
+
+
+def test_dispatched_processor_serves_passed_connections(capture_logging):
+    daemon, channel = socket.socketpair()
+    server, client = socket.socketpair()
+    processor = receiver.DispatchedProcessor(channel)
+    try:
+        client.sendall(SPEC_REQUEST)
+
+        def app(environ, start_response):
+            body = environ['wsgi.input'].read(27)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [body.upper()]
+
+        # the daemon's side: a connection for the READY_BYTE
+        daemon.sendmsg([common.describe_socket(server)], [
+            (socket.SOL_SOCKET, socket.SCM_RIGHTS,
+             struct.pack('i', server.fileno()))])
+        server.close()
+        with capture_logging():
+            processor.handle_request(app)
+        assert daemon.recv(1) == common.READY_BYTE
+        client.shutdown(socket.SHUT_WR)
+        response = client.makefile('rb').read()
+        assert response.startswith(b'Status: 200 OK\r\n')
+        assert response.endswith(b'WHAT IS THE MEANING OF LIFE')
+
+        # once the daemon's gone, so is the receiver
+        daemon.close()
+        with pytest.raises(SystemExit):
+            processor.handle_request(app)
+    finally:
+        processor.close()
+        client.close()
+
+
+@pytest.fixture
+def graceful():
+    graceful = receiver.GracefulExit()
+    handler = signal.getsignal(signal.SIGTERM)
+    graceful.install()
+    try:
+        yield graceful
+    finally:
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGTERM, handler)
+
+
+def test_graceful_exit_wakes_a_wait(graceful):
+    readable, unreadable = socket.socketpair()
+    try:
+        readable.sendall(b'x')
+        assert graceful.wait([unreadable.fileno()]) == [unreadable.fileno()]
+        # a signal that isn't SIGTERM wakes it, but doesn't stop it
+        handler = signal.signal(signal.SIGUSR2, noop)
+        try:
+            timer = threading.Timer(
+                0.1, os.kill, (os.getpid(), signal.SIGUSR2))
+            timer.start()
+            unreadable.sendall(b'x')
+            assert graceful.wait([readable.fileno()]) == [readable.fileno()]
+            timer.join()
+        finally:
+            signal.signal(signal.SIGUSR2, handler)
+        readable.recv(1)
+        timer = threading.Timer(0.1, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+        with pytest.raises(SystemExit):
+            graceful.wait([readable.fileno()])
+        timer.join()
+    finally:
+        readable.close()
+        unreadable.close()
+
+
+def test_sigterm_lets_the_request_running_finish(capture_logging, graceful):
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+    processor = receiver.SocketPassProcessor(listener)
+    clients = [socket.create_connection(listener.getsockname())
+               for _ in range(2)]
+    try:
+        for client in clients:
+            client.sendall(SPEC_REQUEST)
+            client.shutdown(socket.SHUT_WR)
+            client.settimeout(5)
+
+        def app(environ, start_response):
+            os.kill(os.getpid(), signal.SIGTERM)
+            assert graceful.requested
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [environ['wsgi.input'].read(27).upper()]
+
+        with capture_logging():
+            with pytest.raises(SystemExit):
+                receiver.serve([processor], app, graceful)
+        response = clients[0].makefile('rb').read()
+        assert response.startswith(b'Status: 200 OK\r\n')
+        assert response.endswith(b'WHAT IS THE MEANING OF LIFE')
+        # the next connection was left for another receiver
+        assert processor.accept_queue()[0] == 1
+    finally:
+        processor.close()
+        for client in clients:
+            client.close()
+
+
+def fake_dispatcher(daemon, connection=None):
+    # takes a READY_BYTE and its UNREADY_BYTE, then sends connection, if
+    # any, as though it had been on its way before the UNREADY_BYTE
+    # arrived, and lets the receiver go
+    def run():
+        assert daemon.recv(1) == common.READY_BYTE
+        assert daemon.recv(1) == common.UNREADY_BYTE
+        if connection is not None:
+            daemon.sendmsg([common.describe_socket(connection)], [
+                (socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                 struct.pack('i', connection.fileno()))])
+        daemon.shutdown(socket.SHUT_RDWR)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def test_dispatched_processor_takes_back_its_ready(graceful):
+    daemon, channel = socket.socketpair()
+    processor = receiver.DispatchedProcessor(channel)
+    try:
+        dispatcher = fake_dispatcher(daemon)
+        timer = threading.Timer(0.1, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+        with pytest.raises(SystemExit) as exited:
+            receiver.serve([processor], noop, graceful)
+        timer.join()
+        dispatcher.join(5)
+        assert not dispatcher.is_alive()
+        assert exited.value.code == 0
+    finally:
+        processor.close()
+        daemon.close()
+
+
+def test_dispatched_processor_serves_what_was_on_its_way(capture_logging,
+                                                         graceful):
+    daemon, channel = socket.socketpair()
+    server, client = socket.socketpair()
+    processor = receiver.DispatchedProcessor(channel)
+    try:
+        client.sendall(SPEC_REQUEST)
+        client.shutdown(socket.SHUT_WR)
+        dispatcher = fake_dispatcher(daemon, server)
+
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [environ['wsgi.input'].read(27).upper()]
+
+        timer = threading.Timer(0.1, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+        with capture_logging():
+            with pytest.raises(SystemExit) as exited:
+                receiver.serve([processor], app, graceful)
+        timer.join()
+        dispatcher.join(5)
+        assert exited.value.code == 0
+        client.settimeout(5)
+        assert client.makefile('rb').read().endswith(
+            b'WHAT IS THE MEANING OF LIFE')
+    finally:
+        processor.close()
+        daemon.close()
+        server.close()
+        client.close()
+
+
+def test_dispatched_needs_a_handoff_path():
+    with pytest.raises(SystemExit):
+        receiver.parse_args(['--dispatched'])
+    with pytest.raises(SystemExit):
+        receiver.parse_args(['--dispatched', '--twisted', 'handoff.sock'])
+    assert receiver.parse_args(['--dispatched', 'handoff.sock']).dispatched
+
+
+@pytest.mark.parametrize('argv', [
+    ['--spool-memory', '10', 'handoff.sock'],
+    ['--spool-max', '10', 'handoff.sock'],
+    ['--twisted', '--spool-dir', '/tmp', 'handoff.sock'],
+])
+def test_parse_args_spool_options_need_spool(argv):
+    with pytest.raises(SystemExit):
+        receiver.parse_args(argv)
+
+
+def test_parse_args_spool_memory():
+    assert receiver.parse_args(['h.sock']).spool_memory == 1024 * 1024
+    for argv in (['--spool', '--spool-memory', '10', 'h.sock'],
+                 ['--twisted', '--spool-memory', '10', 'h.sock']):
+        assert receiver.parse_args(argv).spool_memory == 10
+
+
+def open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+needs_proc = pytest.mark.skipif(not os.path.isdir('/proc/self/fd'),
+                                reason='no /proc/self/fd here')
+
+
+def send_fds(sock, data, socks):
+    fds = [skt.fileno() for skt in socks]
+    sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                           struct.pack('%di' % len(fds), *fds))])
+
+
+@needs_proc
+def test_read_handoff_closes_descriptors_when_cut_short():
+    server, client = socket.socketpair()
+    listener = socket.socket()
+    try:
+        send_fds(server, b'\x02', [listener])
+        server.close()
+        before = open_fds()
+        with pytest.raises(RuntimeError):
+            receiver.read_handoff(client)
+        assert open_fds() == before
+    finally:
+        client.close()
+        listener.close()
+
+
+@pytest.fixture
+def handoff_daemon(tmpdir):
+    # answers one version 2 handoff request with two listeners, the
+    # second split in two shards.  (path, a callable that waits until
+    # it's answered and let go of the connection)
+    path = str(tmpdir.join('handoff.sock'))
+    server = socket.socket(socket.AF_UNIX)
+    server.bind(path)
+    server.listen(1)
+    listeners = [socket.socket() for _ in range(3)]
+    names = [b'default', b'admin', b'admin:1']
+
+    def answer():
+        conn, _ = server.accept()
+        with conn:
+            conn.recv(len(common.version_request()), socket.MSG_WAITALL)
+            send_fds(conn, common.encode_handoff(
+                [(name, common.describe_socket(listener))
+                 for name, listener in zip(names, listeners)]), listeners)
+    thread = threading.Thread(target=answer)
+    thread.daemon = True
+    thread.start()
+    yield path, lambda: thread.join(5)
+    thread.join(5)
+    server.close()
+    for listener in listeners:
+        listener.close()
+
+
+def nonblocking(fd):
+    # of the open file description every copy of the listener shares
+    return bool(fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_NONBLOCK)
+
+
+def test_all_from_path_leaves_listeners_nonblocking(handoff_daemon):
+    path, answered = handoff_daemon
+    processors = receiver.SocketPassProcessor.all_from_path(path)
+    answered()
+    try:
+        assert all(nonblocking(processor.fileno())
+                   for processor in processors.values())
+    finally:
+        for processor in processors.values():
+            processor.close()
+
+
+@needs_proc
+def test_all_from_path_keeps_only_its_copies(handoff_daemon):
+    path, answered = handoff_daemon
+    before = open_fds()
+    processors = receiver.SocketPassProcessor.all_from_path(path)
+    answered()
+    assert list(processors) == ['default', 'admin', 'admin:1']
+    assert open_fds() == before + 3
+    for processor in processors.values():
+        processor.close()
+    assert open_fds() == before
+
+
+def listener_args(*argv):
+    return receiver.parse_args(list(argv))
+
+
+@needs_proc
+def test_find_processors_closes_unwanted_listeners(handoff_daemon):
+    path, answered = handoff_daemon
+    before = open_fds()
+    processors = receiver.find_processors(
+        listener_args('--listener', 'admin', path))
+    answered()
+    # both of admin's shards, and nothing of default's
+    assert len(processors) == 2
+    assert open_fds() == before + 2
+    for processor in processors:
+        processor.close()
+
+
+@needs_proc
+def test_find_processors_unknown_listener(handoff_daemon):
+    path, answered = handoff_daemon
+    before = open_fds()
+    with pytest.raises(SystemExit) as excinfo:
+        receiver.find_processors(listener_args('--listener', 'nope', path))
+    answered()
+    assert str(excinfo.value) == (
+        'no listener named nope; there are: default, admin')
+    assert open_fds() == before
@@ -0,0 +1,226 @@
+import collections
+import re
+import threading
+import time
+
+from wip.common import thread_cpu_time
+from wip.lazy import types as t
+
+
+DEFAULT_MAX_ROUTES = 1000
+DEFAULT_FLUSH_INTERVAL = 60
+# where requests go once max_routes routes have been seen
+OTHER_ROUTE = '(other)'
+
+_PLACEHOLDER = re.compile(r'\{[^/{}]*\}')
+# path segments that are probably identifiers rather than names:
+# numbers, UUIDs and long runs of hex
+_ID_SEGMENT = re.compile(
+    r'^(?:\d+|[0-9a-fA-F]{8}(?:-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12}'
+    r'|[0-9a-fA-F]{16,})$')
+
+
+def template_pattern(template):
+    # a regular expression for a template like /users/{id}/posts, where
+    # each {name} stands for one path segment and a trailing * for
+    # anything at all.  templates starting with ^ are already one.
+    if template.startswith('^'):
+        return re.compile(template)
+    prefix = template.endswith('*')
+    if prefix:
+        template = template[:-1]
+    parts = _PLACEHOLDER.split(template)
+    pattern = '[^/]+'.join(re.escape(part) for part in parts)
+    return re.compile('^%s%s' % (pattern, '' if prefix else '$'))
+
+
+def collapse_ids(path):
+    # the path with identifier-like segments replaced by {id}
+    return '/'.join('{id}' if _ID_SEGMENT.match(segment) else segment
+                    for segment in path.split('/'))
+
+
+class RouteNormalizer(object):
+    # maps paths to the first template that matches them, and any other
+    # path to itself with its identifiers collapsed
+
+    def __init__(self, templates=()):
+        self.templates = [(template, template_pattern(template))
+                          for template in templates]
+
+    def __call__(self, path):
+        for template, pattern in self.templates:
+            if pattern.match(path):
+                return template
+        return collapse_ids(path)
+
+
+class _Route(object):
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.bytes_out = 0
+        self.statuses = collections.Counter()
+
+    def report(self):
+        return {'count': self.count,
+                'seconds': self.seconds,
+                'max_seconds': self.max_seconds,
+                'cpu_seconds': self.cpu_seconds,
+                'bytes_out': self.bytes_out,
+                'statuses': dict(self.statuses)}
+
+
+class RouteStats(object):
+    # thread safe totals per route.  past max_routes distinct routes,
+    # everything else is counted under OTHER_ROUTE.
+
+    def __init__(self, max_routes=DEFAULT_MAX_ROUTES):
+        self.max_routes = max_routes
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, seconds, bytes_out, status_class,
+               cpu_seconds=0.0):
+        with self._lock:
+            totals = self._routes.get(route)
+            if totals is None:
+                if len(self._routes) >= self.max_routes:
+                    route = OTHER_ROUTE
+                totals = self._routes.setdefault(route, _Route())
+            totals.count += 1
+            totals.seconds += seconds
+            totals.max_seconds = max(totals.max_seconds, seconds)
+            totals.cpu_seconds += cpu_seconds
+            totals.bytes_out += bytes_out
+            totals.statuses[status_class] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict((route, totals.report())
+                        for route, totals in self._routes.items())
+
+    def flush(self):
+        # the totals since the last flush, which are logged, one
+        # wip:route_stats message per route, and then forgotten
+        with self._lock:
+            routes, self._routes = self._routes, {}
+        report = dict((route, totals.report())
+                      for route, totals in routes.items())
+        for route, totals in sorted(report.items()):
+            t.ROUTE_STATS(route=route, **totals).write()
+        return report
+
+
+def status_class(status):
+    return status[:1] + 'xx'
+
+
+class AccountRoutes(object):
+    # WSGI middleware that adds up, per route, how many requests there
+    # were, how long they took from the call to the response's close,
+    # how much of that was CPU time, how much they wrote and their
+    # status classes.  routes are paths as normalize sees them.  the
+    # totals are flushed every flush_interval seconds, checked as
+    # requests finish, or at the end of the next request after
+    # request_flush is called.
+
+    def __init__(self, app, stats=None, normalize=None,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, seconds=time.time):
+        self.app = app
+        self.stats = RouteStats() if stats is None else stats
+        self.normalize = RouteNormalizer() if normalize is None else normalize
+        self.flush_interval = flush_interval
+        self._seconds = seconds
+        self._last_flush = seconds()
+        self._flush_requested = False
+
+    def request_flush(self):
+        # safe from a signal handler
+        self._flush_requested = True
+
+    def __call__(self, environ, start_response):
+        account = _Account(self, self.normalize(environ.get('PATH_INFO', '')),
+                           self._seconds(), thread_cpu_time())
+
+        def accounting_start_response(status, response_headers,
+                                      exc_info=None):
+            account.status = status
+            write = start_response(status, response_headers, exc_info)
+
+            def accounting_write(data):
+                account.bytes_out += len(data)
+                write(data)
+            return accounting_write
+
+        try:
+            result = self.app(environ, accounting_start_response)
+        except Exception:
+            account.finish()
+            raise
+        return _Accounted(result, account)
+
+    def _finished(self, now):
+        if self._flush_requested or (
+                self.flush_interval and
+                now - self._last_flush >= self.flush_interval):
+            self._flush_requested = False
+            self._last_flush = now
+            self.stats.flush()
+
+
+class _Account(object):
+    # one request's part of the totals
+
+    def __init__(self, accounting, route, started, cpu_started):
+        self._accounting = accounting
+        self.route = route
+        self.started = started
+        self.cpu_started = cpu_started
+        self.status = None
+        self.bytes_out = 0
+        self._finished = False
+
+    def finish(self, failed=False):
+        if self._finished:
+            return
+        self._finished = True
+        now = self._accounting._seconds()
+        # a response that never started, or failed part way, is the
+        # server's error whatever the application said
+        if failed or self.status is None:
+            status = 'error'
+        else:
+            status = status_class(self.status)
+        self._accounting.stats.record(
+            self.route, now - self.started, self.bytes_out, status,
+            thread_cpu_time() - self.cpu_started)
+        self._accounting._finished(now)
+
+
+class _Accounted(object):
+
+    def __init__(self, result, account):
+        self._result = result
+        self._account = account
+        self._failed = False
+
+    def __iter__(self):
+        try:
+            for chunk in self._result:
+                self._account.bytes_out += len(chunk)
+                yield chunk
+        except Exception:
+            self._failed = True
+            raise
+
+    def close(self):
+        try:
+            close = getattr(self._result, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._account.finish(self._failed)
@@ -0,0 +1,139 @@
+from eliot.testing import LoggedMessage
+import pytest
+
+from wip import routes, types
+
+
+@pytest.mark.parametrize('template,path,matches', [
+    ('/users/{id}', '/users/42', True),
+    ('/users/{id}', '/users/42/posts', False),
+    ('/users/{id}/posts', '/users/bob/posts', True),
+    ('/static/*', '/static/css/site.css', True),
+    ('/static/*', '/statics', False),
+    ('/a.b', '/axb', False),
+    (r'^/api/v\d+/', '/api/v2/things', True),
+])
+def test_template_pattern(template, path, matches):
+    assert bool(routes.template_pattern(template).match(path)) is matches
+
+
+@pytest.mark.parametrize('path,collapsed', [
+    ('/users/42/posts/7', '/users/{id}/posts/{id}'),
+    ('/items/0123456789abcdef0123', '/items/{id}'),
+    ('/u/123e4567-e89b-12d3-a456-426614174000', '/u/{id}'),
+    ('/about/team', '/about/team'),
+    ('/', '/'),
+])
+def test_collapse_ids(path, collapsed):
+    assert routes.collapse_ids(path) == collapsed
+
+
+def test_normalizer_prefers_templates():
+    normalize = routes.RouteNormalizer(['/users/{name}', '/static/*'])
+    assert normalize('/users/bob') == '/users/{name}'
+    assert normalize('/static/1/2') == '/static/*'
+    assert normalize('/orders/9') == '/orders/{id}'
+
+
+def test_stats_overflow_into_other():
+    stats = routes.RouteStats(max_routes=2)
+    for route in ['/a', '/b', '/c', '/d', '/a']:
+        stats.record(route, 0.5, 10, '2xx')
+    snapshot = stats.snapshot()
+    assert sorted(snapshot) == ['(other)', '/a', '/b']
+    assert snapshot['(other)']['count'] == 2
+    assert snapshot['/a'] == {'count': 2, 'seconds': 1.0,
+                              'max_seconds': 0.5, 'cpu_seconds': 0.0,
+                              'bytes_out': 20, 'statuses': {'2xx': 2}}
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def run(middleware, path):
+    environ = {'PATH_INFO': path, 'REQUEST_METHOD': 'GET'}
+    response = middleware(environ, lambda status, headers, exc_info: None)
+    try:
+        return b''.join(response)
+    finally:
+        response.close()
+
+
+def test_requests_are_accounted(capture_logging):
+    clock = Clock()
+
+    def app(environ, start_response):
+        clock.now += 0.25
+        if environ['PATH_INFO'] == '/missing/3':
+            start_response('404 Not Found', [])
+            return [b'no']
+        start_response('200 OK', [])
+        return [b'hello', b'!']
+
+    middleware = routes.AccountRoutes(app, flush_interval=0, seconds=clock)
+    with capture_logging():
+        run(middleware, '/users/1')
+        run(middleware, '/users/2')
+        run(middleware, '/missing/3')
+    snapshot = middleware.stats.snapshot()
+    assert snapshot['/users/{id}'].pop('cpu_seconds') >= 0
+    assert snapshot['/users/{id}'] == {'count': 2, 'seconds': 0.5,
+                                       'max_seconds': 0.25, 'bytes_out': 12,
+                                       'statuses': {'2xx': 2}}
+    assert snapshot['/missing/{id}']['statuses'] == {'4xx': 1}
+
+
+def test_failures_are_accounted_as_errors(capture_logging):
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        yield b'partial'
+        raise ValueError()
+
+    middleware = routes.AccountRoutes(app, flush_interval=0)
+    with capture_logging():
+        with pytest.raises(ValueError):
+            run(middleware, '/')
+    assert middleware.stats.snapshot()['/']['statuses'] == {'error': 1}
+
+
+def test_flushes_periodically_and_on_request(capture_logging):
+    clock = Clock()
+
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        return [b'x']
+
+    middleware = routes.AccountRoutes(app, flush_interval=60, seconds=clock)
+    with capture_logging() as logger:
+        run(middleware, '/')
+        assert not logger.messages
+        clock.now += 60
+        run(middleware, '/')
+        [flushed] = LoggedMessage.ofType(logger.messages, types.ROUTE_STATS)
+        assert (flushed.message['route'], flushed.message['count']) == (
+            '/', 2)
+        assert not middleware.stats.snapshot()
+
+        middleware.request_flush()
+        run(middleware, '/other')
+    flushed = LoggedMessage.ofType(logger.messages, types.ROUTE_STATS)
+    assert [message.message['route'] for message in flushed] == [
+        '/', '/other']
+
+
+def test_cpu_time_is_accounted(capture_logging):
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        # burn some CPU
+        return [str(sum(range(200000))).encode('ascii')]
+
+    middleware = routes.AccountRoutes(app, flush_interval=0)
+    with capture_logging():
+        run(middleware, '/busy')
+    assert middleware.stats.snapshot()['/busy']['cpu_seconds'] > 0
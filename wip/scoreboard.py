@@ -0,0 +1,134 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+_ALIGN = 64
+# pid, capacity, active requests, requests finished, seconds spent on
+# finished requests, and the sum of the start times of active ones
+_SLOT = struct.Struct('=IIIxxxxQdd')
+
+
+class Scoreboard(object):
+    # a file of fixed slots, one per receiver, where each says how busy
+    # its receiver is.  a receiver only writes its own slot; anyone can
+    # read them all.
+
+    def __init__(self, path, slots):
+        self.slots = slots
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            size = slots * _ALIGN
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def clear(self, index):
+        self._map[index * _ALIGN:(index + 1) * _ALIGN] = b'\0' * _ALIGN
+
+    def slot(self, index, capacity=1, seconds=time.time):
+        return ScoreboardSlot(self._map, index * _ALIGN, capacity, seconds)
+
+    def read(self, index, now):
+        # (pid, capacity, active requests, finished requests, busy
+        # seconds up to now)
+        (pid, capacity, active, requests, busy,
+         started) = _SLOT.unpack_from(self._map, index * _ALIGN)
+        # a slot's fields aren't written atomically, so a reader can
+        # see them part way through a change; never more than one
+        # request's worth out
+        return pid, capacity, active, requests, max(
+            0.0, busy + active * now - started)
+
+
+class ScoreboardSlot(object):
+    # a receiver's own slot, which it marks busy while it runs each of
+    # up to capacity requests at once
+
+    def __init__(self, scoreboard_map, offset, capacity, seconds):
+        self._map = scoreboard_map
+        self._offset = offset
+        self._seconds = seconds
+        self._lock = threading.Lock()
+        self._active = 0
+        self._requests = 0
+        self._busy = 0.0
+        self._started = 0.0
+        self._capacity = capacity
+        self._pid = os.getpid()
+        self._write()
+
+    def _write(self):
+        _SLOT.pack_into(self._map, self._offset, self._pid, self._capacity,
+                        self._active, self._requests, self._busy,
+                        self._started)
+
+    def busy(self):
+        # returns when the request started, for idle
+        now = self._seconds()
+        with self._lock:
+            self._active += 1
+            self._started += now
+            self._write()
+        return now
+
+    def idle(self, started):
+        now = self._seconds()
+        with self._lock:
+            self._active -= 1
+            # with nothing running, start afresh rather than carry
+            # rounding errors forward
+            self._started = self._started - started if self._active else 0.0
+            self._requests += 1
+            self._busy += now - started
+            self._write()
+
+
+class MarkBusy(object):
+    # WSGI middleware that marks slot busy from the application's call
+    # to its response's close
+
+    def __init__(self, app, slot):
+        self.app = app
+        self.slot = slot
+
+    def __call__(self, environ, start_response):
+        started = self.slot.busy()
+        try:
+            result = self.app(environ, start_response)
+        except BaseException:
+            self.slot.idle(started)
+            raise
+        return _Busy(result, self.slot, started)
+
+
+class _Busy(object):
+
+    def __init__(self, result, slot, started):
+        self._result = result
+        self._slot = slot
+        self._started = started
+        self._closed = False
+
+    def __iter__(self):
+        return iter(self._result)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            close = getattr(self._result, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._slot.idle(self._started)
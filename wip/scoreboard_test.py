@@ -0,0 +1,89 @@
+import pytest
+
+from wip import scoreboard
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def board(tmpdir):
+    board = scoreboard.Scoreboard(str(tmpdir.join('scoreboard')), 4)
+    yield board
+    board.close()
+
+
+def test_empty_slots(board):
+    assert board.read(3, 1000.0) == (0, 0, 0, 0, 0.0)
+
+
+def test_busy_seconds_include_running_requests(board):
+    clock = Clock()
+    slot = board.slot(1, capacity=2, seconds=clock)
+    first = slot.busy()
+    clock.now += 1
+    second = slot.busy()
+    clock.now += 2
+    pid, capacity, active, requests, busy = board.read(1, clock.now)
+    assert capacity == 2
+    assert (active, requests, busy) == (2, 0, 5.0)
+
+    slot.idle(first)
+    clock.now += 1
+    assert board.read(1, clock.now)[2:] == (1, 1, 6.0)
+    slot.idle(second)
+    clock.now += 10
+    assert board.read(1, clock.now)[2:] == (0, 2, 6.0)
+    # the other slots are untouched
+    assert board.read(0, clock.now) == (0, 0, 0, 0, 0.0)
+
+
+def test_readers_share_the_file(tmpdir):
+    path = str(tmpdir.join('scoreboard'))
+    writer = scoreboard.Scoreboard(path, 1)
+    reader = scoreboard.Scoreboard(path, 2)
+    try:
+        clock = Clock()
+        writer.slot(0, seconds=clock).busy()
+        clock.now += 3
+        assert reader.read(0, clock.now)[2:] == (1, 0, 3.0)
+        reader.clear(0)
+        assert writer.read(0, clock.now) == (0, 0, 0, 0, 0.0)
+    finally:
+        writer.close()
+        reader.close()
+
+
+def test_mark_busy_until_close(board):
+    clock = Clock()
+    slot = board.slot(0, seconds=clock)
+
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        clock.now += 1
+        return [b'hello']
+
+    result = scoreboard.MarkBusy(app, slot)({}, lambda *a: None)
+    assert list(result) == [b'hello']
+    clock.now += 1
+    assert board.read(0, clock.now)[2:] == (1, 0, 2.0)
+    result.close()
+    result.close()
+    assert board.read(0, clock.now)[2:] == (0, 1, 2.0)
+
+
+def test_mark_busy_failing_app(board):
+    slot = board.slot(0)
+
+    def app(environ, start_response):
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        scoreboard.MarkBusy(app, slot)({}, lambda *a: None)
+    assert board.read(0, 0.0)[2:4] == (0, 1)
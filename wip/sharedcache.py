@@ -0,0 +1,220 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+
+DEFAULT_SLOTS = 4096
+DEFAULT_SLOT_SIZE = 16 * 1024
+DEFAULT_WAYS = 8
+
+_MAGIC = b'wipcache'
+_VERSION = 1
+_ALIGN = 64
+
+# magic, version, ways, slots, slot size
+_FILE_HEADER = struct.Struct('=8sHHII')
+# seq, referenced, key hash, key length, expiry time, value length.
+# seq is odd while the slot is being written.
+_SLOT_HEADER = struct.Struct('=IB3xIH2xdI4x')
+_SEQ = struct.Struct('=I')
+_REFERENCED_OFFSET = _SEQ.size
+
+
+def _aligned(size):
+    return -(-size // _ALIGN) * _ALIGN
+
+
+def _key_hash(key):
+    # stable across processes, unlike hash()
+    return zlib.crc32(key) & 0xffffffff
+
+
+class SharedStore(object):
+    # a response store in a file every process that opens it maps, so
+    # all the receivers on a host share one cache.
+    #
+    # the file is a fixed-slot hash table, set associative: a key can
+    # only live in one of ways slots, chosen by its hash.  each slot
+    # holds one key and value of up to slot_size bytes together.
+    #
+    # reads take no locks.  each slot has a sequence number that a
+    # writer makes odd before changing the slot and even again after,
+    # and readers check it's even and unchanged around what they read.
+    # writers lock their set with fcntl, so they only contend with
+    # other writers to the same set.  fcntl locks are per process, so
+    # threads also take a lock of their own.  a set's victim is chosen
+    # by CLOCK over its slots, each of which a hit marks as referenced.
+
+    def __init__(self, path, slots=DEFAULT_SLOTS, slot_size=DEFAULT_SLOT_SIZE,
+                 ways=DEFAULT_WAYS, seconds=time.time):
+        if not 0 < ways < 256 or slots % ways:
+            raise ValueError('slots must be a multiple of ways, which '
+                             'must be less than 256')
+        self._seconds = seconds
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._attach(slots, slot_size, ways)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def _attach(self, slots, slot_size, ways):
+        # the first process to get here formats the file; the rest use
+        # whatever geometry it chose
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, _ALIGN, 0)
+        try:
+            header = os.read(self._fd, _FILE_HEADER.size)
+            if len(header) == _FILE_HEADER.size:
+                magic, version, ways, slots, slot_size = (
+                    _FILE_HEADER.unpack(header))
+                if magic != _MAGIC or version != _VERSION:
+                    raise ValueError('not a wip cache file')
+                self._geometry(slots, slot_size, ways)
+            else:
+                self._geometry(slots, slot_size, ways)
+                os.ftruncate(self._fd, self._size)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, _FILE_HEADER.pack(
+                    _MAGIC, _VERSION, ways, slots, slot_size))
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, _ALIGN, 0)
+        self._map = mmap.mmap(self._fd, self._size)
+        self._view = memoryview(self._map)
+
+    def _geometry(self, slots, slot_size, ways):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.ways = ways
+        self.sets = slots // ways
+        self.max_bytes = slot_size - _SLOT_HEADER.size
+        # one CLOCK hand per set
+        self._hands = _ALIGN
+        self._first_slot = self._hands + _aligned(self.sets)
+        self._size = self._first_slot + slots * slot_size
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+        os.close(self._fd)
+
+    def _set_of(self, key_hash):
+        return key_hash % self.sets
+
+    def _slot_offset(self, which_set, way):
+        return (self._first_slot +
+                (which_set * self.ways + way) * self.slot_size)
+
+    def _find(self, key):
+        # (slot offset, seq, value offset, value length) for a live
+        # entry for key, or None
+        key_hash = _key_hash(key)
+        which_set = self._set_of(key_hash)
+        now = self._seconds()
+        for way in range(self.ways):
+            offset = self._slot_offset(which_set, way)
+            (seq, _, slot_hash, key_length,
+             expires, value_length) = _SLOT_HEADER.unpack_from(
+                 self._map, offset)
+            if seq & 1 or slot_hash != key_hash or expires <= now:
+                continue
+            key_offset = offset + _SLOT_HEADER.size
+            value_offset = key_offset + key_length
+            if (value_offset + value_length > offset + self.slot_size or
+                    self._view[key_offset:value_offset] != key):
+                continue
+            return offset, seq, value_offset, value_length
+        return None
+
+    def _unchanged(self, offset, seq):
+        return _SEQ.unpack_from(self._map, offset)[0] == seq
+
+    def get_view(self, key):
+        # (a memoryview of the value in the mapping, a callable that
+        # says whether it's still intact) or None.  nothing's copied, so
+        # check the value's intact after using it.
+        found = self._find(key)
+        if found is None:
+            return None
+        offset, seq, value_offset, value_length = found
+        view = self._view[value_offset:value_offset + value_length]
+        if not self._unchanged(offset, seq):
+            return None
+        self._map[offset + _REFERENCED_OFFSET] = 1
+        return view, lambda: self._unchanged(offset, seq)
+
+    def get(self, key):
+        found = self.get_view(key)
+        if found is None:
+            return None
+        view, intact = found
+        value = view.tobytes()
+        return value if intact() else None
+
+    def put(self, key, value, ttl):
+        if len(key) + len(value) > self.max_bytes:
+            return
+        key_hash = _key_hash(key)
+        which_set = self._set_of(key_hash)
+        first = self._slot_offset(which_set, 0)
+        with self._lock:
+            self._put_locked(which_set, first, key, key_hash, value, ttl)
+
+    def _put_locked(self, which_set, first, key, key_hash, value, ttl):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self.ways * self.slot_size,
+                    first)
+        try:
+            offset = self._victim(which_set, key)
+            seq = _SEQ.unpack_from(self._map, offset)[0]
+            # odd already if a writer died part way through this slot
+            writing = seq | 1
+            _SEQ.pack_into(self._map, offset, writing)
+            key_offset = offset + _SLOT_HEADER.size
+            value_offset = key_offset + len(key)
+            self._map[key_offset:value_offset] = key
+            self._map[value_offset:value_offset + len(value)] = value
+            _SLOT_HEADER.pack_into(
+                self._map, offset, writing, 0, key_hash, len(key),
+                self._seconds() + ttl, len(value))
+            _SEQ.pack_into(self._map, offset, (writing + 1) & 0xffffffff)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self.ways * self.slot_size,
+                        first)
+
+    def _victim(self, which_set, key):
+        # the slot already holding key, an empty or expired one, or
+        # the first unreferenced one from the set's hand onwards.
+        # called with the set locked.
+        now = self._seconds()
+        found = self._find(key)
+        if found is not None:
+            return found[0]
+        for way in range(self.ways):
+            offset = self._slot_offset(which_set, way)
+            (_, _, _, _, expires, _) = _SLOT_HEADER.unpack_from(
+                self._map, offset)
+            if expires <= now:
+                return offset
+        hand = self._hands + which_set
+        way = self._map[hand]
+        while True:
+            offset = self._slot_offset(which_set, way)
+            way = (way + 1) % self.ways
+            referenced = offset + _REFERENCED_OFFSET
+            if self._map[referenced]:
+                self._map[referenced] = 0
+                continue
+            self._map[hand] = way
+            return offset
+
+    def __len__(self):
+        now = self._seconds()
+        return sum(
+            1 for slot in range(self.slots)
+            if _SLOT_HEADER.unpack_from(
+                self._map,
+                self._first_slot + slot * self.slot_size)[4] > now)
@@ -0,0 +1,187 @@
+import subprocess
+import sys
+
+import pytest
+
+from wip import microcache, sharedcache
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir.join('cache'))
+
+
+@pytest.fixture
+def store(path, clock):
+    store = sharedcache.SharedStore(path, slots=16, slot_size=256, ways=4,
+                                    seconds=clock)
+    yield store
+    store.close()
+
+
+def test_round_trip(store):
+    assert store.get(b'key') is None
+    store.put(b'key', b'value', 10)
+    assert store.get(b'key') == b'value'
+    store.put(b'key', b'replaced', 10)
+    assert store.get(b'key') == b'replaced'
+    assert len(store) == 1
+
+
+def test_get_view_is_the_mapping(store):
+    store.put(b'key', b'value', 10)
+    view, intact = store.get_view(b'key')
+    assert isinstance(view, memoryview)
+    assert view == b'value'
+    assert intact()
+    store.put(b'key', b'other', 10)
+    # the same memory, now holding something else
+    assert view == b'other'
+    assert not intact()
+
+
+@pytest.mark.parametrize('seq', [5, 0xffffffff])
+def test_put_after_a_writer_died(path, clock, seq):
+    # one way, so the slot has to be reused
+    store = sharedcache.SharedStore(path, slots=4, slot_size=256, ways=1,
+                                    seconds=clock)
+    try:
+        store.put(b'key', b'value', 10)
+        offset = store._find(b'key')[0]
+        # left odd, part way through a write
+        sharedcache._SEQ.pack_into(store._map, offset, seq)
+        assert store.get(b'key') is None
+        for value in [b'one', b'two', b'three']:
+            store.put(b'key', value, 10)
+            assert store.get(b'key') == value
+            assert not sharedcache._SEQ.unpack_from(store._map, offset)[0] & 1
+    finally:
+        store.close()
+
+
+def test_expiry(store, clock):
+    store.put(b'key', b'value', 10)
+    clock.now += 10
+    assert store.get(b'key') is None
+    assert len(store) == 0
+
+
+def test_too_large(store):
+    store.put(b'key', b'x' * store.max_bytes, 10)
+    assert store.get(b'key') is None
+
+
+def test_clock_eviction(path, clock):
+    store = sharedcache.SharedStore(path, slots=2, slot_size=128, ways=2,
+                                    seconds=clock)
+    try:
+        store.put(b'a', b'1', 10)
+        store.put(b'b', b'2', 10)
+        assert store.get(b'a') == b'1'
+        # b is the only unreferenced slot
+        store.put(b'c', b'3', 10)
+        assert store.get(b'b') is None
+        assert store.get(b'a') == b'1'
+        assert store.get(b'c') == b'3'
+    finally:
+        store.close()
+
+
+def test_shared_between_mappings(store, path, clock):
+    other = sharedcache.SharedStore(path, seconds=clock)
+    try:
+        # the geometry comes from the file
+        assert (other.slots, other.slot_size, other.ways) == (16, 256, 4)
+        store.put(b'key', b'value', 10)
+        assert other.get(b'key') == b'value'
+    finally:
+        other.close()
+
+
+def test_shared_between_processes(store, path):
+    subprocess.check_call([
+        sys.executable, '-c',
+        'from wip.sharedcache import SharedStore; '
+        'SharedStore(%r).put(b"key", b"from another process", 60)' % (
+            path,)])
+    assert store.get(b'key') == b'from another process'
+
+
+def test_not_a_cache_file(path):
+    with open(path, 'wb') as f:
+        f.write(b'x' * 100)
+    with pytest.raises(ValueError):
+        sharedcache.SharedStore(path)
+
+
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Cache-Control', 'max-age=60')])
+    return [b'cached body']
+
+
+ENVIRON = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'}
+
+
+def request(cache):
+    return cache(dict(ENVIRON), lambda status, headers, exc_info=None: None)
+
+
+def test_zero_copy_hits(store, clock):
+    cache = microcache.MicroCache(app, store=store, zero_copy=True,
+                                  seconds=clock)
+    b''.join(request(cache))
+    chunks = list(request(cache))
+    assert isinstance(chunks[0], memoryview)
+    assert b''.join(chunks) == b'cached body'
+    assert cache.stats == {'misses': 1, 'hits': 1}
+
+
+def test_zero_copy_torn_body(store, clock):
+    cache = microcache.MicroCache(app, store=store, zero_copy=True,
+                                  seconds=clock)
+    b''.join(request(cache))
+    result = iter(request(cache))
+    assert next(result) == b'cached bod'
+    store.put(cache._key(ENVIRON), b'overwritten', 60)
+    # short of the Content-Length, rather than an exception that would
+    # take the receiver down
+    assert list(result) == []
+    assert cache.stats['torn'] == 1
+
+
+def test_zero_copy_torn_headers_retry(store, clock):
+    cache = microcache.MicroCache(app, store=store, zero_copy=True,
+                                  seconds=clock)
+    b''.join(request(cache))
+    key = cache._key(ENVIRON)
+    get_view = cache._get_view
+
+    def torn_once(key):
+        cache._get_view = get_view
+        view, intact = get_view(key)
+        return view, lambda: False
+    cache._get_view = torn_once
+    started = []
+    chunks = cache(dict(ENVIRON),
+                   lambda status, headers, exc_info=None: started.append(
+                       headers))
+    assert b''.join(chunks) == b'cached body'
+    assert cache.stats['torn'] == 1 and cache.stats['hits'] == 2
+    [headers] = started
+    assert ('Content-Length', '11') in headers
+    assert store.get(key) is not None
@@ -0,0 +1,134 @@
+import collections
+import tempfile
+import threading
+
+from wip.lazy import types as t
+
+
+DEFAULT_MAX_MEMORY = 1024 * 1024
+READ_SIZE = 64 * 1024
+
+
+def _error(start_response, status):
+    body = status.encode('ascii')
+    start_response(status, [('Content-Type', 'text/plain'),
+                            ('Content-Length', str(len(body)))])
+    return [body]
+
+
+class SpoolBody(object):
+    # WSGI middleware that reads a request's whole body before calling
+    # the application, so an upload's slow client isn't the
+    # application's problem.  bodies are kept in memory up to
+    # max_memory bytes and in a temporary file in directory beyond
+    # that.  bodies longer than max_body are refused with a 413.
+
+    def __init__(self, app, max_memory=DEFAULT_MAX_MEMORY, max_body=None,
+                 directory=None):
+        self.app = app
+        self.max_memory = max_memory
+        self.max_body = max_body
+        self.directory = directory
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+
+    def _count(self, name, amount=1):
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    def _length(self, environ):
+        # the body's length, -1 for a chunked body whose length isn't
+        # known until it ends, or 0 if there isn't one
+        content_length = environ.get('CONTENT_LENGTH')
+        if content_length:
+            return int(content_length)
+        if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+            return -1
+        return 0
+
+    def __call__(self, environ, start_response):
+        length = self._length(environ)
+        if not length:
+            return self.app(environ, start_response)
+        if self.max_body is not None and length > self.max_body:
+            self._count('rejected')
+            return _error(start_response, '413 Request Entity Too Large')
+
+        spooled = tempfile.SpooledTemporaryFile(max_size=self.max_memory,
+                                                dir=self.directory)
+        try:
+            with t.SPOOL_BODY(content_length=length) as action:
+                size, complete = self._spool(environ['wsgi.input'], spooled,
+                                             length)
+                action.add_success_fields(length=size,
+                                          on_disk=size > self.max_memory)
+        except BaseException:
+            spooled.close()
+            raise
+        if self.max_body is not None and size > self.max_body:
+            spooled.close()
+            self._count('rejected')
+            return _error(start_response, '413 Request Entity Too Large')
+        if not complete or size < length:
+            # the client gave up part way
+            spooled.close()
+            self._count('truncated')
+            return _error(start_response, '400 Bad Request')
+
+        self._count('spooled')
+        self._count('bytes', size)
+        if size > self.max_memory:
+            self._count('on_disk')
+        spooled.seek(0)
+        environ['wsgi.input'] = spooled
+        environ['CONTENT_LENGTH'] = str(size)
+        # a chunked body has been read to its end; what's left has a length
+        environ.pop('HTTP_TRANSFER_ENCODING', None)
+        try:
+            result = self.app(environ, start_response)
+        except BaseException:
+            spooled.close()
+            raise
+        return _Spooled(result, spooled)
+
+    def _spool(self, wsgi_input, spooled, length):
+        # (how much was read, which is short of length if the client
+        # gave up, and False if the server found the body cut short or
+        # malformed).  a chunked body is only read until it outgrows
+        # max_body.
+        size = 0
+        while length < 0 or size < length:
+            wanted = READ_SIZE if length < 0 else min(READ_SIZE,
+                                                      length - size)
+            try:
+                data = wsgi_input.read(wanted)
+            except RuntimeError:
+                # how the HTTP/1.1 server's body readers say so
+                return size, False
+            if not data:
+                break
+            size += len(data)
+            if self.max_body is not None and size > self.max_body:
+                break
+            spooled.write(data)
+        return size, True
+
+
+class _Spooled(object):
+    # the application's response, which removes the spooled body once
+    # the server closes it
+
+    def __init__(self, result, spooled):
+        self._result = result
+        self._spooled = spooled
+
+    def __iter__(self):
+        return iter(self._result)
+
+    def close(self):
+        try:
+            close = getattr(self._result, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._spooled.close()
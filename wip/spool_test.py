@@ -0,0 +1,141 @@
+import io
+
+from eliot.testing import LoggedAction
+import pytest
+
+from wip import http11, spool, types
+
+
+class SlowInput(object):
+    # hands out at most a few bytes per read, like a slow uploader
+
+    def __init__(self, data, per_read=3):
+        self._input = io.BytesIO(data)
+        self._per_read = per_read
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        if size < 0:
+            size = self._per_read
+        return self._input.read(min(size, self._per_read))
+
+
+def run(middleware, body, content_length=True, chunked=False, **environ):
+    started = []
+
+    def start_response(status, response_headers, exc_info=None):
+        started.append(status)
+
+    environ.setdefault('wsgi.input', io.BytesIO(body))
+    if content_length:
+        environ.setdefault('CONTENT_LENGTH', str(len(body)))
+    if chunked:
+        environ['HTTP_TRANSFER_ENCODING'] = 'chunked'
+    response = middleware(environ, start_response)
+    try:
+        written = b''.join(response)
+    finally:
+        close = getattr(response, 'close', None)
+        if close is not None:
+            close()
+    return started[0], written
+
+
+def reading_app(seen):
+    def app(environ, start_response):
+        wsgi_input = environ['wsgi.input']
+        seen.append((wsgi_input, environ['CONTENT_LENGTH'],
+                     wsgi_input.read(), environ))
+        start_response('200 OK', [])
+        return [b'done']
+    return app
+
+
+@pytest.mark.parametrize('size,on_disk', [(10, False), (100, True)])
+def test_body_is_read_before_the_app_is_called(capture_logging, size,
+                                               on_disk):
+    seen = []
+    body = b'x' * size
+    slow = SlowInput(body)
+    middleware = spool.SpoolBody(reading_app(seen), max_memory=50)
+    with capture_logging() as logger:
+        assert run(middleware, body, **{'wsgi.input': slow}) == (
+            '200 OK', b'done')
+    [(wsgi_input, content_length, read, _)] = seen
+    assert read == body
+    assert content_length == str(size)
+    assert wsgi_input is not slow
+    # the body was closed along with the response
+    assert wsgi_input.closed
+    [action] = LoggedAction.ofType(logger.messages, types.SPOOL_BODY)
+    assert action.succeeded
+    assert action.endMessage['length'] == size
+    assert action.endMessage['on_disk'] is on_disk
+    assert middleware.stats['spooled'] == 1
+    assert middleware.stats['bytes'] == size
+    assert middleware.stats['on_disk'] == int(on_disk)
+
+
+def test_requests_without_bodies_pass_through(capture_logging):
+    seen = []
+    original = io.BytesIO()
+    middleware = spool.SpoolBody(reading_app(seen))
+    with capture_logging():
+        run(middleware, b'', **{'wsgi.input': original})
+    assert seen[0][0] is original
+    assert not middleware.stats
+
+
+def test_chunked_bodies_are_spooled_until_they_end(capture_logging):
+    seen = []
+    body = b'y' * 200
+    middleware = spool.SpoolBody(reading_app(seen), max_memory=50)
+    with capture_logging():
+        run(middleware, body, content_length=False, chunked=True,
+            CONTENT_LENGTH='')
+    assert seen[0][1:3] == ('200', body)
+    assert 'HTTP_TRANSFER_ENCODING' not in seen[0][3]
+
+
+@pytest.mark.parametrize('content_length', [True, False])
+def test_bodies_over_max_body_are_refused(capture_logging, content_length):
+    seen = []
+    middleware = spool.SpoolBody(reading_app(seen), max_body=10)
+    with capture_logging():
+        status, _ = run(middleware, b'z' * 11, content_length=content_length,
+                        chunked=not content_length)
+    assert status == '413 Request Entity Too Large'
+    assert not seen
+    assert middleware.stats['rejected'] == 1
+
+
+def test_truncated_bodies_are_refused(capture_logging):
+    seen = []
+    middleware = spool.SpoolBody(reading_app(seen))
+    with capture_logging():
+        status, _ = run(middleware, b'short', CONTENT_LENGTH='100')
+    assert status == '400 Bad Request'
+    assert not seen
+    assert middleware.stats['truncated'] == 1
+
+
+@pytest.mark.parametrize('body,chunked', [
+    (b'GET / HTTP/1.1\r\nContent-Length: 100\r\n\r\nshort', False),
+    (b'GET / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+     b'10\r\nshort', True),
+])
+def test_bodies_the_server_finds_cut_short_are_refused(capture_logging, body,
+                                                       chunked):
+    # the HTTP/1.1 server's readers raise rather than return short
+    seen = []
+    middleware = spool.SpoolBody(reading_app(seen))
+    instream = io.BytesIO(body)
+    environ = http11.HTTPRequestProcessor(
+        instream, io.BytesIO())._determine_environment()
+    with capture_logging():
+        status, _ = run(middleware, b'', content_length=False,
+                        chunked=chunked, **environ)
+    assert status == '400 Bad Request'
+    assert not seen
+    assert middleware.stats['truncated'] == 1
@@ -0,0 +1,316 @@
+import argparse
+import signal
+import subprocess
+import sys
+import time
+
+from wip.common import allowed_cpus, parse_cpus
+from wip.lazy import types as t
+from wip.receiver import shard_processors, SocketPassProcessor
+from wip.scoreboard import Scoreboard
+
+
+DEFAULT_INTERVAL = 1.0
+# how long a receiver that's been told to stop has to finish its
+# request before it's killed
+RETIRE_TIMEOUT = 10.0
+
+
+class ScalingPolicy(object):
+    # how many receivers there should be, given how busy they are and
+    # how many connections are waiting to be accepted.
+    #
+    # it grows when the busy ratio reaches up_busy, or up_queue
+    # connections are waiting, for up_samples samples in a row, and
+    # shrinks when nothing's waiting and the busy ratio is under
+    # down_busy for down_samples in a row.  the gap between the
+    # thresholds, the longer wait to shrink and the cooldown after any
+    # change keep it from flapping.
+
+    def __init__(self, minimum, maximum, up_busy=0.8, down_busy=0.3,
+                 up_queue=1, up_samples=2, down_samples=10, cooldown=5.0,
+                 seconds=time.time):
+        if not 0 < minimum <= maximum:
+            raise ValueError('need 0 < minimum <= maximum')
+        if not down_busy < up_busy:
+            raise ValueError('down_busy must be below up_busy')
+        self.minimum = minimum
+        self.maximum = maximum
+        self.up_busy = up_busy
+        self.down_busy = down_busy
+        self.up_queue = up_queue
+        self.up_samples = up_samples
+        self.down_samples = down_samples
+        self.cooldown = cooldown
+        self._seconds = seconds
+        self._pressure = 0
+        self._slack = 0
+        self._changed = None
+
+    def decide(self, workers, busy_ratio, queue_depth=None):
+        if workers < self.minimum:
+            return self.minimum
+        if workers > self.maximum:
+            return self.maximum
+        queued = queue_depth is not None and queue_depth >= self.up_queue
+        if queued or busy_ratio >= self.up_busy:
+            self._pressure += 1
+            self._slack = 0
+        elif not queue_depth and busy_ratio < self.down_busy:
+            self._slack += 1
+            self._pressure = 0
+        else:
+            self._pressure = self._slack = 0
+
+        now = self._seconds()
+        if (self._changed is not None and
+                now - self._changed < self.cooldown):
+            return workers
+        wanted = workers
+        if self._pressure >= self.up_samples and workers < self.maximum:
+            wanted = workers + 1
+        elif self._slack >= self.down_samples and workers > self.minimum:
+            wanted = workers - 1
+        if wanted != workers:
+            self._changed = now
+            self._pressure = self._slack = 0
+        return wanted
+
+
+class Supervisor(object):
+    # keeps between policy.minimum and policy.maximum receivers attached
+    # to a handoff daemon, each with a slot on the scoreboard
+
+    def __init__(self, handoff_path, receiver_args, policy, scoreboard_path,
+                 seconds=time.time, listeners=None, cpus=None, shard=False,
+                 dispatched=False, retire_timeout=RETIRE_TIMEOUT):
+        self.handoff_path = handoff_path
+        self.receiver_args = list(receiver_args)
+        # receivers are pinned to these in turn, by slot
+        self.cpus = cpus
+        # and serve the listeners' shards by slot
+        self.shard = shard
+        self.policy = policy
+        self.retire_timeout = retire_timeout
+        self.scoreboard_path = scoreboard_path
+        self.scoreboard = Scoreboard(scoreboard_path, policy.maximum)
+        self._seconds = seconds
+        # slot index: process
+        self.workers = {}
+        self._last = None
+        # receivers take connections from a handoff daemon in
+        # dispatch mode, which keeps its listeners to itself
+        self.dispatched = dispatched
+        # the supervisor's own copies of the listeners, by name, only to
+        # look at their accept queues
+        if listeners is None:
+            listeners = {}
+            if not dispatched:
+                listeners = SocketPassProcessor.all_from_path(handoff_path)
+        self._listeners = listeners
+        # the most shards any listener was split into
+        self.shards = max([len(processors) for processors
+                           in shard_processors(listeners).values()] or [1])
+        if shard and policy.minimum < self.shards:
+            self.close()
+            # or some shard is never served
+            raise ValueError('%d receivers for %d shards'
+                             % (policy.minimum, self.shards))
+
+    def _spawn(self):
+        index = min(set(range(self.policy.maximum)) - set(self.workers))
+        self.scoreboard.clear(index)
+        args = [sys.executable, '-m', 'wip.receiver',
+                '--scoreboard', self.scoreboard_path,
+                '--scoreboard-slot', str(index)]
+        if self.cpus:
+            args.extend(['--cpu', str(self.cpus[index % len(self.cpus)])])
+        if self.shard:
+            args.extend(['--shard', str(index)])
+        if self.dispatched:
+            args.append('--dispatched')
+        args.extend(self.receiver_args)
+        args.append(self.handoff_path)
+        self.workers[index] = subprocess.Popen(args)
+
+    def _retire(self, active):
+        # the newest of the receivers with the fewest requests running;
+        # one that's idle now most likely stays idle until the signal
+        # arrives
+        index = min(self.workers, key=lambda index: (active.get(index, 0),
+                                                     -index))
+        self._terminate({index: self.workers.pop(index)})
+
+    def _terminate(self, processes):
+        # SIGTERM lets a receiver finish the request it's running; any
+        # still going when retire_timeout's up are killed
+        for process in processes.values():
+            process.terminate()
+        deadline = time.time() + self.retire_timeout
+        for index, process in sorted(processes.items()):
+            try:
+                process.wait(timeout=max(0.0, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                t.RECEIVER_KILLED(slot=index).write()
+                process.kill()
+                process.wait()
+
+    def _reap(self):
+        for index, process in list(self.workers.items()):
+            if process.poll() is not None:
+                t.RECEIVER_EXITED(slot=index,
+                                  status=process.returncode).write()
+                del self.workers[index]
+
+    def sample(self):
+        # (busy ratio since the last sample, accept queue depth or None,
+        # and how many requests each receiver is running)
+        now = self._seconds()
+        busy = {}
+        active = {}
+        capacity = 0
+        for index in self.workers:
+            pid, slot_capacity, slot_active, _, busy_seconds = (
+                self.scoreboard.read(index, now))
+            if pid:
+                busy[index] = busy_seconds
+                active[index] = slot_active
+                capacity += slot_capacity
+        last, self._last = self._last, (now, busy)
+        ratio = 0.0
+        if last is not None and capacity and now > last[0]:
+            then, before = last
+            used = sum(busy_seconds - before.get(index, busy_seconds)
+                       for index, busy_seconds in busy.items())
+            ratio = min(1.0, used / ((now - then) * capacity))
+        # every shard of every listener, or the connections in a shard
+        # no receiver serves go unnoticed
+        depth = None
+        for listener in self._listeners.values():
+            queue = listener.accept_queue()
+            if queue is not None:
+                depth = (depth or 0) + queue[0]
+        return ratio, depth, active
+
+    def step(self):
+        self._reap()
+        ratio, depth, active = self.sample()
+        workers = len(self.workers)
+        wanted = self.policy.decide(workers, ratio, depth)
+        if wanted != workers:
+            t.SCALE(workers=workers, wanted=wanted, busy_ratio=ratio,
+                    queue_depth=-1 if depth is None else depth).write()
+        while len(self.workers) < wanted:
+            self._spawn()
+        while len(self.workers) > wanted:
+            self._retire(active)
+
+    def stop(self):
+        self._terminate(self.workers)
+        self.workers.clear()
+        self.close()
+
+    def close(self):
+        for listener in self._listeners.values():
+            listener.close()
+        self.scoreboard.close()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='wip.supervisor',
+        description='run between --min and --max receivers against a '
+                    'handoff daemon, following load')
+    parser.add_argument('handoff_path')
+    parser.add_argument('receiver_args', nargs=argparse.REMAINDER,
+                        help='after --, options for each receiver')
+    parser.add_argument('--min', type=int, default=1, dest='minimum')
+    parser.add_argument('--max', type=int, default=8, dest='maximum')
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                        metavar='SECONDS', help='how often to sample')
+    parser.add_argument('--up-busy', type=float, default=0.8,
+                        metavar='RATIO',
+                        help='grow when receivers are this busy')
+    parser.add_argument('--down-busy', type=float, default=0.3,
+                        metavar='RATIO',
+                        help='shrink when receivers are less busy than '
+                             'this')
+    parser.add_argument('--up-queue', type=int, default=1,
+                        metavar='CONNECTIONS',
+                        help='grow when this many connections are '
+                             'waiting to be accepted (TCP only)')
+    parser.add_argument('--up-samples', type=int, default=2,
+                        metavar='N')
+    parser.add_argument('--down-samples', type=int, default=10,
+                        metavar='N')
+    parser.add_argument('--cooldown', type=float, default=5.0,
+                        metavar='SECONDS',
+                        help='how long to leave things after a change')
+    parser.add_argument('--scoreboard', metavar='PATH',
+                        help='default: the handoff path plus .scoreboard')
+    parser.add_argument('--pin', action='store_true',
+                        help='pin each receiver to one CPU, taking '
+                             '--pin-cpus in turn')
+    parser.add_argument('--pin-cpus', type=parse_cpus, metavar='CPUS',
+                        help='like 0-3,8 or node0 (default: every CPU '
+                             'this process may use)')
+    parser.add_argument('--shard', action='store_true',
+                        help='have each receiver serve its own shard of '
+                             'listeners the handoff daemon split up; with '
+                             '--pin and as many shards as CPUs, each '
+                             'shard stays on one CPU.  needs --min of at '
+                             'least the number of shards.')
+    parser.add_argument('--dispatched', action='store_true',
+                        help='the handoff daemon runs with --dispatch; '
+                             'receivers get --dispatched, and how many '
+                             'connections wait is unknown')
+    parser.add_argument('--retire-timeout', type=float,
+                        default=RETIRE_TIMEOUT, metavar='SECONDS',
+                        help='how long a receiver being stopped has to '
+                             'finish its request before it is killed')
+    parser.add_argument('--no-log', action='store_false', dest='log')
+    args = parser.parse_args(argv)
+    if args.receiver_args[:1] == ['--']:
+        args.receiver_args = args.receiver_args[1:]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.log:
+        import eliot
+        eliot.to_file(sys.stdout)
+    else:
+        t.disable_logging()
+    policy = ScalingPolicy(args.minimum, args.maximum,
+                           up_busy=args.up_busy, down_busy=args.down_busy,
+                           up_queue=args.up_queue,
+                           up_samples=args.up_samples,
+                           down_samples=args.down_samples,
+                           cooldown=args.cooldown)
+    cpus = None
+    if args.pin:
+        cpus = args.pin_cpus or allowed_cpus()
+    try:
+        supervisor = Supervisor(
+            args.handoff_path, args.receiver_args, policy,
+            args.scoreboard or args.handoff_path + '.scoreboard',
+            cpus=cpus, shard=args.shard, dispatched=args.dispatched,
+            retire_timeout=args.retire_timeout)
+    except ValueError as e:
+        raise SystemExit('--shard needs --min of at least the number '
+                         'of shards: %s' % (e,))
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        while True:
+            supervisor.step()
+            time.sleep(args.interval)
+    finally:
+        supervisor.stop()
+
+
+if __name__ == '__main__':
+    main()
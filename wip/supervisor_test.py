@@ -0,0 +1,290 @@
+import subprocess
+
+from eliot.testing import LoggedMessage
+import pytest
+
+from wip import scoreboard, supervisor, types
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def policy(clock, **kw):
+    options = dict(minimum=1, maximum=3, up_samples=2, down_samples=3,
+                   cooldown=5, seconds=clock)
+    options.update(kw)
+    return supervisor.ScalingPolicy(**options)
+
+
+@pytest.mark.parametrize('kw', [
+    {'minimum': 0},
+    {'minimum': 4},
+    {'up_busy': 0.3, 'down_busy': 0.3},
+])
+def test_policy_refuses_nonsense(kw):
+    with pytest.raises(ValueError):
+        policy(Clock(), **kw)
+
+
+def test_policy_keeps_within_bounds():
+    scaling = policy(Clock())
+    assert scaling.decide(0, 0.0) == 1
+    assert scaling.decide(5, 1.0) == 3
+
+
+def test_policy_grows_on_sustained_load():
+    clock = Clock()
+    scaling = policy(clock)
+    assert scaling.decide(1, 0.9) == 1
+    assert scaling.decide(1, 0.9) == 2
+    # cooling down
+    clock.now += 1
+    assert [scaling.decide(2, 1.0) for _ in range(3)] == [2, 2, 2]
+    clock.now += 5
+    assert scaling.decide(2, 1.0) == 3
+    clock.now += 5
+    assert [scaling.decide(3, 1.0) for _ in range(3)] == [3, 3, 3]
+
+
+def test_policy_grows_on_queued_connections():
+    scaling = policy(Clock())
+    assert scaling.decide(1, 0.0, queue_depth=2) == 1
+    assert scaling.decide(1, 0.0, queue_depth=2) == 2
+
+
+def test_policy_ignores_spikes():
+    scaling = policy(Clock())
+    for ratio in [0.9, 0.5, 0.9, 0.1, 0.9, 0.5]:
+        assert scaling.decide(2, ratio) == 2
+
+
+def test_policy_shrinks_slowly():
+    clock = Clock()
+    scaling = policy(clock)
+    assert [scaling.decide(3, 0.1) for _ in range(3)] == [3, 3, 2]
+    clock.now += 5
+    # a queue, even with idle receivers, isn't slack
+    assert scaling.decide(2, 0.1, queue_depth=1) == 2
+    assert [scaling.decide(2, 0.1, queue_depth=0) for _ in range(3)] == [
+        2, 2, 1]
+    clock.now += 5
+    assert [scaling.decide(1, 0.0) for _ in range(5)] == [1] * 5
+
+
+class FakeListener(object):
+
+    def __init__(self, queue=None):
+        self.queue = queue
+
+    def accept_queue(self):
+        return self.queue
+
+    def close(self):
+        pass
+
+
+class FakeProcess(object):
+
+    def __init__(self, returncode=None, finishes=True):
+        self.returncode = returncode
+        self.terminated = False
+        self.killed = False
+        # whether SIGTERM's enough
+        self.finishes = finishes
+        self.timeouts = []
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        self.terminated = True
+
+    def kill(self):
+        self.killed = True
+
+    def wait(self, timeout=None):
+        self.timeouts.append(timeout)
+        if timeout is not None and not (self.finishes or self.killed):
+            raise subprocess.TimeoutExpired('receiver', timeout)
+        return self.returncode
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def supervised(tmpdir, clock):
+    supervised = supervisor.Supervisor(
+        'handoff.sock', [], policy(clock), str(tmpdir.join('scoreboard')),
+        seconds=clock, listeners={'default': FakeListener((4, 128))})
+    yield supervised
+    supervised.stop()
+
+
+def test_sample_busy_ratio(supervised, clock):
+    board = supervised.scoreboard
+    supervised.workers = {0: FakeProcess(), 1: FakeProcess(),
+                          2: FakeProcess()}
+    busy = board.slot(0, capacity=2, seconds=clock)
+    board.slot(1, capacity=2, seconds=clock)
+    # slot 2's receiver hasn't started yet
+    assert supervised.sample() == (0.0, 4, {0: 0, 1: 0})
+    busy.busy()
+    started = busy.busy()
+    clock.now += 2
+    busy.idle(started)
+    ratio, depth, active = supervised.sample()
+    # two requests for two seconds, out of four at a time
+    assert ratio == pytest.approx(4.0 / 8)
+    assert active == {0: 1, 1: 0}
+
+
+def test_step_reaps_and_retires(capture_logging, supervised, clock):
+    spawned = []
+    supervised._spawn = lambda: spawned.append(True)
+    exited = FakeProcess(returncode=3)
+    running = [FakeProcess(), FakeProcess()]
+    supervised.workers = {0: running[0], 1: exited, 2: running[1]}
+    supervised.scoreboard.slot(0, seconds=clock).busy()
+    supervised.policy = policy(clock, down_samples=1)
+    supervised._listeners['default'].queue = None
+    with capture_logging() as logger:
+        supervised.step()
+    (message,) = LoggedMessage.ofType(logger.messages,
+                                      types.RECEIVER_EXITED)
+    assert message.message['slot'] == 1
+    assert message.message['status'] == 3
+    # nothing's busy yet, so the newest idle receiver goes
+    assert sorted(supervised.workers) == [0]
+    assert running[1].terminated and not running[0].terminated
+    # given time to finish its request
+    assert not running[1].killed
+    assert running[1].timeouts == [pytest.approx(10.0, abs=1.0)]
+    (message,) = LoggedMessage.ofType(logger.messages, types.SCALE)
+    assert message.message['workers'] == 2
+    assert message.message['wanted'] == 1
+    assert message.message['queue_depth'] == -1
+    assert not spawned
+
+
+def test_receivers_that_dont_finish_are_killed(capture_logging, supervised):
+    stuck = FakeProcess(finishes=False)
+    finishing = FakeProcess()
+    supervised.retire_timeout = 0.5
+    supervised.workers = {0: finishing, 1: stuck}
+    with capture_logging() as logger:
+        supervised._retire({})
+    assert stuck.terminated and stuck.killed
+    assert stuck.timeouts == [pytest.approx(0.5, abs=0.1), None]
+    (message,) = LoggedMessage.ofType(logger.messages,
+                                      types.RECEIVER_KILLED)
+    assert message.message['slot'] == 1
+
+
+def test_spawn_clears_the_slot(capture_logging, tmpdir, clock, monkeypatch):
+    launched = []
+    monkeypatch.setattr(supervisor.subprocess, 'Popen',
+                        lambda args: launched.append(args) or FakeProcess())
+    path = str(tmpdir.join('scoreboard'))
+    supervised = supervisor.Supervisor(
+        'handoff.sock', ['--twisted'], policy(clock), path,
+        seconds=clock, listeners={'default': FakeListener()})
+    old = scoreboard.Scoreboard(path, 1)
+    old.slot(0).busy()
+    old.close()
+    with capture_logging():
+        supervised.step()
+    assert supervised.scoreboard.read(0, clock.now) == (0, 0, 0, 0, 0.0)
+    (args,) = launched
+    assert args[1:] == ['-m', 'wip.receiver', '--scoreboard', path,
+                        '--scoreboard-slot', '0', '--twisted',
+                        'handoff.sock']
+    supervised.workers.clear()
+    supervised.stop()
+
+
+def test_parse_args():
+    args = supervisor.parse_args(['--max', '4', 'handoff.sock', '--',
+                                  '--twisted', '--threads', '8'])
+    assert args.maximum == 4
+    assert args.handoff_path == 'handoff.sock'
+    assert args.receiver_args == ['--twisted', '--threads', '8']
+
+
+def test_spawn_pins_and_shards(capture_logging, tmpdir, clock, monkeypatch):
+    launched = []
+    monkeypatch.setattr(supervisor.subprocess, 'Popen',
+                        lambda args: launched.append(args) or FakeProcess())
+    supervised = supervisor.Supervisor(
+        'handoff.sock', [], policy(clock, minimum=3),
+        str(tmpdir.join('scoreboard')), seconds=clock,
+        listeners={'default': FakeListener(), 'default:1': FakeListener()},
+        cpus=[2, 5], shard=True)
+    with capture_logging():
+        supervised.step()
+    placement = [args[args.index('--cpu'):args.index('handoff.sock')]
+                 for args in launched]
+    assert placement == [['--cpu', '2', '--shard', '0'],
+                         ['--cpu', '5', '--shard', '1'],
+                         ['--cpu', '2', '--shard', '2']]
+    supervised.workers.clear()
+    supervised.stop()
+
+
+def test_shards_need_enough_receivers(tmpdir, clock):
+    listeners = {'default': FakeListener(), 'default:1': FakeListener(),
+                 'default:2': FakeListener()}
+    with pytest.raises(ValueError):
+        supervisor.Supervisor(
+            'handoff.sock', [], policy(clock, minimum=2),
+            str(tmpdir.join('scoreboard')), seconds=clock,
+            listeners=listeners, shard=True)
+    # without --shard every receiver serves every shard
+    supervised = supervisor.Supervisor(
+        'handoff.sock', [], policy(clock, minimum=2),
+        str(tmpdir.join('scoreboard')), seconds=clock, listeners=listeners)
+    assert supervised.shards == 3
+    supervised.stop()
+
+
+def test_sample_counts_every_shard(tmpdir, clock):
+    supervised = supervisor.Supervisor(
+        'handoff.sock', [], policy(clock), str(tmpdir.join('scoreboard')),
+        seconds=clock, listeners={'default': FakeListener((1, 128)),
+                                  'default:1': FakeListener((3, 128)),
+                                  'admin': FakeListener()})
+    assert supervised.sample()[1] == 4
+    supervised.stop()
+
+
+def test_parse_args_pin():
+    args = supervisor.parse_args(['--pin', '--pin-cpus', '0-1', 'h.sock'])
+    assert args.pin
+    assert args.pin_cpus == [0, 1]
+    with pytest.raises(SystemExit):
+        supervisor.parse_args(['--pin-cpus', '1-0', 'h.sock'])
+
+
+def test_dispatched_receivers(capture_logging, tmpdir, clock, monkeypatch):
+    launched = []
+    monkeypatch.setattr(supervisor.subprocess, 'Popen',
+                        lambda args: launched.append(args) or FakeProcess())
+    # there's no listener to look at, so no from_path
+    supervised = supervisor.Supervisor(
+        'handoff.sock', [], policy(clock), str(tmpdir.join('scoreboard')),
+        seconds=clock, dispatched=True)
+    with capture_logging():
+        supervised.step()
+    [args] = launched
+    assert '--dispatched' in args
+    assert supervised.sample()[1] is None
+    supervised.workers.clear()
+    supervised.stop()
@@ -9,6 +9,44 @@ HANDOFF = eliot.ActionType(
         family=int, type=int, proto=int),
     u'A listening socket is being handed off.')
 
+HANDOFF_LISTENERS = eliot.ActionType(
+    u'wip:handoff_listeners',
+    eliot.fields(
+        path=str),
+    eliot.fields(
+        names=list),
+    u'Several named listening sockets are being handed off at once.')
+
+DISPATCH_ATTACH = eliot.ActionType(
+    u'wip:dispatch_attach',
+    eliot.fields(
+        path=str),
+    [],
+    u'A receiver is asking a handoff daemon in dispatch mode for the '
+    u'connections it accepts.')
+
+ADOPT_SOCKET = eliot.ActionType(
+    u'wip:adopt_socket',
+    eliot.fields(
+        fd=int),
+    eliot.fields(
+        family=int, type=int, proto=int),
+    u'An inherited listening socket is being adopted.')
+
+PIN_CPUS = eliot.MessageType(
+    u'wip:pin_cpus',
+    eliot.fields(
+        cpus=list),
+    u'The receiver is keeping to these CPUs.')
+
+STEER_LISTENER = eliot.MessageType(
+    u'wip:steer_listener',
+    eliot.fields(
+        name=str,
+        cpu=int),
+    u'The kernel is asked to prefer this shard of a listener for '
+    u'connections whose packets the given CPU handles.')
+
 SCGI_ACCEPTED = eliot.MessageType(
     u'wip:scgi_accepted',
     [],
@@ -26,12 +64,119 @@ SCGI_PARSE = eliot.ActionType(
     [],
     u'A new SCGI request is being parsed.')
 
+UWSGI_PARSE = eliot.ActionType(
+    u'wip:uwsgi_parse',
+    [],
+    [],
+    u'A new uwsgi request is being parsed.')
+
+HTTP_PARSE = eliot.ActionType(
+    u'wip:http_parse',
+    [],
+    [],
+    u'A new HTTP request is being parsed.')
+
+FASTCGI_REQUEST = eliot.ActionType(
+    u'wip:fastcgi_request',
+    eliot.fields(
+        request_id=int),
+    [],
+    u'A multiplexed FastCGI request is being handled.')
+
+FASTCGI_IDLE = eliot.MessageType(
+    u'wip:fastcgi_idle',
+    [],
+    u'A kept FastCGI connection sat idle and is being closed.')
+
 WSGI_REQUEST = eliot.ActionType(
     u'wip:wsgi_request',
     eliot.fields(
         path=str),
+    eliot.fields(
+        cpu_seconds=float,
+        user_seconds=float,
+        system_seconds=float,
+        voluntary_switches=int,
+        involuntary_switches=int,
+        major_faults=int,
+        bytes_read=int,
+        bytes_written=int),
+    u'A WSGI application is being called.  On success, what the thread '
+    u'calling it used meanwhile: CPU time, context switches and major '
+    u'page faults, and the bytes read from wsgi.input and written to '
+    u'the client.')
+
+SPOOL_BODY = eliot.ActionType(
+    u'wip:spool_body',
+    eliot.fields(
+        content_length=int),
+    eliot.fields(
+        length=int,
+        on_disk=bool),
+    u'A request body is being read in full before the application is '
+    u'called.')
+
+RECEIVER_STATS = eliot.MessageType(
+    u'wip:receiver_stats',
+    eliot.fields(
+        connections=int,
+        queued=int,
+        active=int,
+        requests=int),
+    u'How many connections an evented receiver has open, how many of '
+    u'their requests are waiting for or running on a thread, and how '
+    u'many it has served.')
+
+ROUTE_STATS = eliot.MessageType(
+    u'wip:route_stats',
+    eliot.fields(
+        route=str,
+        count=int,
+        seconds=float,
+        max_seconds=float,
+        cpu_seconds=float,
+        bytes_out=int,
+        statuses=dict),
+    u'The totals for one route since the last flush: its requests, the '
+    u'time they took and the CPU time they used, the bytes they wrote '
+    u'and their status classes.')
+
+SCALE = eliot.MessageType(
+    u'wip:scale',
+    eliot.fields(
+        workers=int,
+        wanted=int,
+        busy_ratio=float,
+        queue_depth=int),
+    u'The supervisor is changing how many receivers there are, given '
+    u'how busy they were and how many connections were waiting, or -1 '
+    u'if that is not known.')
+
+RECEIVER_EXITED = eliot.MessageType(
+    u'wip:receiver_exited',
+    eliot.fields(
+        slot=int,
+        status=int),
+    u'A receiver the supervisor started exited by itself.')
+
+RECEIVER_KILLED = eliot.MessageType(
+    u'wip:receiver_killed',
+    eliot.fields(
+        slot=int),
+    u'A receiver the supervisor stopped was still running its request '
+    u'when the time to finish it ran out, so it was killed.')
+
+CLIENT_GONE = eliot.MessageType(
+    u'wip:client_gone',
     [],
-    u'A WSGI application is being called.')
+    u'The client hung up, so the response was abandoned.')
+
+MALFORMED_HEADERS = eliot.MessageType(
+    u'wip:malformed_headers',
+    eliot.fields(
+        reason=str),
+    u'The web server sent headers that make no sense, so the connection '
+    u'was dropped.')
 
 RESPONSE_STARTED = eliot.MessageType(
     u'wip:response_started',
@@ -0,0 +1,92 @@
+import io
+import struct
+
+from wip.lazy import types as t
+from wip.common import headers_to_bytes, headers_to_native_strings
+from wip.receiver import MalformedHeaders, WSGIRequestProcessor
+
+
+# modifier1, datasize, modifier2; all little endian
+_PACKET_HEADER = struct.Struct('<BHB')
+_VAR_LENGTH = struct.Struct('<H')
+
+WSGI_MODIFIER = 0
+
+
+def read_packet(f):
+    header = f.read(_PACKET_HEADER.size)
+    if len(header) != _PACKET_HEADER.size:
+        raise MalformedHeaders('the connection ended before a packet header')
+    modifier1, size, modifier2 = _PACKET_HEADER.unpack(header)
+    if modifier1 != WSGI_MODIFIER:
+        raise MalformedHeaders('modifier1 must be %d, not %d'
+                               % (WSGI_MODIFIER, modifier1))
+    # the whole variable block in one exact-size read
+    block = f.read(size)
+    if len(block) != size:
+        raise MalformedHeaders('the variable block ended %d bytes short'
+                               % (size - len(block),))
+    return block
+
+
+def parse_vars(block):
+    # latin-1 maps every byte to one character, so offsets into the
+    # block are offsets into the decoded text.  decoding once and
+    # slicing is much cheaper than decoding each key and value.
+    [text] = headers_to_native_strings([block])
+    end = len(block)
+    unpack_from = _VAR_LENGTH.unpack_from
+    size = _VAR_LENGTH.size
+    environ = {}
+    offset = 0
+    while offset < end:
+        if offset + size > end:
+            raise MalformedHeaders('a key length runs past the block')
+        key_length, = unpack_from(block, offset)
+        key_end = offset + size + key_length
+        if key_end + size > end:
+            raise MalformedHeaders('a key runs past the block')
+        value_length, = unpack_from(block, key_end)
+        value_end = key_end + size + value_length
+        if value_end > end:
+            raise MalformedHeaders('a value runs past the block')
+        environ[text[offset + size:key_end]] = text[key_end + size:value_end]
+        offset = value_end
+    return environ
+
+
+def read_vars(f):
+    with t.UWSGI_PARSE():
+        return parse_vars(read_packet(f))
+
+
+def encode_vars(environ):
+    # the inverse of read_vars, for clients and tests
+    block = b''.join(
+        b''.join([_VAR_LENGTH.pack(len(key)), key,
+                  _VAR_LENGTH.pack(len(value)), value])
+        for key, value in environ)
+    return _PACKET_HEADER.pack(WSGI_MODIFIER, len(block), 0) + block
+
+
+class UWSGIRequestProcessor(WSGIRequestProcessor):
+
+    def _determine_environment(self,
+                               _read_vars=read_vars,
+                               _io_factory=io.BytesIO):
+        environ = _read_vars(self._instream)
+        # nginx's uwsgi_params sends an empty CONTENT_LENGTH
+        content_length = environ.get('CONTENT_LENGTH') or '0'
+        if not content_length.isdigit():
+            raise MalformedHeaders('CONTENT_LENGTH must be a number')
+        if int(content_length):
+            wsgi_input = self._instream
+        else:
+            wsgi_input = _io_factory()
+        return self._populate_environment(environ, wsgi_input)
+
+    def _format_headers(self, status, response_headers):
+        headers = 'HTTP/1.1 %s\r\n%s\r\n' % (
+            status,
+            ''.join('%s: %s\r\n' % header for header in response_headers))
+        return headers_to_bytes(headers)
@@ -0,0 +1,114 @@
+import io
+import socket
+
+from eliot.testing import LoggedAction
+import pytest
+
+from wip import receiver, types, uwsgi
+
+
+SPEC_VARS = [(b'CONTENT_LENGTH', b'27'),
+             (b'REQUEST_METHOD', b'POST'),
+             (b'REQUEST_URI', b'/deepthought'),
+             (b'X_LATIN_1', b'\xbf'),
+             (b'EMPTY', b'')]
+SPEC_REQUEST = uwsgi.encode_vars(SPEC_VARS)
+
+
+def test_read_vars_succeeds(capture_logging):
+    parseable = io.BytesIO(SPEC_REQUEST + b'body')
+    expected = {'CONTENT_LENGTH': '27',
+                'REQUEST_METHOD': 'POST',
+                'REQUEST_URI': '/deepthought',
+                'X_LATIN_1': u'\N{INVERTED QUESTION MARK}',
+                'EMPTY': ''}
+
+    with capture_logging() as logger:
+        assert uwsgi.read_vars(parseable) == expected
+
+    assert parseable.read() == b'body'
+    actions = LoggedAction.ofType(logger.messages, types.UWSGI_PARSE)
+    assert actions and actions[0].succeeded
+
+
+@pytest.mark.parametrize('bad_packet', [
+    b'',
+    b'\x00\x05',
+    b'\x01\x00\x00\x00',
+    b'\x00\x05\x00\x00abc',
+    # key length runs past the end of the block
+    b'\x00\x04\x00\x00\x05\x00ab',
+    # missing value length
+    b'\x00\x03\x00\x00\x01\x00a',
+    # value length runs past the end of the block
+    b'\x00\x06\x00\x00\x01\x00a\x05\x00b',
+])
+def test_read_vars_fails(capture_logging, bad_packet):
+    with pytest.raises(receiver.MalformedHeaders), \
+            capture_logging() as logger:
+        uwsgi.read_vars(io.BytesIO(bad_packet))
+
+    fail_actions = LoggedAction.ofType(logger.messages, types.UWSGI_PARSE)
+    assert fail_actions and not fail_actions[0].succeeded
+
+
+@pytest.mark.parametrize('content_length,body', [
+    (b'5', b'hello'),
+    (b'', b''),
+])
+def test_run_app(capture_logging, content_length, body):
+    def echo(environ, start_response):
+        start_response('200 OK', [('X-Path', environ['PATH_INFO'])])
+        return [environ['wsgi.input'].read(len(body))]
+
+    instream = io.BytesIO(uwsgi.encode_vars([
+        (b'CONTENT_LENGTH', content_length),
+        (b'REQUEST_URI', b'/echo?x=1')]) + body)
+    outstream = io.BytesIO()
+
+    with capture_logging():
+        uwsgi.UWSGIRequestProcessor(instream, outstream).run_app(echo)
+
+    assert outstream.getvalue() == (b'HTTP/1.1 200 OK\r\n'
+                                    b'X-Path: /echo\r\n'
+                                    b'\r\n' + body)
+
+
+@pytest.mark.parametrize('garbage', [
+    # opened and closed without a word
+    b'',
+    # the variable block ends early
+    b'\x00\x20\x00\x00abc',
+    uwsgi.encode_vars([(b'CONTENT_LENGTH', b'lots')]),
+])
+def test_handle_request_survives_malformed_packets(capture_logging, garbage):
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(2)
+    clients = [socket.create_connection(listener.getsockname())
+               for _ in range(2)]
+
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        return [environ['wsgi.input'].read(5)]
+
+    processor = receiver.SocketPassProcessor(
+        listener, request_processor=uwsgi.UWSGIRequestProcessor.from_sock)
+    try:
+        clients[0].sendall(garbage)
+        clients[0].shutdown(socket.SHUT_WR)
+        clients[1].sendall(uwsgi.encode_vars([
+            (b'CONTENT_LENGTH', b'5'), (b'REQUEST_URI', b'/')]) + b'hello')
+        with capture_logging() as logger:
+            processor.handle_request(app)
+            processor.handle_request(app)
+        # the first is dropped without an answer, and the next served
+        assert clients[0].makefile('rb').read() == b''
+        assert clients[1].makefile('rb').read().endswith(b'\r\n\r\nhello')
+    finally:
+        for client in clients:
+            client.close()
+        listener.close()
+    [message] = [message for message in logger.messages
+                 if message.get('message_type') == 'wip:malformed_headers']
+    assert message['reason']